@@ -12,21 +12,28 @@
 import sys
 import os
 import time
-from urllib2 import urlopen, URLError, HTTPError
 import argparse
 import signal
 
 from libvirt import (VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTOFF,
+                     VIR_DOMAIN_NOSTATE, VIR_DOMAIN_SHUTDOWN,
+                     VIR_DOMAIN_XML_INACTIVE,
                      VIR_CONNECT_LIST_DOMAINS_ACTIVE,
                      VIR_CONNECT_LIST_DOMAINS_INACTIVE, libvirtError)
 
 from litpmnlibvirt.litp_libvirt_connector import get_handle
 from litpmnlibvirt.litp_libvirt_utils import (Libvirt_conf, Libvirt_vm_xml,
                                               Libvirt_vm_image, log,
+                                              Libvirt_image_registry,
+                                              Libvirt_storage_volume,
                                               Libvirt_cloud_init,
                                               Libvirt_systemd, echo_success,
-                                              echo_failure,
+                                              Libvirt_host_facts,
+                                              echo_failure, LazyModule,
                                               LitpLibvirtException)
+from litpmnlibvirt.litp_libvirt_timing import ActionTimer, Span, timed
+from litpmnlibvirt import litp_libvirt_metrics as metrics
+from litpmnlibvirt.litp_libvirt_platform import Platform
 
 LITP_LIBVIRT_SUCCESS = 0
 LITP_LIBVIRT_FAILURE = 1
@@ -35,23 +42,39 @@ LITP_LIBVIRT_BAD_CONFIG = 3
 LITP_LIBVIRT_STATUS_CHK_PORT = 12987
 LITP_LIBVIRT_STATUS_CHK_SLEEP = 5
 
+urllib2 = LazyModule('urllib2')
+
 INTERNAL_STATUS_OK = 0
 INTERNAL_STATUS_NOK = 1
 INTERNAL_STATUS_FAIL = 2
 
 INTERNAL_CHECK_FAIL_CODE = 503
+INTERNAL_STATUS_RESULTS = {INTERNAL_STATUS_OK: 'ok',
+                           INTERNAL_STATUS_NOK: 'nok',
+                           INTERNAL_STATUS_FAIL: 'fail'}
 
 # A timeout value of 0 means that a timeout exception will never be raised
 SERVICE_STOP_TIMEOUT = 0
 
 SECONDS_BEFORE_SHUTDOWN_RETRY = 30
 
+# Seconds force-stop waits for a domain that is starting or shutting down to
+# leave that state, overridden by 'force-stop-wait' in adaptor_data. Domains
+# in any other state, e.g. paused or crashed, are destroyed at once
+FORCE_STOP_WAIT = 5
+FORCE_STOP_POLL_INTERVAL = 0.2
+FORCE_STOP_TRANSITIONAL_STATES = (VIR_DOMAIN_NOSTATE, VIR_DOMAIN_SHUTDOWN)
+
 USAGE = "##CMD## <instance_name> [" + \
     "|".join(['start', 'stop', 'status', 'restart',
         'force-stop', 'force-restart', 'stop-undefine',
         'force-stop-undefine']) + "]\n"
 
 
+def urlopen(url):
+    return urllib2.urlopen(url)
+
+
 class Timeout(object):
     """ Timeout class using ALARM signal. """
     class Timeout(Exception):
@@ -74,11 +97,26 @@ class Timeout(object):
 
 class LitpLibVirtAdaptor(object):
 
-    def __init__(self, instance_name, base_os='7'):
+    def __init__(self, instance_name, base_os=None):
         self.instance_name = instance_name
         self.conf = Libvirt_conf(instance_name)
         self.systemd = Libvirt_systemd(instance_name)
-        self.base_os = base_os
+        self._platform = None
+        if base_os is not None:
+            self._platform = Platform.from_base_os(base_os)
+
+    @property
+    def platform(self):
+        """
+        Platform of the host, detected when first needed.
+        """
+        if self._platform is None:
+            self._platform = Platform.get()
+        return self._platform
+
+    @property
+    def base_os(self):
+        return self.platform.os_major
 
     def _is_defined(self):
         conn = get_handle()
@@ -106,6 +144,18 @@ class LitpLibVirtAdaptor(object):
         vm_data = self.conf.get_vm_data()
         return vm_data.get("image")
 
+    def _get_vm_xml(self):
+        return Libvirt_vm_xml(self.instance_name, conf=self.conf,
+                              host_facts=Libvirt_host_facts.get())
+
+    def _get_storage_pool(self):
+        try:
+            return Libvirt_storage_volume.get_pool_name(
+                self.conf.get_adaptor_data())
+        except (KeyError, LitpLibvirtException):
+            return None
+
+    @timed('define')
     def _define(self):
         log('Defining Domain "{0}"'.format(self.instance_name))
         conn = get_handle()
@@ -117,16 +167,95 @@ class LitpLibVirtAdaptor(object):
         adaptor_data = self.conf.get_adaptor_data()
         c_init = Libvirt_cloud_init(self.instance_name, adaptor_data)
         c_init.create_cloud_init_iso()
-        log('Copying base image "{image_name}" to instance directory for '
-            'Domain "{instance_name}"'.format(image_name=image_name,
-                instance_name=self.instance_name))
-        img_mgr.copy_image()
+        storage_pool = self._get_storage_pool()
+        if storage_pool:
+            log('Creating volume for Domain "{0}" in storage pool '
+                '"{1}"'.format(self.instance_name, storage_pool))
+            Libvirt_storage_volume(self.instance_name, image_name,
+                                   storage_pool).create()
+        elif not self.conf.restore_last_undefined_vm():
+            log('Copying base image "{image_name}" to instance directory for '
+                'Domain "{instance_name}"'.format(image_name=image_name,
+                    instance_name=self.instance_name))
+            img_mgr.copy_image()
         log('Adding XML definition for Domain "{0}"'.format(
                                                         self.instance_name))
-        xml = Libvirt_vm_xml(self.instance_name)
-        conn.defineXML(xml.build_machine_xml())
+        xml = self._get_vm_xml().build_machine_xml()
+        with Span('define_xml'):
+            conn.defineXML(xml)
+        self.conf.save_domain_xml(xml)
+        self.conf.save_defined_base_image(image_name)
         log('Domain "{0}" defined'.format(self.instance_name))
 
+    def _is_definition_unchanged(self):
+        """
+        Returns True if only config.json changed, the base image is the one
+        the domain was defined from and the domain XML generated from it is
+        identical to the defined one, in which case the domain does not need
+        to be redefined.
+        """
+        if self.conf.get_changed_config_files() != [self.conf.conf_file]:
+            return False
+        defined_xml = self.conf.get_domain_xml()
+        if defined_xml is None or not self._is_defined():
+            return False
+        if not self._is_base_image_unchanged():
+            return False
+        if not self._is_cloud_init_unchanged():
+            return False
+        try:
+            xml = self._get_vm_xml().build_machine_xml()
+        except LitpLibvirtException as ex:
+            log(str(ex), level='ERROR')
+            return False
+        diff = Libvirt_vm_xml.diff_domain_xml(defined_xml, xml)
+        if not diff:
+            try:
+                libvirt_xml = self._get_domain().XMLDesc(
+                    VIR_DOMAIN_XML_INACTIVE)
+            except libvirtError as ex:
+                log(str(ex), level='ERROR')
+                return False
+            diff = Libvirt_vm_xml.missing_domain_xml(xml, libvirt_xml)
+        if diff:
+            log('XML definition for Domain "{0}" changed:'.format(
+                self.instance_name))
+            for line in diff:
+                log('  {0}'.format(line))
+            return False
+        return True
+
+    def _is_base_image_unchanged(self):
+        """
+        Returns True if the base image has the same size, modification time
+        and inode as when the domain was defined, as a base image replaced
+        under the same name does not change the domain XML.
+        """
+        identity = self.conf.get_base_image_identity(self._get_image_name())
+        if identity != self.conf.get_defined_base_image():
+            log('Base image for Domain "{0}" changed'.format(
+                self.instance_name))
+            return False
+        return True
+
+    def _is_cloud_init_unchanged(self):
+        """
+        Returns True if the disk mounts written to the cloud-init ISO from
+        config.json are the same as in its .live copy, as only their
+        devices are part of the domain XML.
+        """
+        try:
+            live_adaptor_data = self.conf.get_live_conf()['adaptor_data']
+            adaptor_data = self.conf.get_adaptor_data()
+        except (KeyError, LitpLibvirtException):
+            return False
+        if (live_adaptor_data.get('disk_mounts') !=
+                adaptor_data.get('disk_mounts')):
+            log('Disk mounts for Domain "{0}" changed'.format(
+                self.instance_name))
+            return False
+        return True
+
     def _is_started(self):
         return self._get_domain_state() == VIR_DOMAIN_RUNNING
 
@@ -150,7 +279,8 @@ class LitpLibVirtAdaptor(object):
         dom = self._get_domain()
         try:
             log('Defining libvirt domain {0}'.format(self.instance_name))
-            dom.create()
+            with Span('create'):
+                dom.create()
         except libvirtError as ex:
             log('Domain "{0}" could not be created'.format(self.instance_name),
                 echo=True)
@@ -158,15 +288,18 @@ class LitpLibVirtAdaptor(object):
             return LITP_LIBVIRT_FAILURE
         log('Waiting for domain {0} to start'.format(self.instance_name))
         startup_time = self.conf.get_adaptor_data().get("start-timeout", 45)
-        if not self.wait_on_state(self._is_started, startup_time):
+        with Span('wait_running'):
+            started = self.wait_on_state(self._is_started, startup_time)
+        if not started:
             log('Domain "{0}" failed to start'.format(self.instance_name))
             return LITP_LIBVIRT_FAILURE
         log('Domain {0} has been started successfully'.format(
             self.instance_name))
-        internal_status = self._internal_status()
-        while internal_status != INTERNAL_STATUS_OK:
-            self._sleep(LITP_LIBVIRT_STATUS_CHK_SLEEP)
+        with Span('wait_internal_status'):
             internal_status = self._internal_status()
+            while internal_status != INTERNAL_STATUS_OK:
+                self._sleep(LITP_LIBVIRT_STATUS_CHK_SLEEP)
+                internal_status = self._internal_status()
         return LITP_LIBVIRT_SUCCESS
 
     def start(self):
@@ -190,17 +323,20 @@ class LitpLibVirtAdaptor(object):
             echo_failure(msg_str)
         return result
 
+    @timed('check_requirements')
     def check_startup_requirements(self):
         """
         Container method to hold validation for startup
         """
         results = []
         results.extend(self._check_disk_images())
+        results.extend(self._check_hugepages())
 
         for result in results:
             log(result, level="ERROR", echo=True)
         return not bool(results)
 
+    @timed('acpi_shutdown')
     def _shutdown_domain(self):
         dom = self._get_domain()
         try:
@@ -240,10 +376,13 @@ class LitpLibVirtAdaptor(object):
         if not self.wait_for_shutdown(stop_timeout):
             log('ACPI shutdown of Domain "{0}" unsuccessful -'
                 ' calling force-stop'.format(self.instance_name))
+            metrics.inc('litp_libvirt_force_stop_fallbacks_total',
+                        {'instance': self.instance_name})
             return self._force_stop()
 
         return LITP_LIBVIRT_SUCCESS
 
+    @timed('wait_shutdown')
     def wait_for_shutdown(self, timeout):
         """
         Waits for the VM shutdown to complete. Checks every second.
@@ -298,6 +437,7 @@ class LitpLibVirtAdaptor(object):
         """
         time.sleep(secs)
 
+    @timed('force_stop')
     def _force_stop(self):
         log('Attempting to destroy Service "{0}"'.format(self.instance_name))
         if not self._is_defined():
@@ -311,22 +451,14 @@ class LitpLibVirtAdaptor(object):
             return LITP_LIBVIRT_SUCCESS
         dom = self._get_domain()
         log('Calling destroy on Domain "{0}"'.format(self.instance_name))
-        # TORF-481022: Retry mechanism in force stop to avoid
-        # race condition with Puppet
+        # TORF-481022: Puppet may be starting or stopping the domain at the
+        # same time, wait for its state to settle before destroying it
         try:
-            for retries in range(0, 3):
-                if not self._is_running():
-                    log('Retrying if domain {0} is not running.'
-                        '  Attempt {1} of 3.'
-                        .format(self.instance_name, retries))
-                    time.sleep(5)
-                    continue
-                else:
-                    break
-            if not self._is_running():
-                log('All retries attempts used, VM {0} is still down'
-                    .format(self.instance_name))
-                raise libvirtError('instance is not running')
+            state = self._wait_for_settled_state(dom)
+            if state == VIR_DOMAIN_SHUTOFF:
+                log('Domain "{0}" is shut off - nothing to '
+                    'destroy'.format(self.instance_name))
+                return LITP_LIBVIRT_SUCCESS
             dom.destroy()
         except libvirtError as ex:
             log('Force Shutdown failed on "{0}" due to "{1}"'.format( \
@@ -334,6 +466,36 @@ class LitpLibVirtAdaptor(object):
 
         return LITP_LIBVIRT_SUCCESS
 
+    def _get_force_stop_wait(self):
+        try:
+            return float(self.conf.get_adaptor_data().get(
+                'force-stop-wait', FORCE_STOP_WAIT))
+        except (LitpLibvirtException, KeyError, TypeError, ValueError):
+            return FORCE_STOP_WAIT
+
+    def _wait_for_settled_state(self, dom):
+        """
+        Polls the state of ``dom`` while it is starting or shutting down,
+        for at most the 'force-stop-wait' seconds of the adaptor_data.
+        Returns the last state seen.
+        """
+        deadline = time.time() + self._get_force_stop_wait()
+        state = dom.info()[0]
+        if state not in FORCE_STOP_TRANSITIONAL_STATES:
+            return state
+        log('Domain "{0}" is in state {1}, waiting for it to '
+            'settle'.format(self.instance_name, state))
+        metrics.inc('litp_libvirt_force_stop_retries_total',
+                    {'instance': self.instance_name})
+        while time.time() < deadline:
+            self._sleep(FORCE_STOP_POLL_INTERVAL)
+            state = dom.info()[0]
+            if state not in FORCE_STOP_TRANSITIONAL_STATES:
+                return state
+        log('Domain "{0}" did not settle in time, state is {1}'.format(
+            self.instance_name, state))
+        return state
+
     def force_stop(self):
         """
         Forcefully stops the domain (using libvirt.destroy)
@@ -341,7 +503,7 @@ class LitpLibVirtAdaptor(object):
         msg_str = 'Service force-stop for "{0}"'.format(
             self.instance_name)
         result = self._force_stop()
-        if '6' != self.base_os:
+        if self.platform.uses_systemd:
             self.systemd.stop_service()
         if result == LITP_LIBVIRT_SUCCESS:
             echo_success(msg_str)
@@ -355,7 +517,7 @@ class LitpLibVirtAdaptor(object):
         and starts it again normally.
         """
         # We use the high-level functions so we can report status
-        if '6' != self.base_os:
+        if self.platform.uses_systemd:
             return self.systemd.restart_service()
         else:
             self.stop()
@@ -367,16 +529,15 @@ class LitpLibVirtAdaptor(object):
         """
         # We use the high-level functions so we can report status
         self.force_stop()
-        if '6' != self.base_os:
+        if self.platform.uses_systemd:
             return self.systemd.start_service()
         else:
             return self.start()
 
     def _get_url(self, ipaddress):
         url = 'http://{0}:{1}'.format(ipaddress, LITP_LIBVIRT_STATUS_CHK_PORT)
-        log('Checking Domain "{0}" status from URL: "{1}"'.format(
-                self.instance_name, url),
-            level='DEBUG')
+        log('Checking Domain "{0}" status from URL: "{1}"',
+            self.instance_name, url, level='DEBUG')
         return url
 
     def _internal_status(self, log_success=True):
@@ -389,43 +550,54 @@ class LitpLibVirtAdaptor(object):
                         self.instance_name))
                 return INTERNAL_STATUS_OK
             url = self._get_url(chk['ip_address'])
-
-            try:
-                connection = urlopen(url)
-                connection.close()
-            except HTTPError as ex:
-                if ex.getcode() == INTERNAL_CHECK_FAIL_CODE:
-                    log('Domain "{0}" internal status check failed. A '
-                        'HTTPError occured with code "{1}". The HTTPError was '
-                        '"{2}"'.format(self.instance_name,
-                            INTERNAL_CHECK_FAIL_CODE, str(ex)))
-                    return INTERNAL_STATUS_NOK
-                else:
-                    log('Domain "{0}" internal status check failed. A unknown '
-                        'HTTPError occured. The HTTPError was "{1}"'.format(
-                            self.instance_name, str(ex)))
-                    return INTERNAL_STATUS_FAIL
-            except URLError as url_ex:
-                log('Domain "{0}" internal status check failed. A unknown '
-                    'URLError occured. The URLError was "{1}"'.format(
-                        self.instance_name, str(url_ex)))
-                return INTERNAL_STATUS_FAIL
-            else:
-                retcode = connection.getcode()
-                if retcode != 200:
-                    log('Domain "{0}" internal status check failed'.format(
-                            self.instance_name))
-                    log('Domain "{0}" internal status check failed. Return '
-                        'code was not "200", it was "{1}"'.format(
-                            self.instance_name, retcode),
-                        level='DEBUG')
-                    return INTERNAL_STATUS_NOK
+            start = time.time()
+            result = self._query_internal_status(url)
+            labels = {'instance': self.instance_name}
+            metrics.observe('litp_libvirt_internal_status_check_seconds',
+                            labels, time.time() - start)
+            labels['result'] = INTERNAL_STATUS_RESULTS[result]
+            metrics.inc('litp_libvirt_internal_status_checks_total', labels)
+            if result != INTERNAL_STATUS_OK:
+                return result
 
         if log_success:
             log('Domain "{0}" internal status check OK'.format(
                 self.instance_name))
         return INTERNAL_STATUS_OK
 
+    def _query_internal_status(self, url):
+        try:
+            connection = urlopen(url)
+            connection.close()
+        except urllib2.HTTPError as ex:
+            if ex.getcode() == INTERNAL_CHECK_FAIL_CODE:
+                log('Domain "{0}" internal status check failed. A '
+                    'HTTPError occured with code "{1}". The HTTPError was '
+                    '"{2}"'.format(self.instance_name,
+                        INTERNAL_CHECK_FAIL_CODE, str(ex)))
+                return INTERNAL_STATUS_NOK
+            else:
+                log('Domain "{0}" internal status check failed. A unknown '
+                    'HTTPError occured. The HTTPError was "{1}"'.format(
+                        self.instance_name, str(ex)))
+                return INTERNAL_STATUS_FAIL
+        except urllib2.URLError as url_ex:
+            log('Domain "{0}" internal status check failed. A unknown '
+                'URLError occured. The URLError was "{1}"'.format(
+                    self.instance_name, str(url_ex)))
+            return INTERNAL_STATUS_FAIL
+        else:
+            retcode = connection.getcode()
+            if retcode != 200:
+                log('Domain "{0}" internal status check failed'.format(
+                        self.instance_name))
+                log('Domain "{0}" internal status check failed. Return '
+                    'code was not "200", it was "{1}"'.format(
+                        self.instance_name, retcode),
+                    level='DEBUG')
+                return INTERNAL_STATUS_NOK
+        return INTERNAL_STATUS_OK
+
     def _status(self):
         if not self._is_defined():
             return LITP_LIBVIRT_FAILURE
@@ -459,13 +631,28 @@ class LitpLibVirtAdaptor(object):
             return False
         return True
 
+    @timed('check_disk_images')
     def _check_disk_images(self):
         """
-        If the machine is not defined, check that the base image exists.
-        If the machine is defined, check that the instance image exists.
+        If the machine is not defined, check that the base image exists and
+        matches its checksum. If the machine is defined, check that the
+        instance image exists.
         """
         results = []
         image_name = self._get_image_name()
+        storage_pool = self._get_storage_pool()
+        if storage_pool:
+            volume = Libvirt_storage_volume(self.instance_name, image_name,
+                                            storage_pool)
+            if self._is_defined():
+                if not volume.exists():
+                    results.append('Instance volume for Domain "{0}" does '
+                                   'not exist in storage pool "{1}"'.format(
+                                       self.instance_name, storage_pool))
+            elif not volume.base_volume_exists():
+                results.append('Base image volume for Domain "{0}" does not '
+                               'exist'.format(self.instance_name))
+            return results
         img_mgr = Libvirt_vm_image(self.instance_name, image_name)
         if self._is_defined():
             if not img_mgr.live_image_exists():
@@ -475,8 +662,46 @@ class LitpLibVirtAdaptor(object):
             if not img_mgr.base_image_exists():
                 results.append('Base image for Domain "{0}" does not '
                         'exist'.format(self.instance_name))
+            else:
+                reason = Libvirt_image_registry().verify(image_name)
+                if reason is not None:
+                    results.append('Base image "{0}" for Domain "{1}" cannot '
+                                   'be used, {2}'.format(image_name,
+                                        self.instance_name, reason))
         return results
 
+    @timed('check_hugepages')
+    def _check_hugepages(self):
+        """
+        If the memory of the domain is backed by hugepages, check that the
+        host has enough of them free before the domain is started.
+        """
+        results = []
+        try:
+            requirement = Libvirt_vm_xml.get_hugepages_requirement(
+                self.instance_name, self.conf.get_vm_data())
+        except KeyError as ex:
+            return ['Hugepages for Domain "{0}" cannot be checked, "{1}" is '
+                    'missing from vm_data'.format(self.instance_name,
+                                                  ex.args[0])]
+        except LitpLibvirtException as ex:
+            return [str(ex)]
+        if requirement is None or self._is_running():
+            return results
+        page_kib, required = requirement
+        free = Libvirt_host_facts.get_free_hugepages(page_kib)
+        if free is None:
+            results.append('Hugepages of {0}KiB required by Domain "{1}" are '
+                           'not supported by the host'.format(
+                               page_kib, self.instance_name))
+        elif free < required:
+            results.append('Domain "{0}" requires {1} hugepages of {2}KiB, '
+                           'only {3} are free'.format(self.instance_name,
+                                                      required, page_kib,
+                                                      free))
+        return results
+
+    @timed('check_config')
     def _check_config_changed(self):
         """
         Check if config exists and copy it to the live files if it doesn't.
@@ -493,6 +718,17 @@ class LitpLibVirtAdaptor(object):
                 self._force_stop_undefine()
         else:
             if not self.conf.conf_same():
+                if self._is_definition_unchanged():
+                    log('Config change does not affect the XML definition '
+                        'for Domain "{0}", skipping redefinition'.format(
+                            self.instance_name))
+                    metrics.inc('litp_libvirt_config_changes_total',
+                                {'instance': self.instance_name,
+                                 'redefined': 'false'})
+                    return success
+                metrics.inc('litp_libvirt_config_changes_total',
+                            {'instance': self.instance_name,
+                             'redefined': 'true'})
                 self._stop()
                 self._undefine()
                 try:
@@ -501,11 +737,14 @@ class LitpLibVirtAdaptor(object):
                     success = False
         return success
 
+    @timed('undefine')
     def _undefine(self):
         if self._is_defined():
             log('Attempting to undefine the domain "{0}"'.format(
                 self.instance_name))
             dom = self._get_domain()
+            volumes = Libvirt_storage_volume.from_domain_xml(
+                self.instance_name, self.conf.get_domain_xml())
             _stderr = sys.stderr
             _stdout = sys.stdout
             null = open(os.devnull, 'wb')
@@ -513,6 +752,12 @@ class LitpLibVirtAdaptor(object):
             dom.undefine()
             sys.stderr = _stderr
             sys.stdout = _stdout
+            if volumes and self._is_running():
+                log('Domain "{0}" is still running, keeping its '
+                    'volumes'.format(self.instance_name), level='ERROR')
+            else:
+                for volume in volumes:
+                    volume.delete()
         return LITP_LIBVIRT_SUCCESS
 
     def _force_stop_undefine(self):
@@ -537,7 +782,7 @@ class LitpLibVirtAdaptor(object):
             self.instance_name)
 
         result = self._force_stop_undefine()
-        if '6' != self.base_os:
+        if self.platform.uses_systemd:
             self.systemd.stop_service(verbose=False)
         if result == LITP_LIBVIRT_SUCCESS:
             echo_success(msg_str)
@@ -552,7 +797,7 @@ class LitpLibVirtAdaptor(object):
         msg_str = 'Service stop-undefine for "{0}"'.format(
             self.instance_name)
         result = self._stop(stop_timeout=stop_timeout)
-        if '6' != self.base_os:
+        if self.platform.uses_systemd:
             self.systemd.stop_service(verbose=False)
         self._undefine()
         try:
@@ -564,6 +809,7 @@ class LitpLibVirtAdaptor(object):
             echo_success(msg_str)
         else:
             echo_failure(msg_str)
+        return result
 
 
 class ActionValidator(object):
@@ -646,11 +892,7 @@ def _main():
     args = parser.parse_args(sys.argv[1:3])
 
     instance_name = args.instance_name
-    fn = '/etc/redhat-release'
-    with open(fn, 'r') as f:
-        redhat_release = f.readlines()
-    base_os = redhat_release[0].split('release')[1].split('.')[0].strip(' ')
-    adaptor = LitpLibVirtAdaptor(instance_name, base_os)
+    adaptor = LitpLibVirtAdaptor(instance_name)
     validator = ActionValidator(adaptor)
 
     method, kwargs = validator.get_adaptor_method(args.action, sys.argv[3:])
@@ -659,7 +901,20 @@ def _main():
             adaptor.conf.conf_file), level='ERROR', echo=True)
         sys.exit(LITP_LIBVIRT_UNKNOWN_CMD)
 
-    retcode = method(**kwargs)
+    action = args.action.lower()
+    timer = ActionTimer(instance_name, action)
+    try:
+        with timer:
+            retcode = method(**kwargs)
+            timer.result = retcode
+    finally:
+        # status is polled by the service manager, writing its metrics,
+        # including those of its internal status check, would rewrite the
+        # metrics files every few seconds
+        if action != 'status':
+            metrics.record_action(instance_name, action, timer.result,
+                                  timer.duration)
+            metrics.flush()
     sys.exit(retcode)
 
 
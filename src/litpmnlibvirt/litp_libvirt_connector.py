@@ -9,17 +9,126 @@
 ##############################################################################
 
 import functools
+import os
+import sys
+import time
 import libvirt
 
-
 URI = "qemu:///system"
+# Overrides the default URI, e.g. "fake:///" to run against a driver
+# registered with ``register_driver``
+URI_ENV = 'LITP_LIBVIRT_URI'
+# When set, every libvirt call is recorded by the tracer, see get_tracer
+TRACE_ENV = 'LITP_LIBVIRT_TRACE'
+# Connection methods returning domains, which are traced as well
+DOMAIN_METHODS = ('createXML', 'defineXML', 'listAllDomains', 'lookupByID',
+                  'lookupByName', 'lookupByUUIDString')
+
+_drivers = {}
+_tracer = []
+
+
+def register_driver(scheme, opener):
+    """
+    Opens the URIs of ``scheme`` with ``opener(uri)`` instead of libvirt,
+    used to run the adaptor against an in-memory hypervisor.
+    """
+    _drivers[scheme] = opener
+
+
+class LibvirtTracer(object):
+    """
+    Records the method, latency and caller of libvirt calls made through a
+    TracingProxy.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def reset(self):
+        del self.calls[:]
+
+    def record(self, method, seconds, caller):
+        self.calls.append((method, seconds, caller))
+
+    def count(self, method=None):
+        return len([c for c in self.calls if method in (None, c[0])])
+
+    def summary(self):
+        """
+        Returns the number and total duration of the calls, per method and
+        per caller.
+        """
+        methods = {}
+        callers = {}
+        for method, seconds, caller in self.calls:
+            stats = methods.setdefault(method, {'calls': 0, 'ms': 0.0})
+            stats['calls'] += 1
+            stats['ms'] += seconds * 1000
+            key = '{0} {1}'.format(method, caller)
+            callers[key] = callers.get(key, 0) + 1
+        for stats in methods.values():
+            stats['ms'] = round(stats['ms'], 1)
+        return {'calls': len(self.calls),
+                'ms': round(sum(c[1] for c in self.calls) * 1000, 1),
+                'methods': methods,
+                'callers': callers}
+
+
+class TracingProxy(object):
+    """
+    Wraps a libvirt connection or domain, recording each method call with
+    ``tracer``. Domains returned by the connection are wrapped too.
+    """
+
+    def __init__(self, target, tracer, prefix=''):
+        self._target = target
+        self._tracer = tracer
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        method = self._prefix + name
+        tracer = self._tracer
+
+        def traced(*args, **kwargs):
+            frame = sys._getframe(1)
+            caller = '{0}:{1}:{2}'.format(
+                os.path.basename(frame.f_code.co_filename),
+                frame.f_code.co_name, frame.f_lineno)
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            finally:
+                tracer.record(method, time.time() - start, caller)
+            if name in DOMAIN_METHODS:
+                if isinstance(result, list):
+                    return [TracingProxy(dom, tracer, 'dom.')
+                            for dom in result]
+                return TracingProxy(result, tracer, 'dom.')
+            return result
+        return traced
+
+
+def get_tracer():
+    """
+    Returns the tracer of the libvirt calls, or None unless tracing was
+    enabled with the LITP_LIBVIRT_TRACE environment variable.
+    """
+    if not _tracer and os.environ.get(TRACE_ENV):
+        _tracer.append(LibvirtTracer())
+    return _tracer[0] if _tracer else None
 
 
 def cache_connection(func):
     uri_to_handler = {}
 
     @functools.wraps(func)
-    def dec(uri=URI):
+    def dec(uri=None):
+        if uri is None:
+            uri = os.environ.get(URI_ENV, URI)
         if uri_to_handler.get(uri) is None:
             uri_to_handler[uri] = func(uri)
         return uri_to_handler[uri]
@@ -30,4 +139,9 @@ def cache_connection(func):
 
 @cache_connection
 def get_handle(uri=URI):
-    return libvirt.open(uri)
+    opener = _drivers.get(uri.split(':', 1)[0], libvirt.open)
+    conn = opener(uri)
+    tracer = get_tracer()
+    if tracer is not None:
+        return TracingProxy(conn, tracer)
+    return conn
@@ -0,0 +1,186 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import atexit
+import logging
+import os
+import threading
+import Queue
+
+LOGGER_NAME = 'litp_libvirt'
+LOGGING_CONF = '/etc/litp_libvirt_logging.conf'
+# Seconds to wait at exit for queued records to be written
+QUEUE_FLUSH_TIMEOUT = 5
+
+_configured = []
+
+
+class LazyMessage(object):
+    """
+    Log message formatted with ``str.format`` only when a handler writes it.
+    """
+    __slots__ = ('fmt', 'args')
+
+    def __init__(self, fmt, args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return str(self.fmt).format(*self.args)
+
+
+class LitpQueueHandler(logging.Handler):
+    """
+    Hands log records over to a background thread that writes them to the
+    wrapped ``handlers``, so that callers never wait on the log file.
+    """
+    _STOP = object()
+
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._queue = Queue.Queue()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._write_records,
+                                        name='litp_libvirt_log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_records(self):
+        while True:
+            record = self._queue.get()
+            if record is LitpQueueHandler._STOP:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def emit(self, record):
+        # The writer thread does not survive a fork, start a new one in the
+        # child
+        if self._pid != os.getpid():
+            self._lock.acquire()
+            try:
+                if self._pid != os.getpid():
+                    self._start()
+            finally:
+                self._lock.release()
+        self._queue.put(record)
+
+    def flush(self):
+        """
+        Writes all queued records and stops the writer thread, the next
+        record starts a new one.
+        """
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(LitpQueueHandler._STOP)
+        self._thread.join(QUEUE_FLUSH_TIMEOUT)
+        self._pid = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def after_fork(self):
+        """
+        Replaces the locks of the handler and of the wrapped handlers in a
+        forked child, where a lock held by another thread of the parent,
+        e.g. the writer thread, is never released. The next record starts
+        a new writer thread.
+        """
+        self.createLock()
+        self._lock = threading.Lock()
+        self._pid = None
+        for handler in self.handlers:
+            handler.createLock()
+
+    def close(self):
+        self.flush()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def configure_logging():
+    """
+    Reads the logging configuration on first use rather than at import, so
+    that commands which never log do not pay for it.
+    """
+    if _configured:
+        return
+    _configured.append(True)
+    if os.environ.get('TESTING_FLAG', None):
+        # Don't try reading logging conf for unit tests
+        return
+    import logging.config
+    logging.config.fileConfig(LOGGING_CONF)
+    install_queue_handler(logging.getLogger(LOGGER_NAME))
+
+
+def flush_logging():
+    """
+    Writes out the queued records of the litp_libvirt logger, for processes
+    which exit without running the atexit handlers.
+    """
+    for handler in logging.getLogger(LOGGER_NAME).handlers:
+        handler.flush()
+
+
+def reinit_logging_after_fork():
+    """
+    Makes the litp_libvirt logger usable in a forked child, whatever the
+    threads of the parent held at the time of the fork.
+    """
+    # Python 2 does not reset the module lock of logging on fork
+    logging._lock = threading.RLock()  # pylint: disable=W0212
+    for handler in logging.getLogger(LOGGER_NAME).handlers:
+        if isinstance(handler, LitpQueueHandler):
+            handler.after_fork()
+        else:
+            handler.createLock()
+
+
+def get_handler_fds():
+    """
+    Returns the file descriptors the handlers of the litp_libvirt logger
+    write to, which a detached process keeps open to go on logging.
+    """
+    handlers = []
+    for handler in logging.getLogger(LOGGER_NAME).handlers:
+        handlers.extend(getattr(handler, 'handlers', [handler]))
+    fds = []
+    for handler in handlers:
+        for attr in ('stream', 'socket'):
+            try:
+                fds.append(getattr(handler, attr).fileno())
+            except (AttributeError, ValueError, IOError):
+                pass
+    return fds
+
+
+def install_queue_handler(logger):
+    """
+    Moves the handlers of ``logger`` behind a LitpQueueHandler and makes
+    sure the queue is written out when the process exits.
+    """
+    handlers = logger.handlers[:]
+    if not handlers:
+        return None
+    queue_handler = LitpQueueHandler(handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    atexit.register(queue_handler.flush)
+    return queue_handler
@@ -0,0 +1,188 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import fcntl
+import json
+import os
+import tempfile
+
+from litpmnlibvirt.litp_libvirt_utils import log
+
+# Metrics are only written if the node_exporter textfile collector
+# directory exists
+METRICS_TEXTFILE_DIR = '/var/lib/node_exporter/textfile_collector'
+METRICS_TEXTFILE = 'litp_libvirt.prom'
+# Each adaptor call is a separate process, the metric values are kept
+# between calls in this file
+METRICS_STATE_FILE = '/var/lib/libvirt/litp_libvirt_metrics.json'
+
+ACTION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600)
+STATUS_CHECK_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'litp_libvirt_actions_total':
+        ('counter', 'Adaptor actions by instance, action and return code.',
+         None),
+    'litp_libvirt_action_duration_seconds':
+        ('histogram', 'Duration of adaptor actions.', ACTION_BUCKETS),
+    'litp_libvirt_force_stop_fallbacks_total':
+        ('counter', 'ACPI shutdowns that timed out and fell back to '
+         'force-stop.', None),
+    'litp_libvirt_force_stop_retries_total':
+        ('counter', 'Force-stops that waited for the domain state to '
+         'settle.', None),
+    'litp_libvirt_internal_status_checks_total':
+        ('counter', 'Internal status checks by result.', None),
+    'litp_libvirt_internal_status_check_seconds':
+        ('histogram', 'Latency of internal status checks.',
+         STATUS_CHECK_BUCKETS),
+    'litp_libvirt_config_changes_total':
+        ('counter', 'Config changes by whether the domain was redefined.',
+         None),
+}
+
+_pending = []
+
+
+def _label_str(labels):
+    return ','.join('{0}="{1}"'.format(
+        key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+        for key in sorted(labels))
+
+
+def inc(name, labels, amount=1):
+    """
+    Increments the counter ``name``, written out by ``flush``.
+    """
+    _pending.append((name, _label_str(labels), amount))
+
+
+def observe(name, labels, value):
+    """
+    Adds ``value`` to the histogram ``name``, written out by ``flush``.
+    """
+    _pending.append((name, _label_str(labels), value))
+
+
+def record_action(instance, action, retcode, duration):
+    """
+    Records the return code and duration of an adaptor action.
+    """
+    labels = {'instance': instance, 'action': action}
+    observe('litp_libvirt_action_duration_seconds', labels, duration)
+    labels['rc'] = retcode
+    inc('litp_libvirt_actions_total', labels)
+
+
+def _apply(state, name, labels, value):
+    metric_type, _, buckets = METRICS[name]
+    series = state.setdefault(name, {})
+    if metric_type == 'counter':
+        series[labels] = series.get(labels, 0) + value
+        return
+    hist = series.get(labels)
+    if hist is None or len(hist['buckets']) != len(buckets):
+        hist = series[labels] = {'buckets': [0] * len(buckets),
+                                 'sum': 0, 'count': 0}
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            hist['buckets'][i] += 1
+    hist['sum'] += value
+    hist['count'] += 1
+
+
+def _join_labels(labels, extra):
+    return '{' + ','.join(l for l in (labels, extra) if l) + '}'
+
+
+def render(state):
+    """
+    Returns ``state`` in the Prometheus text exposition format.
+    """
+    lines = []
+    for name in sorted(state):
+        if name not in METRICS:
+            continue
+        metric_type, help_text, buckets = METRICS[name]
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        for labels in sorted(state[name]):
+            value = state[name][labels]
+            if metric_type == 'counter':
+                lines.append('{0}{1} {2}'.format(
+                    name, _join_labels(labels, ''), value))
+                continue
+            for bound, count in zip(buckets, value['buckets']):
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _join_labels(labels, 'le="{0}"'.format(bound)),
+                    count))
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, _join_labels(labels, 'le="+Inf"'), value['count']))
+            lines.append('{0}_sum{1} {2}'.format(
+                name, _join_labels(labels, ''), value['sum']))
+            lines.append('{0}_count{1} {2}'.format(
+                name, _join_labels(labels, ''), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def _load_state():
+    try:
+        with open(METRICS_STATE_FILE, 'r') as state_file:
+            return json.load(state_file)
+    except IOError:
+        return {}
+    except ValueError as ex:
+        log('Discarding unreadable metrics state "{0}": {1}'.format(
+            METRICS_STATE_FILE, str(ex)), level='ERROR')
+        return {}
+
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.' + os.path.basename(path))
+    try:
+        os.write(fd, data)
+        os.fchmod(fd, 0644)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
+
+
+def flush():
+    """
+    Merges the pending updates into the metrics state and rewrites the
+    textfile. Concurrent adaptor calls are serialised with a lock file and
+    both files are replaced atomically, so node_exporter never reads a
+    partial file.
+    """
+    updates = _pending[:]
+    del _pending[:]
+    if not updates or not os.path.isdir(METRICS_TEXTFILE_DIR):
+        return
+    try:
+        lock_file = open(METRICS_STATE_FILE + '.lock', 'a')
+    except IOError as ex:
+        log('Unable to lock metrics state: {0}'.format(str(ex)),
+            level='ERROR')
+        return
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        state = _load_state()
+        for name, labels, value in updates:
+            _apply(state, name, labels, value)
+        _write_atomic(METRICS_STATE_FILE, json.dumps(state))
+        _write_atomic(os.path.join(METRICS_TEXTFILE_DIR, METRICS_TEXTFILE),
+                      render(state))
+    except (IOError, OSError) as ex:
+        log('Failed to write metrics: {0}'.format(str(ex)), level='ERROR')
+    finally:
+        lock_file.close()
@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from libvirt import (VIR_DOMAIN_SHUTOFF, VIR_CONNECT_LIST_DOMAINS_ACTIVE,
+                     libvirtError)
+
+from litpmnlibvirt.litp_libvirt_connector import get_handle
+import litpmnlibvirt
+from litpmnlibvirt.litp_libvirt_utils import (Libvirt_conf, Libvirt_systemd,
+                                              Libvirt_vm_image,
+                                              Libvirt_image_registry,
+                                              LitpLibvirtException,
+                                              LIBVIRT_CONFPATH,
+                                              SYSTEMCTL_PATH,
+                                              echo_success, echo_failure,
+                                              log)
+from litpmnlibvirt.litp_libvirt_adaptor import (ActionValidator,
+                                                LITP_LIBVIRT_SUCCESS,
+                                                LITP_LIBVIRT_FAILURE,
+                                                SECONDS_BEFORE_SHUTDOWN_RETRY)
+from litpmnlibvirt.litp_libvirt_platform import Platform
+from litpmnlibvirt.litp_libvirt_timing import ActionTimer, Span
+from litpmnlibvirt import litp_libvirt_metrics as metrics
+
+# Used when none of the domains has a stop-timeout configured
+DEFAULT_DRAIN_TIMEOUT = 300
+DRAIN_POLL_INTERVAL = 1
+NODE_INSTANCE = 'node'
+
+DEFAULT_START_CONCURRENCY = 2
+# New starts are held back while the "some" I/O pressure of the last 10
+# seconds is above this percentage and other starts are still running
+DEFAULT_MAX_IO_PRESSURE = 40.0
+IO_PRESSURE_PATH = '/proc/pressure/io'
+START_POLL_INTERVAL = 1
+# A start which has not finished after this many seconds is killed, its
+# domain stopped and reported as failed
+DEFAULT_START_TIMEOUT = 600
+ADAPTOR_MODULE = 'litpmnlibvirt.litp_libvirt_adaptor'
+
+
+class LitpLibvirtNode(object):
+    """
+    Actions on all the LITP managed domains of the node at once.
+    """
+
+    def __init__(self, platform=None):
+        self._platform = platform
+
+    @property
+    def platform(self):
+        if self._platform is None:
+            self._platform = Platform.get()
+        return self._platform
+
+    @staticmethod
+    def _is_managed(name):
+        return Libvirt_conf(name).conf_live_exists()
+
+    def _running_domains(self):
+        conn = get_handle()
+        return [dom for dom in
+                conn.listAllDomains(VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+                if self._is_managed(dom.name())]
+
+    @staticmethod
+    def _get_stop_timeout(name):
+        try:
+            return int(Libvirt_conf(name).get_adaptor_data().get(
+                'stop-timeout', 0))
+        except (LitpLibvirtException, KeyError, TypeError, ValueError):
+            return 0
+
+    def _get_drain_timeout(self, names):
+        """
+        The drain waits as long as the slowest domain is allowed to take
+        to stop on its own.
+        """
+        timeouts = [self._get_stop_timeout(name) for name in names]
+        return max(timeouts) or DEFAULT_DRAIN_TIMEOUT
+
+    @staticmethod
+    def _shutdown(dom):
+        try:
+            dom.shutdown()
+        except libvirtError as ex:
+            log('Shutdown failed on "{0}" due to "{1}"'.format(dom.name(),
+                                                              ex))
+
+    @staticmethod
+    def _is_stopped(dom):
+        try:
+            return dom.info()[0] == VIR_DOMAIN_SHUTOFF
+        except libvirtError:
+            # A domain that disappeared is no longer running either
+            return True
+
+    def _sleep(self, secs):
+        time.sleep(secs)
+
+    def _wait_for_shutdown(self, domains, deadline):
+        """
+        Waits for all ``domains`` to shut off until ``deadline``, resending
+        the ACPI shutdown to the remaining ones every
+        SECONDS_BEFORE_SHUTDOWN_RETRY seconds in case it was sent while
+        they were booting. Returns the domains still running.
+        """
+        remaining = list(domains)
+        last_sent = time.time()
+        while True:
+            remaining = [dom for dom in remaining
+                         if not self._is_stopped(dom)]
+            now = time.time()
+            if not remaining or now >= deadline:
+                return remaining
+            if now - last_sent >= SECONDS_BEFORE_SHUTDOWN_RETRY:
+                for dom in remaining:
+                    self._shutdown(dom)
+                last_sent = now
+            self._sleep(min(DRAIN_POLL_INTERVAL, deadline - now))
+
+    def drain(self, timeout=None):
+        """
+        Shuts down all running domains together: ACPI shutdown is sent to
+        all of them at once, they are waited for against a single deadline
+        and only the ones still running at the deadline are destroyed. The
+        services of the domains are then stopped.
+        """
+        domains = self._running_domains()
+        if not domains:
+            log('No running domains to drain', echo=True)
+            return LITP_LIBVIRT_SUCCESS
+        names = [dom.name() for dom in domains]
+        if not timeout:
+            timeout = self._get_drain_timeout(names)
+        log('Draining Domains {0}, waiting up to {1} seconds'.format(
+            ', '.join(names), timeout))
+
+        deadline = time.time() + timeout
+        with Span('acpi_shutdown'):
+            for dom in domains:
+                self._shutdown(dom)
+        with Span('wait_shutdown'):
+            stragglers = self._wait_for_shutdown(domains, deadline)
+
+        failed = set()
+        with Span('force_stop'):
+            for dom in stragglers:
+                log('ACPI shutdown of Domain "{0}" unsuccessful - '
+                    'destroying'.format(dom.name()))
+                metrics.inc('litp_libvirt_force_stop_fallbacks_total',
+                            {'instance': dom.name()})
+                try:
+                    dom.destroy()
+                except libvirtError as ex:
+                    log('Force Shutdown failed on "{0}" due to "{1}"'.format(
+                        dom.name(), ex), level='ERROR')
+                    failed.add(dom.name())
+
+        if self.platform.uses_systemd:
+            rcs = Libvirt_systemd.run_jobs('stop', names)
+            failed.update(name for name, rc in rcs.items() if rc != 0)
+
+        for name in names:
+            msg_str = 'Service drain for "{0}"'.format(name)
+            if name in failed:
+                echo_failure(msg_str)
+            else:
+                echo_success(msg_str)
+        if failed:
+            return LITP_LIBVIRT_FAILURE
+        return LITP_LIBVIRT_SUCCESS
+
+    @staticmethod
+    def _managed_instances():
+        try:
+            names = os.listdir(LIBVIRT_CONFPATH)
+        except OSError:
+            return []
+        return sorted(name for name in names
+                      if os.path.isfile(Libvirt_conf(name).conf_file))
+
+    @staticmethod
+    def _get_start_after(name):
+        try:
+            start_after = Libvirt_conf(name).get_adaptor_data().get(
+                'start-after', [])
+        except (LitpLibvirtException, KeyError):
+            return []
+        if isinstance(start_after, basestring):
+            return [start_after]
+        return list(start_after)
+
+    @staticmethod
+    def _get_io_pressure():
+        """
+        Returns the "some" avg10 I/O pressure of the host, 0 if the kernel
+        does not report pressure stall information.
+        """
+        try:
+            with open(IO_PRESSURE_PATH, 'r') as pressure_file:
+                for line in pressure_file:
+                    fields = line.split()
+                    if fields and fields[0] == 'some':
+                        for field in fields[1:]:
+                            key, _, value = field.partition('=')
+                            if key == 'avg10':
+                                return float(value)
+        except (IOError, ValueError):
+            pass
+        return 0.0
+
+    def _start_instance(self, name):
+        """
+        Starts ``name`` in a separate process which exits once the domain
+        has started and passed its internal status check.
+        """
+        if self.platform.uses_systemd:
+            cmd = [SYSTEMCTL_PATH, 'start', name]
+        else:
+            cmd = [sys.executable, '-m', ADAPTOR_MODULE, name, 'start']
+        env = dict(os.environ)
+        pythonpath = [os.path.dirname(os.path.dirname(
+            os.path.abspath(litpmnlibvirt.__file__)))]
+        if env.get('PYTHONPATH'):
+            pythonpath.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(pythonpath)
+        log('Starting Domain "{0}"'.format(name))
+        return subprocess.Popen(cmd, env=env, close_fds=True)
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            proc.kill()
+        except OSError:
+            # The process exited in the meantime
+            pass
+        proc.wait()
+
+    def _stop_instance(self, name):
+        """
+        Stops ``name`` after its start was killed, so that the domain does
+        not come up while it is reported as failed.
+        """
+        log('Stopping Domain "{0}"'.format(name))
+        if self.platform.uses_systemd:
+            # Replaces the start job of the unit, which outlives the killed
+            # systemctl client
+            Libvirt_systemd(name).stop_service(verbose=False)
+            return
+        try:
+            dom = get_handle().lookupByName(name)
+            if dom.isActive():
+                dom.destroy()
+        except libvirtError as ex:
+            log('Failed to stop Domain "{0}": {1}'.format(name, ex),
+                level='DEBUG')
+
+    def start_all(self, names=None, concurrency=DEFAULT_START_CONCURRENCY,
+                  max_io_pressure=DEFAULT_MAX_IO_PRESSURE,
+                  start_timeout=DEFAULT_START_TIMEOUT):
+        """
+        Starts the domains ``names``, all managed domains by default, in
+        the given order with at most ``concurrency`` starts in flight. A
+        domain is only started once the domains of its "start-after"
+        adaptor data have started, and new starts wait while the host I/O
+        pressure is above ``max_io_pressure``. A start which takes longer
+        than ``start_timeout`` seconds is killed, its domain stopped, and
+        fails.
+        """
+        if names is None:
+            names = self._managed_instances()
+        deps = dict((name, [dep for dep in self._get_start_after(name)
+                            if dep in names and dep != name])
+                    for name in names)
+        pending = list(names)
+        running = {}
+        started_at = {}
+        results = {}
+        throttled = False
+        while pending or running:
+            for name, proc in running.items():
+                retcode = proc.poll()
+                if (retcode is None and
+                        time.time() - started_at[name] > start_timeout):
+                    log('Start of Domain "{0}" did not finish within {1} '
+                        'seconds'.format(name, start_timeout), level='ERROR')
+                    self._kill(proc)
+                    self._stop_instance(name)
+                    retcode = LITP_LIBVIRT_FAILURE
+                if retcode is not None:
+                    del running[name]
+                    results[name] = retcode
+                    log('Start of Domain "{0}" finished with {1} after '
+                        '{2:.1f} seconds'.format(
+                            name, retcode, time.time() - started_at[name]))
+
+            for name in pending[:]:
+                failed_deps = [dep for dep in deps[name]
+                               if results.get(dep, 0) != 0]
+                if failed_deps:
+                    log('Not starting Domain "{0}", Domains {1} failed to '
+                        'start'.format(name, ', '.join(failed_deps)),
+                        level='ERROR')
+                    pending.remove(name)
+                    results[name] = LITP_LIBVIRT_FAILURE
+
+            while pending and len(running) < concurrency:
+                ready = [name for name in pending
+                         if all(results.get(dep) == 0 for dep in deps[name])]
+                if not ready:
+                    break
+                if running:
+                    pressure = self._get_io_pressure()
+                    if pressure > max_io_pressure:
+                        if not throttled:
+                            log('Holding back starts, I/O pressure is '
+                                '{0}%'.format(pressure))
+                        throttled = True
+                        break
+                throttled = False
+                name = ready[0]
+                pending.remove(name)
+                started_at[name] = time.time()
+                running[name] = self._start_instance(name)
+
+            if not running and pending:
+                log('Not starting Domains {0}, their start-after '
+                    'dependencies form a cycle'.format(', '.join(pending)),
+                    level='ERROR')
+                for name in pending:
+                    results[name] = LITP_LIBVIRT_FAILURE
+                pending = []
+            if running:
+                self._sleep(START_POLL_INTERVAL)
+
+        for name in names:
+            msg_str = 'Service start-all for "{0}"'.format(name)
+            if results[name] == 0:
+                echo_success(msg_str)
+            else:
+                echo_failure(msg_str)
+        if [name for name in names if results[name] != 0]:
+            return LITP_LIBVIRT_FAILURE
+        return LITP_LIBVIRT_SUCCESS
+
+    @staticmethod
+    def _get_image_name(name):
+        try:
+            return Libvirt_conf(name).get_vm_data().get('image')
+        except (LitpLibvirtException, KeyError):
+            return None
+
+    def prewarm(self, names=None):
+        """
+        Reads the base images which the domains ``names``, all managed
+        domains by default, are defined from into the page cache, so that
+        their starts do not wait on the disk to copy them. The images are
+        hashed on the way if they have no checksum recorded yet.
+        """
+        if names is None:
+            names = self._managed_instances()
+        images = []
+        for name in names:
+            image = self._get_image_name(name)
+            if not image or image in images:
+                continue
+            if Libvirt_vm_image(name, image).live_image_exists():
+                # The base image is only copied for a new instance
+                continue
+            images.append(image)
+        if not images:
+            log('No base images to pre-warm', echo=True)
+            return LITP_LIBVIRT_SUCCESS
+        failed = Libvirt_image_registry().prewarm(images)
+        for image in images:
+            msg_str = 'Service prewarm for image "{0}"'.format(image)
+            if image in failed:
+                echo_failure(msg_str)
+            else:
+                echo_success(msg_str)
+        if failed:
+            return LITP_LIBVIRT_FAILURE
+        return LITP_LIBVIRT_SUCCESS
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='litp_libvirt_node',
+        description='Actions on all LITP managed domains of the node.')
+    subparsers = parser.add_subparsers(dest='command')
+    drain = subparsers.add_parser(
+        'drain', help='Gracefully shut down all running domains at once.')
+    drain.add_argument(
+        '--timeout', help='Time in seconds to wait for all domains to shut '
+        'down before destroying the remaining ones. Defaults to the '
+        'largest stop-timeout of the domains.', default=None,
+        metavar='positive_integer', type=ActionValidator.positive_integer,
+        dest='timeout')
+    start_all = subparsers.add_parser(
+        'start-all', help='Start domains in order, a few at a time.')
+    start_all.add_argument(
+        'instances', nargs='*', metavar='instance_name',
+        help='Domains to start, in start order. Defaults to all managed '
+        'domains.')
+    start_all.add_argument(
+        '--concurrency', help='Maximum number of domains starting at the '
+        'same time.', default=DEFAULT_START_CONCURRENCY,
+        metavar='positive_integer', type=ActionValidator.positive_integer,
+        dest='concurrency')
+    start_all.add_argument(
+        '--max-io-pressure', help='Do not begin new starts while the host '
+        'I/O pressure (avg10 percent from {0}) is above this '
+        'value.'.format(IO_PRESSURE_PATH), default=DEFAULT_MAX_IO_PRESSURE,
+        metavar='percent', type=float, dest='max_io_pressure')
+    start_all.add_argument(
+        '--start-timeout', help='Time in seconds after which the start of '
+        'a domain is killed and reported as failed.',
+        default=DEFAULT_START_TIMEOUT, metavar='positive_integer',
+        type=ActionValidator.positive_integer, dest='start_timeout')
+    prewarm = subparsers.add_parser(
+        'prewarm', help='Read the base images of domains to be started '
+        'into the page cache.')
+    prewarm.add_argument(
+        'instances', nargs='*', metavar='instance_name',
+        help='Domains whose base images are read. Defaults to all managed '
+        'domains.')
+    return parser
+
+
+def _run_command(node, args):
+    if args.command == 'start-all':
+        return node.start_all(names=args.instances or None,
+                              concurrency=args.concurrency,
+                              max_io_pressure=args.max_io_pressure,
+                              start_timeout=args.start_timeout)
+    if args.command == 'prewarm':
+        return node.prewarm(names=args.instances or None)
+    return node.drain(timeout=args.timeout)
+
+
+def _main():
+    args = _get_parser().parse_args(sys.argv[1:])
+    node = LitpLibvirtNode()
+    with ActionTimer(NODE_INSTANCE, args.command) as timer:
+        retcode = _run_command(node, args)
+        timer.result = retcode
+    metrics.record_action(NODE_INSTANCE, args.command, retcode,
+                          timer.duration)
+    metrics.flush()
+    sys.exit(retcode)
+
+
+if __name__ == "__main__":    # pragma: no cover
+    _main()
@@ -0,0 +1,115 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import os
+import re
+
+OS_RELEASE_PATH = '/etc/os-release'
+REDHAT_RELEASE_PATH = '/etc/redhat-release'
+# Only present when the running init is systemd, see sd_booted(3)
+SYSTEMD_RUNTIME_DIR = '/run/systemd/system'
+# First release managing services with systemd
+SYSTEMD_OS_MAJOR = 7
+# Assumed if neither release file can be parsed, as the adaptor did before
+# the platform was detected
+DEFAULT_OS_MAJOR = '7'
+
+INIT_SYSTEMD = 'systemd'
+INIT_SYSV = 'sysv'
+
+
+class Platform(object):
+    """
+    Operating system facts the adaptor branches on, detected once per
+    process.
+    """
+    _cached = None
+
+    def __init__(self, os_major, init_system):
+        self.os_major = os_major
+        self.init_system = init_system
+
+    def __repr__(self):
+        return 'Platform(os_major={0!r}, init_system={1!r})'.format(
+            self.os_major, self.init_system)
+
+    @property
+    def uses_systemd(self):
+        """
+        True if VM services are managed by systemd units, rather than
+        started directly by the adaptor.
+        """
+        return self.init_system == INIT_SYSTEMD
+
+    @staticmethod
+    def from_base_os(base_os):
+        """
+        Returns the platform of the given OS major version, e.g. '6'.
+        """
+        os_major = str(base_os)
+        if os_major.isdigit() and int(os_major) < SYSTEMD_OS_MAJOR:
+            return Platform(os_major, INIT_SYSV)
+        return Platform(os_major, INIT_SYSTEMD)
+
+    @staticmethod
+    def _read_file(path):
+        try:
+            with open(path, 'r') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    @staticmethod
+    def _parse_os_release(content):
+        """
+        Returns the VERSION_ID major number from os-release ``content``.
+        """
+        for line in content.splitlines():
+            key, _, value = line.strip().partition('=')
+            if key == 'VERSION_ID':
+                return value.strip('"\'').split('.')[0] or None
+        return None
+
+    @staticmethod
+    def _parse_redhat_release(content):
+        """
+        Returns the major number from e.g. "Red Hat Enterprise Linux Server
+        release 6.10 (Santiago)".
+        """
+        match = re.search(r'release\s+(\d+)', content)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def detect():
+        """
+        Detects the platform without using the cache.
+        """
+        os_major = None
+        content = Platform._read_file(OS_RELEASE_PATH)
+        if content is not None:
+            os_major = Platform._parse_os_release(content)
+        if os_major is None:
+            content = Platform._read_file(REDHAT_RELEASE_PATH)
+            if content is not None:
+                os_major = Platform._parse_redhat_release(content)
+        if os.path.isdir(SYSTEMD_RUNTIME_DIR):
+            return Platform(os_major or DEFAULT_OS_MAJOR, INIT_SYSTEMD)
+        if os_major is None:
+            return Platform(DEFAULT_OS_MAJOR, INIT_SYSV)
+        return Platform.from_base_os(os_major)
+
+    @staticmethod
+    def get():
+        """
+        Returns the platform of this host, detected on first use.
+        """
+        if Platform._cached is None:
+            Platform._cached = Platform.detect()
+        return Platform._cached
@@ -0,0 +1,155 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import functools
+import json
+import logging
+import os
+import socket
+import time
+
+from litpmnlibvirt.litp_libvirt_connector import get_tracer
+from litpmnlibvirt.litp_libvirt_logging import configure_logging
+
+# When set, every timing record is also appended to this file, one JSON
+# document per line
+TIMING_FILE_ENV = 'LITP_LIBVIRT_TIMING_FILE'
+
+logger = logging.getLogger("litp_libvirt")
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+class ActionTimer(object):
+    """
+    Collects the duration of the phases of one adaptor action and emits them
+    as a single JSON record when the action completes:
+
+        with ActionTimer('vm1', 'start') as timer:
+            timer.result = adaptor.start()
+
+    Phases are timed with ``Span`` or the ``timed`` decorator, nested phases
+    are named after their parents, e.g. "define.copy_image". If libvirt
+    calls are traced, their summary is added to the record.
+    """
+    _current = None
+
+    def __init__(self, instance_name, action):
+        self.instance_name = instance_name
+        self.action = action
+        self.result = None
+        self.phases = []
+        self._stack = []
+        self._start = None
+        self.duration = None
+
+    @staticmethod
+    def current():
+        return ActionTimer._current
+
+    def __enter__(self):
+        tracer = get_tracer()
+        if tracer is not None:
+            tracer.reset()
+        self._start = time.time()
+        ActionTimer._current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # pylint: disable=W0613
+        self.duration = time.time() - self._start
+        ActionTimer._current = None
+        if exc_type is not None and self.result is None:
+            self.result = exc_type.__name__
+        self.emit()
+        return False
+
+    def begin_phase(self, name):
+        self._stack.append(name)
+        phase = {'phase': '.'.join(self._stack),
+                 'start_ms': _ms(time.time() - self._start),
+                 'ms': None}
+        self.phases.append(phase)
+        return phase
+
+    def end_phase(self, phase):
+        phase['ms'] = round(_ms(time.time() - self._start) -
+                            phase['start_ms'], 1)
+        self._stack.pop()
+
+    def get_record(self):
+        record = {'host': socket.gethostname(),
+                  'instance': self.instance_name,
+                  'action': self.action,
+                  'result': self.result,
+                  'timestamp': self._start,
+                  'ms': _ms(self.duration),
+                  'phases': self.phases}
+        tracer = get_tracer()
+        if tracer is not None:
+            record['libvirt'] = tracer.summary()
+        return record
+
+    def emit(self):
+        """
+        Writes the timing record to the log and, if configured, to the
+        timing file.
+        """
+        record = json.dumps(self.get_record(), sort_keys=True, default=str)
+        configure_logging()
+        logger.info('Action timing: ' + record)
+        path = os.environ.get(TIMING_FILE_ENV)
+        if not path:
+            return
+        try:
+            with open(path, 'a') as timing_file:
+                timing_file.write(record + '\n')
+        except IOError as ex:
+            logger.error('Failed to write timing record to "{0}": '
+                         '{1}'.format(path, str(ex)))
+
+
+class Span(object):
+    """
+    Times the enclosed block as a phase of the current ActionTimer, does
+    nothing outside of an action.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._timer = None
+        self._phase = None
+
+    def __enter__(self):
+        self._timer = ActionTimer.current()
+        if self._timer is not None:
+            self._phase = self._timer.begin_phase(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # pylint: disable=W0613
+        if self._timer is not None:
+            self._timer.end_phase(self._phase)
+        return False
+
+
+def timed(name):
+    """
+    Decorator timing each call of the function as the ``name`` phase.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
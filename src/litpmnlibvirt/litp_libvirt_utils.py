@@ -8,39 +8,135 @@
 # program(s) have been supplied.
 ##############################################################################
 
-import xml.etree.ElementTree as ET
 import json
 
 import itertools
-from lxml import etree
-
-import yaml
 import sys
 import os
-import logging.config
+import logging
 import subprocess
+import select
+import signal
+import errno
+import fcntl
 import shutil
 from hashlib import md5
 import datetime
+import time
 import tempfile
-import uuid
 import string
 import re
 
+import libvirt
+
 from litpmnlibvirt.litp_libvirt_connector import get_handle
+from litpmnlibvirt.litp_libvirt_logging import (LazyMessage,
+                                                configure_logging,
+                                                flush_logging,
+                                                get_handler_fds,
+                                                reinit_logging_after_fork)
+from litpmnlibvirt.litp_libvirt_timing import Span, timed
 
 LIBVIRT_CONFPATH = "/var/lib/libvirt/instances"
 LIBVIRT_CONFFILE = "config.json"
 LIBVIRT_BASE_IMGPATH = "/var/lib/libvirt/images"
 LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY = 'last_undefined_vm'
+# Below LIBVIRT_CONFPATH, so that files are moved to it with a rename
+LIBVIRT_TRASH_DIRECTORY = '.trash'
+LIBVIRT_TRASH_LOCK_FILE = '.lock'
+BACKUP_INDEX_FILE = 'index.json'
+# Below LIBVIRT_CONFPATH, serialises changes to the backup indexes, which
+# evictions make across instances
+BACKUP_LOCK_FILE = '.backup.lock'
+BACKUP_GENERATION_FORMAT = '%Y%m%d%H%M%S'
+# Retention of the backups of undefined instances, overridden in adaptor_data
+# by 'backup-generations', 'backup-max-size', 'backup-host-max-size' and
+# 'backup-min-free-percent'. Sizes are bytes or e.g. "20G", None is unlimited.
+BACKUP_GENERATIONS = 1
+BACKUP_MAX_SIZE = None
+BACKUP_HOST_MAX_SIZE = None
+# Older backups are evicted while less than this share of the filesystem
+# is free, None never evicts for free space
+BACKUP_MIN_FREE_PERCENT = None
+LIBVIRT_DOMAIN_XML_FILE = 'domain.xml.live'
+LIBVIRT_BASE_IMAGE_FILE = 'base_image.live'
+# Below LIBVIRT_BASE_IMGPATH
+IMAGE_REGISTRY_FILE = '.image_registry.json'
+IMAGE_REGISTRY_LOCK_SUFFIX = '.lock'
+# Held by the process hashing the images in the background
+IMAGE_REFRESH_LOCK_SUFFIX = '.refresh.lock'
+IMAGE_CHECKSUM_SUFFIX = '.md5'
+IMAGE_READ_BUFFER_SIZE = 4 * 1024 * 1024
+# ioctl sharing the data blocks of a file with another, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Errors of FICLONE between filesystems, or on filesystems, without reflinks
+REFLINK_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                              errno.ENOTTY, errno.ENOSYS)
+# Storage pools holding volumes as files, other pools hold raw volumes
+FILE_STORAGE_POOL_TYPES = ('dir', 'fs', 'netfs')
 LIBVIRT_CAPABILITIES_XPATH = '/capabilities/host/topology/cells/cell'
+LIBVIRT_MACHINES_XPATH = "/capabilities/guest/arch[@name='x86_64']/machine"
+LIBVIRT_HOST_FACTS_FILE = '/var/run/litp_libvirt_host_facts.json'
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+CPUINFO_PATH = '/proc/cpuinfo'
+DMI_ID_PATH = '/sys/class/dmi/id'
+KVM_DEVICE_PATH = '/dev/kvm'
+VIRT_WHAT_PATH = '/usr/sbin/virt-what'
+HUGEPAGES_FREE_PATH = '/sys/kernel/mm/hugepages/hugepages-{0}kB/free_hugepages'
+# DMI product names reported by the common hypervisors
+VIRTUAL_DMI_PRODUCTS = ('VMware', 'VirtualBox', 'KVM', 'Bochs', 'HVM domU',
+                        'Virtual Machine', 'OpenStack', 'RHEV Hypervisor',
+                        'Google Compute Engine', 'Standard PC')
+
+# Parts of the generated domain XML that libvirt drops or regenerates in the
+# inactive definition, ignored when comparing definitions
+DOMAIN_XML_IGNORED_TAGS = ('alias', 'reboot')
+DOMAIN_XML_IGNORED_CHILDREN = {'serial': ('source',), 'console': ('source',)}
+DOMAIN_XML_IGNORED_ATTRS = {'console': ('tty',), 'graphics': ('port',),
+                            'memory': ('unit',)}
+MEMORY_UNITS_KIB = {'KiB': 1, 'MiB': 1024, 'GiB': 1024 * 1024}
+# Size suffixes accepted in config.json and the matching libvirt units
+SIZE_UNITS = {'G': 'GiB', 'M': 'MiB', 'K': 'KiB'}
+
+DEFAULT_MACHINE_TYPE = 'rhel6.6.0'
+DEFAULT_VIDEO_MODEL = 'cirrus'
+INPUT_BUSES = ('usb', 'virtio')
+DISK_IO_MODES = ('native', 'threads')
+DISK_DISCARD_MODES = ('unmap', 'ignore')
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported when one of its attributes
+    is first used, keeping the heavy imports off the paths that never need
+    them.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            __import__(self._name)
+            self.__dict__['_module'] = sys.modules[self._name]
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+ET = LazyModule('xml.etree.ElementTree')
+etree = LazyModule('lxml.etree')
+yaml = LazyModule('yaml')
+difflib = LazyModule('difflib')
+uuid = LazyModule('uuid')
 
-if not os.environ.get('TESTING_FLAG', None):  # pragma: no cover
-    logging.config.fileConfig('/etc/litp_libvirt_logging.conf')
-else:
-    # Don't try reading logging conf for unit tests
-    pass
 logger = logging.getLogger("litp_libvirt")
+LOG_LEVELS = {'INFO': logging.INFO,
+              'DEBUG': logging.DEBUG,
+              'ERROR': logging.ERROR}
 
 ANSI_MOVE_CURSOR = '\033[60G'
 ANSI_FAILURE_COLOR = '\033[1;31m'
@@ -48,19 +144,129 @@ ANSI_SUCCESS_COLOR = '\033[1;32m'
 ANSI_NO_COLOR = '\033[0m'
 
 SYSTEMCTL_PATH = "/bin/systemctl"
+SYSTEMD_DBUS_NAME = 'org.freedesktop.systemd1'
+SYSTEMD_DBUS_PATH = '/org/freedesktop/systemd1'
+SYSTEMD_MANAGER_IFACE = 'org.freedesktop.systemd1.Manager'
+SYSTEMD_UNIT_IFACE = 'org.freedesktop.systemd1.Unit'
+SYSTEMD_JOB_IFACE = 'org.freedesktop.systemd1.Job'
+DBUS_PROPERTIES_IFACE = 'org.freedesktop.DBus.Properties'
+
+GENISOIMAGE_PATH = 'genisoimage'
+LSBLK_PATH = '/bin/lsblk'
+# Seconds an external command may run before its process group is killed
+GENISOIMAGE_TIMEOUT = 300
+LSBLK_TIMEOUT = 30
+VIRT_WHAT_TIMEOUT = 30
+SYSTEMCTL_TIMEOUT = 30
+# Seconds to wait for systemd unit jobs, their JobRemoved signal is
+# checked for every poll interval in case it was missed
+SYSTEMD_JOB_TIMEOUT = 900
+SYSTEMD_JOB_POLL_INTERVAL = 5
+# Seconds between checks for exit once a command has closed its output
+EXEC_POLL_INTERVAL = 0.05
+EXEC_READ_SIZE = 65536
 
 
 class LitpLibvirtException(Exception):
     pass
 
 
-def exec_cmd(cmd):
-    p = subprocess.Popen(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True)
-    out, err = p.communicate()
-    return (p.returncode, out.strip(), err.strip())
+class LitpLibvirtCmdTimeout(LitpLibvirtException):
+    pass
+
+
+def _cmd_str(cmd):
+    if isinstance(cmd, basestring):
+        return cmd
+    return ' '.join(cmd)
+
+
+def _kill_process_group(p):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError as ex:
+        if ex.errno != errno.ESRCH:
+            raise
+    p.wait()
+
+
+def _log_lines(cmd_name, pending, data, final=False):
+    """
+    Logs the complete lines of ``pending`` + ``data`` and returns the
+    trailing partial line.
+    """
+    lines = (pending + data).split('\n')
+    pending = '' if final else lines.pop()
+    for line in lines:
+        if line:
+            log('{0}: {1}', cmd_name, line, level='DEBUG')
+    return pending
+
+
+def exec_cmd(cmd, timeout=None, stream=False):
+    """
+    Runs ``cmd`` and returns a tuple of its return code, stdout and stderr.
+    ``cmd`` is an argument list executed without a shell, a string is still
+    run through the shell. The command runs in its own process group which
+    is killed, raising LitpLibvirtCmdTimeout, if it has not finished after
+    ``timeout`` seconds. With ``stream`` the output is logged line by line
+    as it is read. A command which does not exist returns 127, as it does
+    through the shell.
+    """
+    cmd_name = _cmd_str(cmd)
+    start = time.time()
+    deadline = start + timeout if timeout else None
+    try:
+        p = subprocess.Popen(cmd,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             shell=isinstance(cmd, basestring),
+                             close_fds=True,
+                             preexec_fn=os.setsid)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+        log('Command "{0}" not found', cmd_name, level='DEBUG')
+        return (127, '', str(ex))
+    output = {p.stdout: [], p.stderr: []}
+    pending = {p.stdout: '', p.stderr: ''}
+    pipes = [p.stdout, p.stderr]
+    try:
+        while pipes or p.poll() is None:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    _kill_process_group(p)
+                    raise LitpLibvirtCmdTimeout('Command "{0}" timed out '
+                        'after {1} seconds'.format(cmd_name, timeout))
+            if not pipes:
+                time.sleep(min(wait, EXEC_POLL_INTERVAL) if wait
+                           else EXEC_POLL_INTERVAL)
+                continue
+            try:
+                ready = select.select(pipes, [], [], wait)[0]
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            for pipe in ready:
+                data = os.read(pipe.fileno(), EXEC_READ_SIZE)
+                if not data:
+                    pipes.remove(pipe)
+                    if stream:
+                        _log_lines(cmd_name, pending[pipe], '', final=True)
+                    continue
+                output[pipe].append(data)
+                if stream:
+                    pending[pipe] = _log_lines(cmd_name, pending[pipe], data)
+    finally:
+        p.stdout.close()
+        p.stderr.close()
+    log('Command "{0}" returned {1} in {2:.3f}s', cmd_name, p.returncode,
+        time.time() - start, level='DEBUG')
+    return (p.returncode, ''.join(output[p.stdout]).strip(),
+            ''.join(output[p.stderr]).strip())
 
 
 def echo_success(msg='', state='OK'):
@@ -99,28 +305,66 @@ def echo_failure(msg='', state='FAILED'):
         print log_msg
 
 
-def log(message, level='INFO', echo=False):
+def log(message, *args, **kwargs):
     """
-    Print and log the supplied message
+    Print and log the supplied message. When ``args`` are given ``message``
+    is a format string, formatted only if the message is actually written.
+    Accepts the ``level`` ('INFO', 'DEBUG' or 'ERROR') and ``echo`` keyword
+    arguments.
     """
-    prefix = ''
-    #seperator = ' - '
-    #if instance_name is not None:
-    #    prefix = prefix + str(instance_name) + seperator
+    level = kwargs.get('level', 'INFO')
+    echo = kwargs.get('echo', False)
+    configure_logging()
+    if not echo and \
+            not logger.isEnabledFor(LOG_LEVELS.get(level, logging.ERROR)):
+        return
+    if args:
+        message = LazyMessage(message, args)
 
     if echo:
         print str(message)
 
     if level == 'INFO':
-        logger.info(str(prefix) + str(message))
+        logger.info(message if args else str(message))
     elif level == 'DEBUG':
-        logger.debug(str(prefix) + str(message))
+        logger.debug(message if args else str(message))
     elif level == 'ERROR':
-        logger.error(str(prefix) + str(message))
+        logger.error(message if args else str(message))
     else:
         msg = "Invalid logging level:" + str(level) + " message: " \
                       + str(message)
-        logger.error(str(prefix) + str(msg))
+        logger.error(msg)
+
+
+# JSON config files read by the process, by path: (stat key, contents)
+_conf_cache = {}
+
+
+def _get_stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+def load_conf_file(path):
+    """
+    Returns the deserialized JSON file ``path``. The result is shared by the
+    whole process until the file changes on disk, it must not be modified.
+    A file which cannot be stat'ed is read every time.
+    """
+    key = _get_stat_key(path)
+    cached = _conf_cache.get(path)
+    if key is not None and cached is not None and cached[0] == key:
+        return cached[1]
+    with open(path, 'r') as conf_file:
+        data = json.load(conf_file)
+    if key is not None:
+        _conf_cache[path] = (key, data)
+    else:
+        _conf_cache.pop(path, None)
+    return data
 
 
 def load_file_containing_yaml(path):
@@ -141,9 +385,23 @@ def load_file_containing_yaml(path):
 
 
 class Libvirt_capabilities(object):
+    # Parsed capabilities XML of the hypervisor, fetched once per process
+    _root = None
+
     def __init__(self):
         super(Libvirt_capabilities, self).__init__()
 
+    @staticmethod
+    def get_root():
+        if Libvirt_capabilities._root is None:
+            Libvirt_capabilities._root = etree.fromstring(
+                get_handle().getCapabilities())
+        return Libvirt_capabilities._root
+
+    @staticmethod
+    def clear():
+        Libvirt_capabilities._root = None
+
     @staticmethod
     def __compress_list(number_list):
         def group(int_list):
@@ -160,9 +418,7 @@ class Libvirt_capabilities(object):
 
     @staticmethod
     def get_cpu_capabilities():
-        conn = get_handle()
-        caps = conn.getCapabilities()
-        root = etree.fromstring(caps)
+        root = Libvirt_capabilities.get_root()
 
         mappings = {}
         for cell in root.xpath(LIBVIRT_CAPABILITIES_XPATH):
@@ -177,6 +433,270 @@ class Libvirt_capabilities(object):
 
         return mappings
 
+    @staticmethod
+    def get_machine_type(machine_type):
+        """
+        Resolves ``machine_type`` against the x86_64 machine types supported
+        by the hypervisor. Aliases such as "q35" or "pc" resolve to the
+        newest versioned machine type they stand for.
+        """
+        root = Libvirt_capabilities.get_root()
+        machines = []
+        for machine in root.xpath(LIBVIRT_MACHINES_XPATH):
+            if machine.text == machine_type:
+                return machine.get('canonical', machine.text)
+            machines.append(machine.text)
+        raise LitpLibvirtException('Machine type "{0}" is not supported, '
+                                   'supported types: {1}'.format(
+                                       machine_type,
+                                       ', '.join(sorted(set(machines)))))
+
+
+class Libvirt_host_facts(object):
+    """
+    Virtualization facts of the host (bare-metal vs virtual, CPU model,
+    KVM availability). Facts are detected once per boot using cheap
+    checks on ``/proc`` and ``/sys`` and cached in
+    ``LIBVIRT_HOST_FACTS_FILE``, keyed by the kernel boot id.
+    """
+    _cached = None
+
+    def __init__(self, facts):
+        self.facts = facts
+
+    @property
+    def is_bare_metal(self):
+        return self.facts.get('is_bare_metal', False)
+
+    @property
+    def cpu_model(self):
+        return self.facts.get('cpu_model')
+
+    @property
+    def kvm_available(self):
+        return self.facts.get('kvm_available', False)
+
+    @staticmethod
+    def _read_file(path):
+        try:
+            with open(path, 'r') as fd:
+                return fd.read()
+        except (IOError, OSError):
+            return None
+
+    @staticmethod
+    def _get_boot_id():
+        boot_id = Libvirt_host_facts._read_file(BOOT_ID_PATH)
+        return boot_id.strip() if boot_id else None
+
+    @staticmethod
+    def _parse_cpuinfo(cpuinfo):
+        """
+        Returns a tuple of the CPU model name and whether the
+        ``hypervisor`` CPU flag is set, from the first processor entry.
+        """
+        model = None
+        flags = []
+        for line in cpuinfo.splitlines():
+            if ':' not in line:
+                continue
+            key, value = [i.strip() for i in line.split(':', 1)]
+            if key == 'model name' and model is None:
+                model = value
+            elif key == 'flags' and not flags:
+                flags = value.split()
+        return model, 'hypervisor' in flags
+
+    @staticmethod
+    def _is_virtual_dmi():
+        product = Libvirt_host_facts._read_file(
+            os.path.join(DMI_ID_PATH, 'product_name'))
+        if not product:
+            return False
+        return any(p in product for p in VIRTUAL_DMI_PRODUCTS)
+
+    @staticmethod
+    def detect():
+        """
+        Detects the host facts without using the cache.
+        """
+        cpuinfo = Libvirt_host_facts._read_file(CPUINFO_PATH)
+        if cpuinfo is not None:
+            cpu_model, hypervisor = Libvirt_host_facts._parse_cpuinfo(
+                cpuinfo)
+            is_bare_metal = not (hypervisor or
+                                 Libvirt_host_facts._is_virtual_dmi())
+        else:
+            log('Unable to read {0}, falling back to {1}'.format(
+                CPUINFO_PATH, VIRT_WHAT_PATH), level='DEBUG')
+            cpu_model = None
+            is_bare_metal = exec_cmd([VIRT_WHAT_PATH],
+                                     timeout=VIRT_WHAT_TIMEOUT)[1] == ''
+        return {'is_bare_metal': is_bare_metal,
+                'cpu_model': cpu_model,
+                'kvm_available': os.path.exists(KVM_DEVICE_PATH)}
+
+    @staticmethod
+    def _load_cache(boot_id):
+        content = Libvirt_host_facts._read_file(LIBVIRT_HOST_FACTS_FILE)
+        if not content:
+            return None
+        try:
+            cache = json.loads(content)
+        except ValueError:
+            return None
+        if cache.get('boot_id') != boot_id:
+            return None
+        return cache.get('facts')
+
+    @staticmethod
+    def _save_cache(boot_id, facts):
+        tmp_file = LIBVIRT_HOST_FACTS_FILE + '.tmp'
+        try:
+            with open(tmp_file, 'w') as fd:
+                json.dump({'boot_id': boot_id, 'facts': facts}, fd)
+            os.rename(tmp_file, LIBVIRT_HOST_FACTS_FILE)
+        except (IOError, OSError) as ex:
+            log('Unable to cache host facts in "{0}": {1}'.format(
+                LIBVIRT_HOST_FACTS_FILE, str(ex)), level='DEBUG')
+
+    @staticmethod
+    def get_free_hugepages(page_kib):
+        """
+        Returns the number of free hugepages of ``page_kib`` KiB on the host,
+        or None if the page size is not supported. The value is not cached.
+        """
+        free = Libvirt_host_facts._read_file(
+            HUGEPAGES_FREE_PATH.format(page_kib))
+        if free is None:
+            return None
+        return int(free.strip())
+
+    @staticmethod
+    def get():
+        """
+        Returns the host facts, detecting them only if they are not
+        cached for the current boot.
+        """
+        if Libvirt_host_facts._cached is None:
+            boot_id = Libvirt_host_facts._get_boot_id()
+            facts = None
+            if boot_id:
+                facts = Libvirt_host_facts._load_cache(boot_id)
+            if facts is None:
+                facts = Libvirt_host_facts.detect()
+                log('Detected host facts: {0}'.format(facts), level='DEBUG')
+                if boot_id:
+                    Libvirt_host_facts._save_cache(boot_id, facts)
+            Libvirt_host_facts._cached = Libvirt_host_facts(facts)
+        return Libvirt_host_facts._cached
+
+
+class Libvirt_trash(object):
+    """
+    Files which are no longer needed are renamed into the trash and deleted
+    by a background process, so that actions do not wait on deleting
+    multi-GB images.
+    """
+
+    @staticmethod
+    def get_path():
+        return os.path.join(LIBVIRT_CONFPATH, LIBVIRT_TRASH_DIRECTORY)
+
+    @staticmethod
+    def move(paths, prefix):
+        """
+        Renames ``paths`` into a new directory of the trash and returns it.
+        """
+        trash = Libvirt_trash.get_path()
+        try:
+            os.mkdir(trash)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        target = tempfile.mkdtemp(prefix=prefix + '-', dir=trash)
+        for path in paths:
+            os.rename(path, os.path.join(target, os.path.basename(path)))
+        return target
+
+    @staticmethod
+    def reap():
+        """
+        Deletes everything in the trash, unless another process is already
+        doing so.
+        """
+        trash = Libvirt_trash.get_path()
+        try:
+            lock_file = open(os.path.join(trash, LIBVIRT_TRASH_LOCK_FILE), 'a')
+        except IOError:
+            return
+        try:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            for entry in os.listdir(trash):
+                if entry != LIBVIRT_TRASH_LOCK_FILE:
+                    shutil.rmtree(os.path.join(trash, entry),
+                                  ignore_errors=True)
+        finally:
+            lock_file.close()
+
+    @staticmethod
+    def reap_in_background():
+        """
+        Empties the trash in a detached, low priority process. Whatever it
+        does not get to is deleted by the next reaper.
+        """
+        run_in_background(Libvirt_trash.reap, 'trash reaper')
+
+
+def _close_fds(keep):
+    """
+    Closes the file descriptors above stderr, except ``keep``.
+    """
+    low = 3
+    for fd in sorted(set(keep)):
+        if fd >= low:
+            os.closerange(low, fd)
+            low = fd + 1
+    os.closerange(low, subprocess.MAXFD)
+
+
+def run_in_background(func, description):
+    """
+    Runs ``func`` in a detached, low priority process, so that the caller
+    does not wait for it.
+    """
+    try:
+        pid = os.fork()
+    except OSError as ex:
+        log('Unable to start {0}: {1}'.format(description, str(ex)))
+        return
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        reinit_logging_after_fork()
+        os.setsid()
+        if os.fork():
+            return
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        # Don't hold the caller's libvirt and D-Bus connections or locks
+        # while the job runs
+        _close_fds(get_handler_fds())
+        os.nice(19)
+        func()
+    finally:
+        try:
+            # os._exit skips the atexit handler writing the queued records
+            flush_logging()
+        finally:
+            # Never return into the caller's code from a forked child
+            os._exit(0)
+
 
 class Libvirt_conf(object):
     def __init__(self, name):
@@ -194,11 +714,26 @@ class Libvirt_conf(object):
              '/'.join([LIBVIRT_CONFPATH, name, 'network-config.live']))
         )
 
+    @property
+    def conf(self):
+        return self._conf
+
+    @conf.setter
+    def conf(self, conf):
+        # A config set on the object is used instead of config.json
+        self._conf = conf
+        self._conf_loaded = False
+
     def read_conf_data(self):
+        """
+        Reads config.json through the config cache of the process, so that
+        it is only parsed again once it changes on disk.
+        """
+        if self._conf is not None and not self._conf_loaded:
+            return
         try:
-            if self.conf == None:
-                with open(self.conf_file, "r") as config_file:
-                    self.conf = json.load(config_file)
+            self._conf = load_conf_file(self.conf_file)
+            self._conf_loaded = True
         except (IOError, ValueError) as ex:
             raise LitpLibvirtException('Problem opening config '
                                        'for Domain "{0}": '
@@ -206,6 +741,7 @@ class Libvirt_conf(object):
                                                     str(ex)))
 
     def save_conf_data(self):
+        _conf_cache.pop(self.conf_file, None)
         try:
             json.dump(self.conf, open(self.conf_file, "w"))
         except IOError as ex:
@@ -228,8 +764,7 @@ class Libvirt_conf(object):
         means self.conf_live_exists() returns true
         """
         try:
-            with open(self._get_conf_data_path(True), "r") as conf_file:
-                return json.load(conf_file)
+            return load_conf_file(self._get_conf_data_path(True))
         except (IOError, ValueError) as ex:
             raise LitpLibvirtException(
                 'The file "{0}" for the domain "{1}" cannot be accessed: {2}'
@@ -250,6 +785,80 @@ class Libvirt_conf(object):
             return False
         return all(checksums)
 
+    def get_changed_config_files(self):
+        """
+        Returns the list of config files which differ from their .live copy.
+        All of them are reported if any of the files cannot be read.
+        """
+        changed = []
+        try:
+            for conf_file, live_file in self.config_files:
+                with open(conf_file) as cdp:
+                    checksum = md5(cdp.read()).hexdigest()
+                with open(live_file) as cdpl:
+                    live_checksum = md5(cdpl.read()).hexdigest()
+                if checksum != live_checksum:
+                    changed.append(conf_file)
+        except IOError:
+            return [i[0] for i in self.config_files]
+        return changed
+
+    def _get_domain_xml_path(self):
+        return os.path.join(self.instance_dir, LIBVIRT_DOMAIN_XML_FILE)
+
+    def get_domain_xml(self):
+        """
+        Returns the domain XML last passed to libvirt for this instance,
+        or None if it was not recorded.
+        """
+        try:
+            with open(self._get_domain_xml_path(), 'r') as xml_file:
+                return xml_file.read()
+        except IOError:
+            return None
+
+    def save_domain_xml(self, xml):
+        try:
+            with open(self._get_domain_xml_path(), 'w') as xml_file:
+                xml_file.write(xml)
+        except IOError as ex:
+            log('Problem recording the XML definition for Domain '
+                '"{0}": {1}'.format(self.name, str(ex)))
+
+    def _get_base_image_file_path(self):
+        return os.path.join(self.instance_dir, LIBVIRT_BASE_IMAGE_FILE)
+
+    @staticmethod
+    def get_base_image_identity(image):
+        """
+        Returns the size, modification time and inode of the base image
+        ``image``, or None if it cannot be read.
+        """
+        try:
+            st = os.stat(os.path.join(LIBVIRT_BASE_IMGPATH, image))
+        except (OSError, TypeError):
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'inode': st.st_ino}
+
+    def get_defined_base_image(self):
+        """
+        Returns the identity of the base image the instance was last defined
+        from, or None if it was not recorded.
+        """
+        try:
+            with open(self._get_base_image_file_path(), 'r') as image_file:
+                return json.load(image_file)
+        except (IOError, ValueError):
+            return None
+
+    def save_defined_base_image(self, image):
+        try:
+            with open(self._get_base_image_file_path(), 'w') as image_file:
+                json.dump(self.get_base_image_identity(image), image_file)
+        except IOError as ex:
+            log('Problem recording the base image for Domain '
+                '"{0}": {1}'.format(self.name, str(ex)))
+
     def conf_copy(self):
         try:
             for i in self.config_files:
@@ -271,19 +880,44 @@ class Libvirt_conf(object):
         self.read_conf_data()
         return self.conf["adaptor_data"]
 
+    @timed('cleanup_instance_dir')
     def cleanup_instance_dir(self):
         """
         Removes all files in VM instance directory, excluding
         ``LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY``, user-data, meta-data,
         network-config  and config.json.
+
+        The files are moved to the trash and deleted in the background, they
+        are only deleted here if they cannot be moved.
         """
-        for f in os.listdir(self.instance_dir):
-            if f in [LIBVIRT_CONFFILE, "user-data", "meta-data",
-                     "network-config", LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY]:
-                continue
-            fpath = os.path.join(self.instance_dir, f)
+        paths = [os.path.join(self.instance_dir, f)
+                 for f in os.listdir(self.instance_dir)
+                 if f not in [LIBVIRT_CONFFILE, "user-data", "meta-data",
+                              "network-config",
+                              LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY]]
+        self._discard_files(paths)
+
+    def _discard_files(self, paths):
+        """
+        Moves ``paths`` to the trash and reaps it in the background, or
+        deletes them if they cannot be moved.
+        """
+        if not paths:
+            return
+        try:
+            Libvirt_trash.move(paths, self.name)
+        except OSError as ex:
+            log('Failed to move files of "{0}" to the trash, deleting them: '
+                '{1}'.format(self.name, str(ex)))
+            self._remove_files(paths)
+        else:
+            Libvirt_trash.reap_in_background()
+
+    @staticmethod
+    def _remove_files(paths):
+        for fpath in paths:
             if os.path.isdir(fpath):
-                log('Removing directory "{0}".'.format(fpath), level="DEBUG")
+                log('Removing directory "{0}".', fpath, level="DEBUG")
                 try:
                     shutil.rmtree(fpath)
                 except OSError as ex:
@@ -292,9 +926,12 @@ class Libvirt_conf(object):
                     raise ex
             else:
                 try:
-                    log('Removing file "{0}".'.format(fpath), level="DEBUG")
+                    log('Removing file "{0}".', fpath, level="DEBUG")
                     os.unlink(fpath)
                 except OSError as ex:
+                    if ex.errno == errno.ENOENT:
+                        # Moved to the trash before the move failed
+                        continue
                     log('Failed to delete file "{0}": {1}.'.format(fpath,
                                                                     str(ex)))
                     raise ex
@@ -307,10 +944,166 @@ class Libvirt_conf(object):
             log('Error while storing virtual machine: {0}'.format(str(ex)))
             raise ex
 
+    def _get_backup_size_limit(self, adaptor_data, option, default):
+        value = adaptor_data.get(option, default)
+        if value is None or str(value).isdigit():
+            return None if value is None else int(value)
+        try:
+            return Libvirt_vm_xml._size_kib(self.name, option, value) * 1024
+        except LitpLibvirtException as ex:
+            log(str(ex), level='ERROR')
+            return default
+
+    def _get_backup_min_free_percent(self, adaptor_data):
+        """
+        Returns the 'backup-min-free-percent' option of ``adaptor_data``,
+        ``BACKUP_MIN_FREE_PERCENT`` if it is not set or is not a percentage.
+        """
+        value = adaptor_data.get('backup-min-free-percent')
+        if value is None:
+            return BACKUP_MIN_FREE_PERCENT
+        try:
+            percent = int(value)
+        except (TypeError, ValueError):
+            percent = -1
+        if not 0 <= percent <= 100:
+            log('Invalid backup-min-free-percent "{0}" for Domain "{1}"'
+                .format(value, self.name), level='ERROR')
+            return BACKUP_MIN_FREE_PERCENT
+        return percent
+
+    def get_backup_policy(self):
+        """
+        Returns the number of backup generations to keep, the maximum
+        size of the backups of this instance and of all instances and the
+        share of the filesystem to keep free.
+        """
+        try:
+            adaptor_data = self.get_adaptor_data()
+        except (KeyError, LitpLibvirtException):
+            adaptor_data = {}
+        try:
+            generations = max(1, int(adaptor_data.get('backup-generations',
+                                                      BACKUP_GENERATIONS)))
+        except (TypeError, ValueError):
+            generations = BACKUP_GENERATIONS
+        return (generations,
+                self._get_backup_size_limit(adaptor_data, 'backup-max-size',
+                                            BACKUP_MAX_SIZE),
+                self._get_backup_size_limit(adaptor_data,
+                                            'backup-host-max-size',
+                                            BACKUP_HOST_MAX_SIZE),
+                self._get_backup_min_free_percent(adaptor_data))
+
+    def _get_other_backup_indexes(self):
+        """
+        Returns the backup indexes of the other instances.
+        """
+        indexes = []
+        try:
+            names = os.listdir(LIBVIRT_CONFPATH)
+        except OSError:
+            return indexes
+        for name in sorted(names):
+            if name == self.name:
+                continue
+            backup_dir = os.path.join(LIBVIRT_CONFPATH, name,
+                                      LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY)
+            if os.path.isdir(backup_dir):
+                indexes.append(Libvirt_backup_index(backup_dir).load())
+        return indexes
+
+    def _get_free_space(self):
+        """
+        Returns the free and total bytes of the filesystem of the instance.
+        """
+        try:
+            st = os.statvfs(self.instance_dir)
+        except OSError:
+            return None, None
+        return st.f_bavail * st.f_frsize, st.f_blocks * st.f_frsize
+
+    def _evict_backups(self, index):
+        """
+        Removes the oldest generations of ``index`` beyond the retention
+        policy of this instance, then the oldest generations of all
+        instances while the backups of the host are too large or, when a
+        free space threshold is configured, its filesystem is short of
+        space. The generation just added to
+        ``index`` is always kept. Returns the (index, generation) pairs
+        removed.
+        """
+        generations, max_size, host_max_size, min_free_percent = \
+            self.get_backup_policy()
+        newest = index.generations[-1]
+        evicted = []
+        while len(index.generations) > 1:
+            if len(index.generations) > generations:
+                reason = 'more than {0} generations'.format(generations)
+            elif max_size is not None and index.total_size() > max_size:
+                reason = 'larger than {0} bytes'.format(max_size)
+            else:
+                break
+            evicted.append((index, index.generations.pop(0), reason))
+
+        free, total = None, None
+        if min_free_percent is not None:
+            free, total = self._get_free_space()
+
+        def short_of_space():
+            return total and free * 100 < total * min_free_percent
+
+        indexes = [index]
+        if host_max_size is not None or short_of_space():
+            indexes.extend(self._get_other_backup_indexes())
+        host_size = sum(i.total_size() for i in indexes)
+        candidates = sorted([(g['generation'], i, g) for i in indexes
+                             for g in i.generations if g is not newest],
+                            key=lambda c: c[0])
+        for _, backup_index, generation in candidates:
+            if host_max_size is not None and host_size > host_max_size:
+                reason = 'host backups larger than {0} bytes'.format(
+                    host_max_size)
+            elif short_of_space():
+                reason = 'less than {0}% free space'.format(min_free_percent)
+            else:
+                break
+            backup_index.generations.remove(generation)
+            evicted.append((backup_index, generation, reason))
+            host_size -= generation['size']
+            if free is not None:
+                free += generation['size']
+
+        for backup_index, generation, reason in evicted:
+            log('Evicting backup generation {0} of "{1}": {2}'.format(
+                generation['generation'], backup_index.get_instance_name(),
+                reason))
+        return [(i, g) for i, g, _ in evicted]
+
+    def _get_storage_pool(self):
+        """
+        Returns the storage pool holding the image of the defined domain,
+        or the one configured in adaptor_data, None if the image is a file.
+        """
+        volumes = Libvirt_storage_volume.from_domain_xml(
+            self.name, self.get_domain_xml())
+        if volumes:
+            return volumes[0].pool_name
+        try:
+            return Libvirt_storage_volume.get_pool_name(
+                self.get_adaptor_data())
+        except (KeyError, LitpLibvirtException):
+            return None
+
+    @timed('backup_instance_files')
     def move_files_to_last_undefined_vm_dir(self):
         """
-        Moves all 4 .live files and the qcow2 image to
-        empty ``LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY`` directory.
+        Moves all 4 .live files and the qcow2 image to a new generation of
+        the ``LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY`` directory and evicts
+        the generations beyond the retention policy to the trash.
+
+        An image kept as a storage pool volume is deleted with the domain,
+        its generation only holds the .live files and is never restored.
         """
         backup_dir = os.path.join(self.instance_dir,
             LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY)
@@ -322,87 +1115,505 @@ class Libvirt_conf(object):
                                        '{1}'.format(self.name,
                                                     str(ex)))
 
-        image_file = os.path.join(self.instance_dir, image)
-        if not os.path.exists(image_file):
-            log('No image found in "{0}" for {1}. Nothing to save.'.format(
-                self.instance_dir, self.name))
-            return
+        live_files = [i[1] for i in self.config_files]
+        storage_pool = self._get_storage_pool()
+        if storage_pool:
+            log('The image of Domain "{0}" is a volume of storage pool '
+                '"{1}" and is not backed up, it cannot be rolled '
+                'back'.format(self.name, storage_pool))
+            files = [f for f in live_files if os.path.exists(f)]
+            fingerprint = None
+            if not files:
+                log('No config files found in "{0}" for {1}. Nothing to '
+                    'save.'.format(self.instance_dir, self.name))
+                return
+        else:
+            image_file = os.path.join(self.instance_dir, image)
+            if not os.path.exists(image_file):
+                log('No image found in "{0}" for {1}. Nothing to '
+                    'save.'.format(self.instance_dir, self.name))
+                return
+            files = [image_file] + live_files
+            fingerprint = self.get_fingerprint(live=True)
 
         if not os.path.isdir(backup_dir):
             self._create_dir(backup_dir)
-        else:
-            log('Removing directory "{0}".'.format(backup_dir), level="DEBUG")
-            try:
-                shutil.rmtree(backup_dir)
-            except OSError as ex:
-                log('Failed to delete directory "{0}": {1}.'.format(
-                    backup_dir, str(ex)))
-                raise ex
-            else:
-                self._create_dir(backup_dir)
+        lock_file = Libvirt_backup_index.lock()
+        try:
+            self._backup_files(backup_dir, files, fingerprint)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
 
+    def _backup_files(self, backup_dir, files, fingerprint):
+        index = Libvirt_backup_index(backup_dir).load()
         current_time = datetime.datetime.now()
-        for fpath in [image_file] + [i[1] for i in self.config_files]:
+        generation = current_time.strftime(BACKUP_GENERATION_FORMAT)
+        moved = []
+        for fpath in files:
             fn = os.path.basename(fpath)
-            fn = "%s-%s" % (fn, current_time.strftime("%Y%m%d%H%M%S"))
+            fn = "%s-%s" % (fn, generation)
             tpath = os.path.join(backup_dir, fn)
             try:
-                log('Moving file "{0}" to {1}.'.format(
-                    fpath, backup_dir), level="DEBUG")
+                log('Moving file "{0}" to {1}.', fpath, backup_dir,
+                    level="DEBUG")
                 os.rename(fpath, tpath)
+                moved.append(fn)
             except OSError as ex:
                 log('Failed to move file "{0}": {1}.'.format(fpath, str(ex)))
+        if len(moved) != len(files):
+            # An incomplete generation is never restored
+            fingerprint = None
+        index.add(generation, moved, fingerprint)
+
+        evicted = self._evict_backups(index)
+        self._discard_files([os.path.join(i.backup_dir, fn)
+                             for i, gen in evicted for fn in gen['files']])
+        for backup_index in set([index] + [i for i, _ in evicted]):
+            backup_index.save()
+
+    def get_fingerprint(self, live=False):
+        """
+        Returns a digest of the config files, or of their .live copies, and
+        of the size and modification time of the base image they use, or
+        None if any of them cannot be read.
+        """
+        digest = md5()
+        try:
+            for conf_file, live_file in self.config_files:
+                with open(live_file if live else conf_file) as cdp:
+                    digest.update(md5(cdp.read()).hexdigest())
+            if live:
+                image = self.get_live_conf()['vm_data']['image']
+            else:
+                image = self.get_vm_data()['image']
+            st = os.stat(os.path.join(LIBVIRT_BASE_IMGPATH, image))
+        except (IOError, OSError, KeyError, TypeError,
+                LitpLibvirtException):
+            return None
+        digest.update('{0}:{1}'.format(st.st_size, int(st.st_mtime)))
+        return digest.hexdigest()
+
+    @timed('restore_instance_files')
+    def restore_last_undefined_vm(self):
+        """
+        Moves the image of the newest generation in
+        ``LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY`` which was backed up with the
+        same config files and base image back into the instance directory,
+        so that it does not need to be copied from the base image.
+        Returns True if the image was restored.
+        """
+        backup_dir = os.path.join(self.instance_dir,
+                                  LIBVIRT_LAST_UNDEFINED_VM_DIRECTORY)
+        if not os.path.isdir(backup_dir):
+            return False
+        fingerprint = self.get_fingerprint()
+        if fingerprint is None:
+            return False
+        image = self.get_vm_data()['image']
+        image_file = os.path.join(self.instance_dir, image)
+        if os.path.exists(image_file):
+            return False
+
+        lock_file = Libvirt_backup_index.lock()
+        try:
+            return self._restore_image(backup_dir, image, image_file,
+                                       fingerprint)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    def _restore_image(self, backup_dir, image, image_file, fingerprint):
+        index = Libvirt_backup_index(backup_dir).load()
+        matching = [g for g in index.generations
+                    if g.get('fingerprint') == fingerprint]
+        if not matching:
+            return False
+        generation = matching[-1]
+        backup_file = "%s-%s" % (image, generation['generation'])
+        try:
+            os.rename(os.path.join(backup_dir, backup_file), image_file)
+        except OSError as ex:
+            log('Failed to restore image "{0}" of "{1}": {2}'.format(
+                backup_file, self.name, str(ex)))
+            return False
+        log('Restored image of "{0}" from backup generation {1}'.format(
+            self.name, generation['generation']))
+
+        # The .live files are rewritten from the config files on start
+        index.generations.remove(generation)
+        self._discard_files([os.path.join(backup_dir, fn)
+                             for fn in generation['files']
+                             if fn != backup_file])
+        index.save()
+        return True
+
+
+class Libvirt_backup_index(object):
+    """
+    Generations of backed up files of an undefined instance, oldest first,
+    recorded in the index file of its backup directory. Each generation
+    holds the files suffixed with its timestamp, its size in bytes,
+    creation time and the fingerprint of the config files and base image it
+    was taken with, if known.
+    """
+    _suffix = re.compile(r'^(.+)-(\d{14})$')
+
+    def __init__(self, backup_dir):
+        self.backup_dir = backup_dir
+        self.path = os.path.join(backup_dir, BACKUP_INDEX_FILE)
+        self.generations = []
+
+    @staticmethod
+    def lock():
+        """
+        Takes the host-wide lock of the backup indexes, held until the
+        returned file is closed. Returns None if the lock file cannot be
+        opened.
+        """
+        try:
+            lock_file = open(os.path.join(LIBVIRT_CONFPATH, BACKUP_LOCK_FILE),
+                             'a')
+        except IOError as ex:
+            log('Unable to lock the backup indexes: {0}'.format(str(ex)),
+                level='DEBUG')
+            return None
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
+
+    def get_instance_name(self):
+        return os.path.basename(os.path.dirname(self.backup_dir))
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as index_file:
+                self.generations = json.load(index_file)['generations']
+        except (IOError, ValueError, KeyError, TypeError):
+            self.generations = self._scan()
+        return self
+
+    def _scan(self):
+        """
+        Rebuilds the generations from the backup directory, e.g. when it
+        was written by a version without an index.
+        """
+        by_generation = {}
+        try:
+            names = os.listdir(self.backup_dir)
+        except OSError:
+            return []
+        for name in sorted(names):
+            match = Libvirt_backup_index._suffix.match(name)
+            if match:
+                by_generation.setdefault(match.group(2), []).append(name)
+        generations = []
+        for generation in sorted(by_generation):
+            generations.append(self._new_generation(
+                generation, by_generation[generation], None))
+        return generations
+
+    def _new_generation(self, generation, files, fingerprint):
+        size = 0
+        for fn in files:
+            try:
+                size += os.path.getsize(os.path.join(self.backup_dir, fn))
+            except OSError:
+                pass
+        return {'generation': generation,
+                'created': time.time(),
+                'size': size,
+                'files': files,
+                'fingerprint': fingerprint}
+
+    def add(self, generation, files, fingerprint=None):
+        entry = self._new_generation(generation, files, fingerprint)
+        self.generations = [g for g in self.generations
+                            if g['generation'] != generation] + [entry]
+        return entry
+
+    def total_size(self):
+        return sum(g['size'] for g in self.generations)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as index_file:
+                json.dump({'generations': self.generations}, index_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as ex:
+            log('Unable to save backup index "{0}": {1}'.format(
+                self.path, str(ex)))
+
+
+class Libvirt_systemd_bus(object):
+    """
+    Persistent connection to the systemd manager on the D-Bus system bus.
+    Unit jobs are queued with StartUnit/StopUnit/RestartUnit and their
+    completion is tracked with the JobRemoved signal, so many jobs can be
+    queued at once and waited for together.
+    """
+    _instance = None
+    _unavailable = False
+
+    def __init__(self):
+        import dbus
+        from dbus.mainloop.glib import DBusGMainLoop
+        try:
+            from gi.repository import GLib as glib
+        except ImportError:
+            import gobject as glib
+        self._dbus = dbus
+        self._glib = glib
+        self.error = dbus.exceptions.DBusException
+        self._context = glib.MainContext.default()
+        self._bus = dbus.SystemBus(mainloop=DBusGMainLoop())
+        self._manager = dbus.Interface(
+            self._bus.get_object(SYSTEMD_DBUS_NAME, SYSTEMD_DBUS_PATH),
+            SYSTEMD_MANAGER_IFACE)
+        self._jobs = set()
+        self._results = {}
+        self._bus.add_signal_receiver(self._job_removed,
+                                      signal_name='JobRemoved',
+                                      dbus_interface=SYSTEMD_MANAGER_IFACE,
+                                      bus_name=SYSTEMD_DBUS_NAME,
+                                      path=SYSTEMD_DBUS_PATH)
+        self._manager.Subscribe()
+
+    @staticmethod
+    def get():
+        """
+        Returns the shared connection, or None if D-Bus cannot be used, in
+        which case callers fall back to systemctl.
+        """
+        if Libvirt_systemd_bus._instance is None and \
+                not Libvirt_systemd_bus._unavailable:
+            try:
+                Libvirt_systemd_bus._instance = Libvirt_systemd_bus()
+            except Exception as ex:
+                log('systemd D-Bus API not available, using {0}: '
+                    '{1}'.format(SYSTEMCTL_PATH, str(ex)), level='DEBUG')
+                Libvirt_systemd_bus._unavailable = True
+        return Libvirt_systemd_bus._instance
+
+    def _job_removed(self, job_id, job_path, unit, result):
+        # pylint: disable=W0613
+        if str(job_path) in self._jobs:
+            self._results[str(job_path)] = str(result)
+
+    def queue_job(self, method, unit):
+        """
+        Queues a ``method`` (StartUnit, StopUnit, RestartUnit) job for
+        ``unit`` and returns the job path without waiting for it.
+        """
+        job = str(getattr(self._manager, method)(unit, 'replace'))
+        self._jobs.add(job)
+        return job
+
+    def _job_exists(self, job):
+        try:
+            properties = self._dbus.Interface(
+                self._bus.get_object(SYSTEMD_DBUS_NAME, job),
+                DBUS_PROPERTIES_IFACE)
+            properties.Get(SYSTEMD_JOB_IFACE, 'State')
+        except self.error:
+            return False
+        return True
+
+    def _dispatch_pending(self):
+        while self._context.pending():
+            self._context.iteration(False)
+
+    def wait_for_jobs(self, jobs, timeout=None):
+        """
+        Waits for the JobRemoved signals of ``jobs`` and returns the
+        result of each job ("done", "failed", ...), "missed" for the jobs
+        which are gone without a signal and "timeout" for the jobs still
+        running after ``timeout`` seconds, ``SYSTEMD_JOB_TIMEOUT`` if not
+        given.
+        """
+        deadline = time.time() + (timeout or SYSTEMD_JOB_TIMEOUT)
+        pending = set(jobs)
+        results = {}
+        woken = []
+        scheduled = False
+        while True:
+            for job in [j for j in pending if j in self._results]:
+                results[job] = self._results.pop(job)
+                pending.remove(job)
+            now = time.time()
+            if not pending or now >= deadline:
+                break
+            if woken:
+                missed = [j for j in pending if not self._job_exists(j)]
+                self._dispatch_pending()
+                for job in missed:
+                    if job not in self._results:
+                        log('JobRemoved signal of systemd job "{0}" was '
+                            'missed'.format(job), level='DEBUG')
+                        results[job] = 'missed'
+                        pending.remove(job)
+                del woken[:]
+                scheduled = False
+                continue
+            if not scheduled:
+                # Wakes the blocking iteration up to poll the jobs
+                self._glib.timeout_add(
+                    int(min(SYSTEMD_JOB_POLL_INTERVAL, deadline - now) * 1000),
+                    lambda: woken.append(True))
+                scheduled = True
+            self._context.iteration(True)
+        for job in jobs:
+            self._jobs.discard(job)
+            self._results.pop(job, None)
+            results.setdefault(job, 'timeout')
+        return results
+
+    def get_active_state(self, unit):
+        """
+        Returns the ActiveState of ``unit``, "unknown" if it does not exist.
+        """
+        unit_path = self._manager.LoadUnit(unit)
+        properties = self._dbus.Interface(
+            self._bus.get_object(SYSTEMD_DBUS_NAME, unit_path),
+            DBUS_PROPERTIES_IFACE)
+        if properties.Get(SYSTEMD_UNIT_IFACE, 'LoadState') == 'not-found':
+            return 'unknown'
+        return str(properties.Get(SYSTEMD_UNIT_IFACE, 'ActiveState'))
 
 
 class Libvirt_systemd(object):
 
+    JOB_METHODS = {'start': 'StartUnit',
+                   'stop': 'StopUnit',
+                   'restart': 'RestartUnit'}
+    # ActiveState of a unit after its start, stop or restart job is done
+    JOB_DONE_STATES = {'start': ('active',),
+                       'stop': ('inactive', 'failed', 'unknown'),
+                       'restart': ('active',)}
+
     def __init__(self, name):
         self.name = name
 
+    @staticmethod
+    def _unit_name(name):
+        return name if name.endswith('.service') else name + '.service'
+
     def is_service_inactive(self):
-        _, out, _ = exec_cmd("{0} is-active {1}".format(SYSTEMCTL_PATH,
-                                                         self.name))
-        log('Service "{0}" is in state {1}'.format(self.name, out.strip()))
-        return out.strip() == 'unknown' or out.strip() == 'activating'
+        state = None
+        bus = Libvirt_systemd_bus.get()
+        if bus is not None:
+            try:
+                state = bus.get_active_state(self._unit_name(self.name))
+            except bus.error as ex:
+                log('Failed to get the state of service "{0}" from systemd: '
+                    '{1}'.format(self.name, str(ex)), level='DEBUG')
+        if state is None:
+            try:
+                _, out, _ = exec_cmd([SYSTEMCTL_PATH, 'is-active', self.name],
+                                     timeout=SYSTEMCTL_TIMEOUT)
+            except LitpLibvirtCmdTimeout as ex:
+                log(str(ex))
+                out = ''
+            state = out.strip()
+        log('Service "{0}" is in state {1}'.format(self.name, state))
+        return state == 'unknown' or state == 'activating'
 
-    def stop_service(self, verbose=True):
-        log('Attempting to stop service "{0}" with systemctl'.format(
-            self.name))
-        rc, _, _ = exec_cmd("{0} stop {1}".format(SYSTEMCTL_PATH,
-                                                  self.name))
+    @staticmethod
+    def _run_systemctl(action, names, timeout=None):
+        """
+        Runs ``systemctl action`` for each service in ``names``, a service
+        whose job has not finished after ``timeout`` seconds, or
+        ``SYSTEMD_JOB_TIMEOUT``, fails.
+        """
+        rcs = {}
+        for name in names:
+            try:
+                rcs[name], _, _ = exec_cmd([SYSTEMCTL_PATH, action, name],
+                                           timeout=timeout or
+                                           SYSTEMD_JOB_TIMEOUT)
+            except LitpLibvirtCmdTimeout as ex:
+                log(str(ex))
+                rcs[name] = 1
+        return rcs
+
+    @staticmethod
+    def run_jobs(action, names, timeout=None):
+        """
+        Runs the ``action`` (start, stop, restart) job for all services in
+        ``names`` at once and returns a dict of their return codes.
+        """
+        bus = Libvirt_systemd_bus.get()
+        if bus is None:
+            return Libvirt_systemd._run_systemctl(action, names, timeout)
+        jobs = {}
+        try:
+            for name in names:
+                jobs[bus.queue_job(Libvirt_systemd.JOB_METHODS[action],
+                                   Libvirt_systemd._unit_name(name))] = name
+        except bus.error as ex:
+            log('Failed to queue service {0} jobs with systemd, using '
+                '{1}: {2}'.format(action, SYSTEMCTL_PATH, str(ex)))
+            queued = jobs.values()
+            rcs = Libvirt_systemd._run_systemctl(
+                action, [name for name in names if name not in queued],
+                timeout)
+            if jobs:
+                rcs.update(Libvirt_systemd._collect_jobs(bus, jobs, action,
+                                                         timeout))
+            return rcs
+        return Libvirt_systemd._collect_jobs(bus, jobs, action, timeout)
+
+    @staticmethod
+    def _get_missed_result(bus, action, name):
+        """
+        Returns the result of the ``action`` job of ``name`` from the state
+        its unit was left in.
+        """
+        try:
+            state = bus.get_active_state(Libvirt_systemd._unit_name(name))
+        except bus.error as ex:
+            log('Failed to get the state of service "{0}" from systemd: '
+                '{1}'.format(name, str(ex)), level='DEBUG')
+            return 'failed'
+        if state in Libvirt_systemd.JOB_DONE_STATES[action]:
+            return 'done'
+        return 'failed'
+
+    @staticmethod
+    def _collect_jobs(bus, jobs, action, timeout):
+        results = bus.wait_for_jobs(jobs.keys(), timeout)
+        rcs = {}
+        for job, name in jobs.items():
+            result = results[job]
+            if result == 'missed':
+                result = Libvirt_systemd._get_missed_result(bus, action, name)
+            if result != 'done':
+                log('Service {0} job for "{1}" finished with result '
+                    '"{2}"'.format(action, name, result))
+            rcs[name] = 0 if result == 'done' else 1
+        return rcs
+
+    def _run_job(self, action, verbose):
+        log('Attempting to {0} service "{1}" with systemd'.format(action,
+                                                                 self.name))
+        with Span('systemd_' + action):
+            rc = Libvirt_systemd.run_jobs(action, [self.name])[self.name]
         if verbose:
-            msg_str = 'Service stop for "{0}"'.format(self.name)
+            msg_str = 'Service {0} for "{1}"'.format(action, self.name)
             if rc == 0:
                 echo_success(msg_str)
             else:
                 echo_failure(msg_str)
         return rc
 
+    def stop_service(self, verbose=True):
+        return self._run_job('stop', verbose)
+
     def start_service(self, verbose=True):
-        log('Attempting to start service "{0}" with systemctl'.format(
-            self.name))
-        rc, _, _ = exec_cmd("{0} start {1}".format(SYSTEMCTL_PATH,
-                                                   self.name))
-        if verbose:
-            msg_str = 'Service start for "{0}"'.format(self.name)
-            if rc == 0:
-                echo_success(msg_str)
-            else:
-                echo_failure(msg_str)
-        return rc
+        return self._run_job('start', verbose)
 
     def restart_service(self, verbose=True):
-        log('Attempting to restart service "{0}" with systemctl'.format(
-            self.name))
-        rc, _, _ = exec_cmd("{0} restart {1}".format(SYSTEMCTL_PATH,
-                                                   self.name))
-        if verbose:
-            msg_str = 'Service restart for "{0}"'.format(self.name)
-            if rc == 0:
-                echo_success(msg_str)
-            else:
-                echo_failure(msg_str)
-        return rc
+        return self._run_job('restart', verbose)
 
 
 class Libvirt_cloud_init(object):
@@ -417,7 +1628,8 @@ class Libvirt_cloud_init(object):
         updated_disk_mounts = []
         for bd_path, mount_point in disk_mounts:
             try:
-                _, bd_uuid, _ = exec_cmd("/bin/lsblk -nf -o UUID %s" % bd_path)
+                _, bd_uuid, _ = exec_cmd([LSBLK_PATH, '-nf', '-o', 'UUID',
+                                          bd_path], timeout=LSBLK_TIMEOUT)
             except Exception as ex:
                 raise LitpLibvirtException('Problem executing lsblk: '
                                        '{0}'.format(str(ex)))
@@ -456,26 +1668,26 @@ class Libvirt_cloud_init(object):
                                        '{0}'.format(str(ex)))
         return path_to_userdata
 
+    @timed('cloud_init_iso')
     def create_cloud_init_iso(self):
         userdata_path = self._userdata_path
         if self._adaptor_data.get('disk_mounts'):
             userdata_path = self._get_updated_userdata_path()
 
+        cmd = [GENISOIMAGE_PATH, '-output', self._iso, '-volid', 'cidata',
+               '-joliet', '-rock', userdata_path,
+               os.path.join(self._location, 'meta-data')]
         networkconfig_path = os.path.join(self._location, 'network-config')
-        if not os.path.isfile(networkconfig_path):
-            networkconfig_path = ''
-
-        cmd = ("genisoimage -output {0}/cloud_init.iso -volid cidata -joliet"
-               " -rock {1} {0}/meta-data {2}"
-                  .format(self._location, userdata_path, networkconfig_path))
+        if os.path.isfile(networkconfig_path):
+            cmd.append(networkconfig_path)
 
         try:
-            exec_cmd(cmd)
+            exec_cmd(cmd, timeout=GENISOIMAGE_TIMEOUT, stream=True)
         except Exception as ex:
             raise LitpLibvirtException('Problem executing genisoimage: '
                                        '{0}'.format(str(ex)))
         finally:
-            if userdata_path.startswith(tempfile.gettempdir()):
+            if userdata_path != self._userdata_path:
                 try:
                     shutil.rmtree(os.path.dirname(userdata_path))
                 except OSError as ex:
@@ -484,6 +1696,9 @@ class Libvirt_cloud_init(object):
 
 
 class Libvirt_vm_image(object):
+    # (base image device, instance directory device) pairs without reflinks
+    _no_reflink = set()
+
     def __init__(self, name, image_name):
         self.name = name
         self.inst_loc = os.path.join(LIBVIRT_CONFPATH, name)
@@ -496,8 +1711,52 @@ class Libvirt_vm_image(object):
     def get_live_img_path(self):
         return os.path.join(self.inst_loc, self.image_name)
 
+    @timed('copy_image')
     def copy_image(self):
-        shutil.copy(self.get_base_img_path(), self.get_live_img_path())
+        """
+        Clones the base image into the instance directory, which shares
+        the data blocks of the images until either is written on
+        filesystems with reflinks such as XFS and Btrfs, and copies it
+        otherwise.
+        """
+        src = self.get_base_img_path()
+        dst = self.get_live_img_path()
+        if not self._clone(src, dst):
+            shutil.copy(src, dst)
+
+    @staticmethod
+    def _clone(src, dst):
+        """
+        Returns True if ``src`` was cloned to ``dst`` with FICLONE.
+        """
+        try:
+            src_file = open(src, 'rb')
+        except IOError:
+            return False
+        with src_file:
+            try:
+                devices = (os.fstat(src_file.fileno()).st_dev,
+                           os.stat(os.path.dirname(dst)).st_dev)
+            except OSError:
+                return False
+            if devices in Libvirt_vm_image._no_reflink:
+                return False
+            try:
+                with open(dst, 'wb') as dst_file:
+                    fcntl.ioctl(dst_file.fileno(), FICLONE,
+                                src_file.fileno())
+            except IOError as ex:
+                if ex.errno in REFLINK_UNSUPPORTED_ERRNOS:
+                    Libvirt_vm_image._no_reflink.add(devices)
+                log('Unable to clone image "{0}", copying it: {1}', src, ex,
+                    level='DEBUG')
+                try:
+                    os.remove(dst)
+                except OSError:
+                    pass
+                return False
+        shutil.copymode(src, dst)
+        return True
 
     def base_image_exists(self):
         image = self.get_base_img_path()
@@ -507,21 +1766,422 @@ class Libvirt_vm_image(object):
         return os.path.isfile(self.get_live_img_path())
 
 
+class Libvirt_image_registry(object):
+    """
+    Size, modification time and md5 of the base images, kept in
+    ``IMAGE_REGISTRY_FILE`` of ``LIBVIRT_BASE_IMGPATH`` so that an image is
+    only hashed once. An image is checked against the md5 of its
+    ``IMAGE_CHECKSUM_SUFFIX`` file, when there is one, to catch images that
+    were only partially transferred.
+    """
+
+    def __init__(self, image_path=None):
+        self.image_path = image_path or LIBVIRT_BASE_IMGPATH
+        self.path = os.path.join(self.image_path, IMAGE_REGISTRY_FILE)
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as registry_file:
+                records = json.load(registry_file)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(records, dict):
+            return {}
+        return records
+
+    def _update(self, image_name, record):
+        """
+        Stores ``record`` of ``image_name``, holding a lock so that the
+        records of other processes are not lost.
+        """
+        try:
+            with open(self.path + IMAGE_REGISTRY_LOCK_SUFFIX, 'a') as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                records = self.load()
+                records[image_name] = record
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as registry_file:
+                    json.dump(records, registry_file)
+                os.rename(tmp_path, self.path)
+        except (IOError, OSError) as ex:
+            log('Unable to update image registry "{0}": {1}'.format(
+                self.path, str(ex)))
+
+    @staticmethod
+    def _signature(st):
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def get_record(self, image_name):
+        """
+        Returns the record of ``image_name``, or None if it was not hashed
+        since it last changed.
+        """
+        try:
+            st = os.stat(os.path.join(self.image_path, image_name))
+        except OSError:
+            return None
+        record = self.load().get(image_name)
+        if not isinstance(record, dict) or 'md5' not in record:
+            return None
+        if (record.get('size'), record.get('mtime')) != (st.st_size,
+                                                         st.st_mtime):
+            return None
+        return record
+
+    def _read(self, image_name, digest=None):
+        """
+        Reads the whole image, which also brings it into the page cache.
+        Returns the stat of the image before it was read.
+        """
+        path = os.path.join(self.image_path, image_name)
+        with open(path, 'rb') as image_file:
+            st = os.fstat(image_file.fileno())
+            while True:
+                data = image_file.read(IMAGE_READ_BUFFER_SIZE)
+                if not data:
+                    break
+                if digest is not None:
+                    digest.update(data)
+        return st
+
+    @timed('hash_image')
+    def hash_image(self, image_name):
+        """
+        Hashes ``image_name`` and records it. Returns the record, or None if
+        the image cannot be read or changed while it was hashed.
+        """
+        digest = md5()
+        try:
+            st = self._read(image_name, digest)
+            after = os.stat(os.path.join(self.image_path, image_name))
+        except (IOError, OSError) as ex:
+            log('Unable to hash image "{0}": {1}'.format(image_name,
+                                                          str(ex)))
+            return None
+        if self._signature(st) != self._signature(after):
+            log('Image "{0}" changed while it was hashed'.format(image_name))
+            return None
+        record = self._signature(st)
+        record['md5'] = digest.hexdigest()
+        self._update(image_name, record)
+        return record
+
+    def get_expected_checksum(self, image_name):
+        """
+        Returns the md5 in the checksum file of ``image_name``, in the
+        format written by md5sum, or None if there is none.
+        """
+        try:
+            with open(os.path.join(self.image_path,
+                                   image_name + IMAGE_CHECKSUM_SUFFIX),
+                      'r') as checksum_file:
+                fields = checksum_file.read().split()
+        except IOError:
+            return None
+        if not fields:
+            return None
+        return fields[0].lower()
+
+    def _images(self):
+        try:
+            names = os.listdir(self.image_path)
+        except OSError:
+            return []
+        return sorted(name for name in names
+                      if not name.startswith('.') and
+                      not name.endswith(IMAGE_CHECKSUM_SUFFIX) and
+                      os.path.isfile(os.path.join(self.image_path, name)))
+
+    def refresh(self):
+        """
+        Hashes the images which were not hashed since they last changed,
+        unless another process is already doing so.
+        """
+        try:
+            lock_file = open(self.path + IMAGE_REFRESH_LOCK_SUFFIX, 'a')
+        except IOError:
+            return
+        try:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                log('Images are already being hashed', level='DEBUG')
+                return
+            for image_name in self._images():
+                if self.get_record(image_name) is None:
+                    self.hash_image(image_name)
+        finally:
+            lock_file.close()
+
+    def refresh_in_background(self):
+        run_in_background(self.refresh, 'image hashing')
+
+    def verify(self, image_name):
+        """
+        Returns None if ``image_name`` can be used, or why it cannot.
+
+        A recorded md5 is trusted for as long as the size and modification
+        time of the image do not change. An image with a checksum file is
+        hashed now if it has no record, others are hashed in the background.
+        """
+        if not os.path.isfile(os.path.join(self.image_path, image_name)):
+            return 'it does not exist'
+        expected = self.get_expected_checksum(image_name)
+        record = self.get_record(image_name)
+        if record is None:
+            if expected is None:
+                self.refresh_in_background()
+                return None
+            record = self.hash_image(image_name)
+            if record is None:
+                return 'it could not be hashed'
+        if expected is not None and record['md5'] != expected:
+            return 'its md5 {0} does not match {1}{2}'.format(
+                record['md5'], image_name, IMAGE_CHECKSUM_SUFFIX)
+        return None
+
+    @timed('prewarm_images')
+    def prewarm(self, image_names):
+        """
+        Reads ``image_names`` into the page cache ahead of the starts which
+        copy them, hashing the ones without a record on the way.
+        Returns the images which could not be read.
+        """
+        failed = []
+        for image_name in image_names:
+            log('Pre-warming image "{0}"'.format(image_name))
+            if self.get_record(image_name) is None:
+                if self.hash_image(image_name) is None:
+                    failed.append(image_name)
+                continue
+            try:
+                self._read(image_name)
+            except (IOError, OSError) as ex:
+                log('Unable to read image "{0}": {1}'.format(image_name,
+                                                              str(ex)))
+                failed.append(image_name)
+        return failed
+
+
+class Libvirt_storage_volume(object):
+    """
+    Instance image kept as a volume of the libvirt storage pool named by
+    'storage-pool' in adaptor_data, rather than as a file of the instance
+    directory. The volume is cloned from the volume of the base image, which
+    is looked up in the pool by the image name and then by its path, e.g.
+    when the images directory is a pool itself.
+
+    In a logical pool holding the base volume, the instance volume is a
+    (thin) snapshot of it, and otherwise a clone, which libvirt makes with
+    a reflink where it can.
+    """
+
+    def __init__(self, name, image_name, pool_name):
+        self.name = name
+        self.image_name = image_name
+        self.pool_name = pool_name
+        self.volume_name = '{0}-{1}'.format(name, image_name)
+
+    @staticmethod
+    def get_pool_name(adaptor_data):
+        return adaptor_data.get('storage-pool') or None
+
+    @staticmethod
+    def from_domain_xml(name, xml):
+        """
+        Returns the volumes of instance ``name`` used by the disks of the
+        domain ``xml``.
+        """
+        if not xml:
+            return []
+        try:
+            domain = ET.fromstring(xml)
+        except Exception as ex:
+            log('Unable to read the disks of Domain "{0}": {1}'.format(
+                name, str(ex)))
+            return []
+        volumes = []
+        for disk in domain.findall('devices/disk'):
+            source = disk.find('source')
+            if disk.get('type') != 'volume' or source is None:
+                continue
+            pool_name = source.get('pool')
+            volume_name = source.get('volume', '')
+            prefix = name + '-'
+            if pool_name and volume_name.startswith(prefix):
+                volumes.append(Libvirt_storage_volume(
+                    name, volume_name[len(prefix):], pool_name))
+        return volumes
+
+    def _get_pool(self):
+        try:
+            pool = get_handle().storagePoolLookupByName(self.pool_name)
+            if not pool.isActive():
+                raise LitpLibvirtException('Storage pool "{0}" is not '
+                                           'active'.format(self.pool_name))
+        except libvirt.libvirtError as ex:
+            raise LitpLibvirtException('Problem accessing storage pool '
+                                       '"{0}": {1}'.format(self.pool_name,
+                                                           str(ex)))
+        return pool
+
+    @staticmethod
+    def _get_pool_type(pool):
+        return ET.fromstring(pool.XMLDesc(0)).get('type')
+
+    def get_format(self):
+        """
+        Returns the disk format of the volume in its pool.
+        """
+        if self._get_pool_type(self._get_pool()) in FILE_STORAGE_POOL_TYPES:
+            return 'qcow2'
+        return 'raw'
+
+    def _get_volume(self, pool):
+        try:
+            return pool.storageVolLookupByName(self.volume_name)
+        except libvirt.libvirtError:
+            return None
+
+    def exists(self):
+        try:
+            return self._get_volume(self._get_pool()) is not None
+        except LitpLibvirtException:
+            return False
+
+    def _find_base_volume(self, pool):
+        try:
+            return pool.storageVolLookupByName(self.image_name)
+        except libvirt.libvirtError:
+            pass
+        path = os.path.join(LIBVIRT_BASE_IMGPATH, self.image_name)
+        try:
+            return get_handle().storageVolLookupByPath(path)
+        except libvirt.libvirtError:
+            return None
+
+    def base_volume_exists(self):
+        try:
+            return self._find_base_volume(self._get_pool()) is not None
+        except LitpLibvirtException:
+            return False
+
+    def _volume_xml(self, base, fmt, backing_path=None):
+        volume = ET.Element('volume')
+        ET.SubElement(volume, 'name').text = self.volume_name
+        base_capacity = ET.fromstring(base.XMLDesc(0)).find('capacity')
+        capacity = ET.SubElement(volume, 'capacity',
+                                 {'unit': base_capacity.get('unit', 'bytes')})
+        capacity.text = base_capacity.text
+        if fmt:
+            target = ET.SubElement(volume, 'target')
+            ET.SubElement(target, 'format', {'type': fmt})
+        if backing_path:
+            backing = ET.SubElement(volume, 'backingStore')
+            ET.SubElement(backing, 'path').text = backing_path
+        return ET.tostring(volume)
+
+    @timed('create_volume')
+    def create(self):
+        """
+        Creates the volume from the base image volume, replacing a volume
+        left over by an earlier definition.
+        """
+        pool = self._get_pool()
+        base = self._find_base_volume(pool)
+        if base is None:
+            raise LitpLibvirtException('Base image "{0}" is not a volume of '
+                                       'a storage pool'.format(
+                                           self.image_name))
+        try:
+            old = self._get_volume(pool)
+            if old is not None:
+                log('Deleting volume "{0}" of storage pool "{1}"'.format(
+                    self.volume_name, self.pool_name))
+                old.delete(0)
+            pool_type = self._get_pool_type(pool)
+            if pool_type in FILE_STORAGE_POOL_TYPES:
+                log('Cloning volume "{0}" in storage pool "{1}"'.format(
+                    self.volume_name, self.pool_name))
+                pool.createXMLFrom(self._volume_xml(base, 'qcow2'), base,
+                                   getattr(libvirt,
+                                           'VIR_STORAGE_VOL_CREATE_REFLINK',
+                                           0))
+            elif (pool_type == 'logical' and
+                  base.storagePoolLookupByVolume().name() == pool.name()):
+                log('Creating snapshot volume "{0}" in storage pool '
+                    '"{1}"'.format(self.volume_name, self.pool_name))
+                pool.createXML(self._volume_xml(base, None, base.path()), 0)
+            else:
+                log('Cloning volume "{0}" in storage pool "{1}"'.format(
+                    self.volume_name, self.pool_name))
+                pool.createXMLFrom(self._volume_xml(base, None), base, 0)
+        except libvirt.libvirtError as ex:
+            raise LitpLibvirtException('Problem creating volume "{0}" in '
+                                       'storage pool "{1}": {2}'.format(
+                                           self.volume_name, self.pool_name,
+                                           str(ex)))
+
+    @timed('delete_volume')
+    def delete(self):
+        try:
+            volume = self._get_volume(self._get_pool())
+            if volume is not None:
+                log('Deleting volume "{0}" of storage pool "{1}"'.format(
+                    self.volume_name, self.pool_name))
+                volume.delete(0)
+        except (libvirt.libvirtError, LitpLibvirtException) as ex:
+            log('Problem deleting volume "{0}" of storage pool "{1}": '
+                '{2}'.format(self.volume_name, self.pool_name, str(ex)),
+                level='ERROR')
+
+
 class Libvirt_vm_xml(object):
-    def __init__(self, name):
+    """
+    Builds the domain XML of instance ``name`` from ``conf``, the
+    Libvirt_conf of the instance, and ``host_facts``. Both are looked up
+    when not given, callers which already hold them pass them to avoid
+    reading config.json and detecting the host facts again.
+    """
+
+    def __init__(self, name, conf=None, host_facts=None):
         self.name = name
+        self._conf = conf
+        self._host_facts = host_facts
 
-    def _add_image_device(self, devices, image):
-        disk_img = Libvirt_vm_image(self.name, image)
-        disk = ET.SubElement(devices, "disk",
-                             {'type': 'file',
-                              'device': 'disk'})
-        ET.SubElement(disk, "driver",
-                          {'name': 'qemu',
-                           'type': 'qcow2',
-                           'cache': 'none'})
-        live_img = disk_img.get_live_img_path()
-        ET.SubElement(disk, "source",
+    @staticmethod
+    def _disk_driver_attrs(disk_type, tuning):
+        attrs = {'name': 'qemu',
+                 'type': disk_type,
+                 'cache': 'none'}
+        if tuning:
+            for key in ('io', 'discard', 'iothread'):
+                if tuning.get(key):
+                    attrs[key] = tuning[key]
+        return attrs
+
+    def _add_image_device(self, devices, image, tuning=None,
+                          storage_pool=None):
+        if storage_pool:
+            volume = Libvirt_storage_volume(self.name, image, storage_pool)
+            disk = ET.SubElement(devices, "disk",
+                                 {'type': 'volume',
+                                  'device': 'disk'})
+            ET.SubElement(disk, "driver",
+                          self._disk_driver_attrs(volume.get_format(),
+                                                  tuning))
+            ET.SubElement(disk, "source",
+                          {'pool': storage_pool,
+                           'volume': volume.volume_name})
+        else:
+            disk_img = Libvirt_vm_image(self.name, image)
+            disk = ET.SubElement(devices, "disk",
+                                 {'type': 'file',
+                                  'device': 'disk'})
+            ET.SubElement(disk, "driver",
+                          self._disk_driver_attrs('qcow2', tuning))
+            live_img = disk_img.get_live_img_path()
+            ET.SubElement(disk, "source",
                           {'file': live_img})
         ET.SubElement(disk, "target",
                           {'dev': 'vda',
@@ -544,21 +2204,26 @@ class Libvirt_vm_xml(object):
                     letters.remove(name[2])
         return 'vd%s' % letters[0]
 
-    def _add_disk_device(self, devices_node, device_path):
+    def _add_disk_device(self, devices_node, device_path, tuning=None):
         disk = ET.SubElement(devices_node, "disk",
                              {'type': 'block',
                               'device': 'disk'})
         ET.SubElement(disk, "driver",
-                          {'name': 'qemu',
-                           'type': 'raw',
-                           'cache': 'none'})
+                          self._disk_driver_attrs('raw', tuning))
         ET.SubElement(disk, "source",
                           {'dev': device_path})
         ET.SubElement(disk, "target",
                           {'dev': self._find_free_device_name(devices_node),
                            'bus': 'virtio'})
 
-    def _add_usb_device(self, devices):
+    def _add_usb_device(self, devices, enabled=True):
+        if not enabled:
+            # Stops libvirt from adding its default USB controller
+            ET.SubElement(devices, "controller",
+                          {'type': 'usb',
+                           'index': '0',
+                           'model': 'none'})
+            return
         controller = ET.SubElement(devices, "controller",
                                    {'type': 'usb',
                                     'index': '0'})
@@ -587,10 +2252,10 @@ class Libvirt_vm_xml(object):
         ET.SubElement(console, "alias",
                           {'name': 'serial0'})
 
-    def _add_input_device(self, devices):
+    def _add_input_device(self, devices, bus='usb'):
         input_dev = ET.SubElement(devices, "input",
                                {'type': 'tablet',
-                                'bus': 'usb'})
+                                'bus': bus})
         ET.SubElement(input_dev, "alias",
                           {'name': 'input00'})
         ET.SubElement(devices, "input",
@@ -607,12 +2272,13 @@ class Libvirt_vm_xml(object):
                           {'type': 'address',
                            'address': '127.0.0.1'})
 
-    def _add_video_device(self, devices):
+    def _add_video_device(self, devices, model=DEFAULT_VIDEO_MODEL):
         video = ET.SubElement(devices, "video")
-        ET.SubElement(video, "model",
-                          {'type': 'cirrus',
-                           'vram': '9216',
-                           'heads': '1'})
+        model_attrs = {'type': model,
+                       'heads': '1'}
+        if model == DEFAULT_VIDEO_MODEL:
+            model_attrs['vram'] = '9216'
+        ET.SubElement(video, "model", model_attrs)
         ET.SubElement(video, "alias",
                           {'name': 'video0'})
 
@@ -632,7 +2298,8 @@ class Libvirt_vm_xml(object):
                           {'model': 'random'})
         backend.text = '/dev/random'
 
-    def _add_net_interface_device(self, devices, shared_dev, mac_address):
+    def _add_net_interface_device(self, devices, shared_dev, mac_address,
+                                  queues=None, vhost=False):
         # Generalise for multiple net interfaces
         iface = ET.SubElement(devices, "interface",
                               {'type': 'bridge'})
@@ -642,11 +2309,19 @@ class Libvirt_vm_xml(object):
         ET.SubElement(iface, "model",
                           {'type': 'virtio'})
 
+        driver_attrs = {}
+        if vhost:
+            driver_attrs['name'] = 'vhost'
+        if queues and queues > 1:
+            driver_attrs['queues'] = str(queues)
+        if driver_attrs:
+            ET.SubElement(iface, "driver", driver_attrs)
+
         if mac_address:
             ET.SubElement(iface, "mac",
                               {'address': mac_address})
 
-    def _add_cdrom_device(self, devices, src_file):
+    def _add_cdrom_device(self, devices, src_file, bus='ide'):
         cd = ET.SubElement(devices, "disk",
                            {'type': 'file',
                             'device': 'cdrom'})
@@ -656,18 +2331,132 @@ class Libvirt_vm_xml(object):
         ET.SubElement(cd, "source",
                           {'file': src_file})
         ET.SubElement(cd, "target",
-                          {'dev': 'hda',
-                           'bus': 'ide'})
+                          {'dev': 'hda' if bus == 'ide' else 'sda',
+                           'bus': bus})
         ET.SubElement(cd, "readonly")
         ET.SubElement(cd, "alias",
-                          {'name': 'ide0-0-0'})
+                          {'name': '{0}0-0-0'.format(bus)})
+
+    @staticmethod
+    def _positive_int(name, option, value):
+        try:
+            result = int(value)
+        except (TypeError, ValueError):
+            result = 0
+        if result <= 0:
+            raise LitpLibvirtException('{0}: {1} value "{2}" is not a '
+                                       'positive integer'.format(name, option,
+                                                                 value))
+        return result
+
+    @staticmethod
+    def _parse_size(name, option, value):
+        """
+        Splits a size such as "2048M" into its value and libvirt unit.
+        """
+        value = str(value)
+        if value[-1:] not in SIZE_UNITS or not value[:-1].isdigit():
+            raise LitpLibvirtException('{0}: {1} size {2} has incorrect '
+                                       'format'.format(name, option, value))
+        return value[:-1], SIZE_UNITS[value[-1]]
+
+    @staticmethod
+    def _size_kib(name, option, value):
+        size, unit = Libvirt_vm_xml._parse_size(name, option, value)
+        return int(size) * MEMORY_UNITS_KIB[unit]
+
+    @staticmethod
+    def _in_nodeset(node, nodeset):
+        try:
+            for item in nodeset.split(','):
+                bounds = item.split('-')
+                if int(bounds[0]) <= node <= int(bounds[-1]):
+                    return True
+        except ValueError:
+            raise LitpLibvirtException('Nodeset {0} has incorrect '
+                                       'format'.format(nodeset))
+        return False
+
+    @staticmethod
+    def _get_hugepages(name, hugepages):
+        """
+        Returns the list of hugepage sizes from the ``hugepages`` option,
+        either a single size or a list of {"size": .., "nodeset": ..},
+        as (size, unit, nodeset) tuples.
+        """
+        if not isinstance(hugepages, list):
+            hugepages = [{'size': hugepages}]
+        pages = []
+        for page in hugepages:
+            try:
+                size, unit = Libvirt_vm_xml._parse_size(name, 'hugepages',
+                                                        page['size'])
+            except (KeyError, TypeError):
+                raise LitpLibvirtException('{0}: hugepages value {1} has '
+                                           'incorrect format'.format(name,
+                                                                     page))
+            pages.append((size, unit, page.get('nodeset')))
+        return pages
+
+    @staticmethod
+    def get_hugepages_requirement(name, vm_data):
+        """
+        Returns a tuple of the size in KiB of the hugepages backing the
+        memory of the domain and the number of pages it needs, or None if
+        it is not backed by hugepages.
+        """
+        if not vm_data.get('hugepages'):
+            return None
+        pages = Libvirt_vm_xml._get_hugepages(name, vm_data['hugepages'])
+        # Without a guest NUMA topology all memory is in guest node 0
+        backing = pages[0]
+        for page in pages:
+            if page[2] is None or Libvirt_vm_xml._in_nodeset(0, page[2]):
+                backing = page
+                break
+        page_kib = int(backing[0]) * MEMORY_UNITS_KIB[backing[1]]
+        ram_kib = Libvirt_vm_xml._size_kib(name, 'ram', vm_data['ram'])
+        return page_kib, (ram_kib + page_kib - 1) // page_kib
+
+    def _add_memory_backing(self, domain, name, hugepages, locked,
+                            nosharepages):
+        if not (hugepages or locked or nosharepages):
+            return
+        backing = ET.SubElement(domain, "memoryBacking")
+        if hugepages:
+            pages = ET.SubElement(backing, "hugepages")
+            for size, unit, nodeset in self._get_hugepages(name, hugepages):
+                page_attrs = {'size': size, 'unit': unit}
+                if nodeset:
+                    page_attrs['nodeset'] = nodeset
+                ET.SubElement(pages, "page", page_attrs)
+        if nosharepages:
+            ET.SubElement(backing, "nosharepages")
+        if locked:
+            ET.SubElement(backing, "locked")
+
+    def _get_net_queues(self, name, cpus, net_queues):
+        """
+        Returns the number of virtio-net queues, which is tied to and
+        limited by the number of vCPUs.
+        """
+        if not net_queues:
+            return None
+        vcpus = self._positive_int(name, 'cpu', cpus)
+        if net_queues == 'auto':
+            return vcpus
+        return min(self._positive_int(name, 'net_queues', net_queues), vcpus)
 
     def _define_domain(self, name, ram_size, cpus, image,
-                       nics, block_devices, cpuset=None, cpunodebind=None):
-        allowed_units = {'M': 'MiB'}
+                       nics, block_devices, cpuset=None, cpunodebind=None,
+                       iothreads=None, disk_io=None, disk_discard=None,
+                       net_queues=None, net_vhost=False, hugepages=None,
+                       memory_locked=False, nosharepages=False,
+                       machine_type=None, headless=False, video_model=None,
+                       input_bus=None, storage_pool=None):
         ram_units = ram_size[-1]
         ram_val = ram_size[:-1]
-        if ram_units not in allowed_units.keys():
+        if ram_units not in SIZE_UNITS.keys():
             raise LitpLibvirtException('Ram size {0} has incorrect '
                                        'format'.format(ram_size))
 
@@ -675,12 +2464,14 @@ class Libvirt_vm_xml(object):
         machine_name = ET.SubElement(domain, "name")
         machine_name.text = name
         memory = ET.SubElement(domain, "memory",
-                               {"unit": allowed_units[ram_units]})
+                               {"unit": SIZE_UNITS[ram_units]})
         memory.text = ram_val
+        self._add_memory_backing(domain, name, hugepages, memory_locked,
+                                 nosharepages)
 
-        virt_what_command = "/usr/sbin/virt-what"
-        is_bare_metal = exec_cmd(virt_what_command)[1] == ''
         # check if it is virtual or physical machine
+        host_facts = self._host_facts or Libvirt_host_facts.get()
+        is_bare_metal = host_facts.is_bare_metal
         if is_bare_metal:
             ET.SubElement(domain, "cpu",
                           {"mode": "host-passthrough"})
@@ -704,10 +2495,35 @@ class Libvirt_vm_xml(object):
         cpu = ET.SubElement(domain, "vcpu", cpus_attrs)
         cpu.text = cpus
 
+        if disk_io and disk_io not in DISK_IO_MODES:
+            raise LitpLibvirtException('{0}: disk_io value "{1}" is not one '
+                                       'of {2}'.format(name, disk_io,
+                                                       DISK_IO_MODES))
+        if disk_discard and disk_discard not in DISK_DISCARD_MODES:
+            raise LitpLibvirtException('{0}: disk_discard value "{1}" is not '
+                                       'one of {2}'.format(name, disk_discard,
+                                                           DISK_DISCARD_MODES))
+        num_iothreads = 0
+        if iothreads:
+            num_iothreads = self._positive_int(name, 'iothreads', iothreads)
+            io_threads = ET.SubElement(domain, "iothreads")
+            io_threads.text = str(num_iothreads)
+        queues = self._get_net_queues(name, cpus, net_queues)
+
+        if input_bus and input_bus not in INPUT_BUSES:
+            raise LitpLibvirtException('{0}: input_bus value "{1}" is not one '
+                                       'of {2}'.format(name, input_bus,
+                                                       INPUT_BUSES))
+        machine = DEFAULT_MACHINE_TYPE
+        if machine_type:
+            machine = Libvirt_capabilities.get_machine_type(machine_type)
+        # q35 machines have no IDE controller
+        cdrom_bus = 'sata' if 'q35' in machine else 'ide'
+
         op_sys = ET.SubElement(domain, "os")
         arch = ET.SubElement(op_sys, "type",
                              {'arch': 'x86_64',
-                              'machine': 'rhel6.6.0'})
+                              'machine': machine})
         arch.text = "hvm"
         ET.SubElement(op_sys, "boot", {"dev": "hd"})
         features = ET.SubElement(domain, "features")
@@ -726,10 +2542,20 @@ class Libvirt_vm_xml(object):
         devices = ET.SubElement(domain, "devices")
         emu = ET.SubElement(devices, "emulator")
         emu.text = "/usr/libexec/qemu-kvm"
-        self._add_image_device(devices, image)
-        for block_device_path in block_devices:
-            self._add_disk_device(devices, block_device_path)
-        self._add_usb_device(devices)
+        disk_tuning = []
+        for index in range(len(block_devices) + 1):
+            tuning = {'io': disk_io, 'discard': disk_discard}
+            if num_iothreads:
+                # Spread the disks over the I/O threads
+                tuning['iothread'] = str(index % num_iothreads + 1)
+            disk_tuning.append(tuning)
+        self._add_image_device(devices, image, disk_tuning[0],
+                               storage_pool=storage_pool)
+        for block_device_path, tuning in zip(block_devices, disk_tuning[1:]):
+            self._add_disk_device(devices, block_device_path, tuning)
+        # The USB controller is only needed for the USB tablet
+        self._add_usb_device(devices, enabled=not headless and
+                             input_bus in (None, 'usb'))
 
         for dev in sorted(nics, key=self.network_sort):
             nic = nics[dev]
@@ -738,15 +2564,19 @@ class Libvirt_vm_xml(object):
                 nic_mac_address = nic["mac_address"]
             self._add_net_interface_device(devices,
                                            nic["host_device"],
-                                           nic_mac_address)
+                                           nic_mac_address,
+                                           queues=queues,
+                                           vhost=net_vhost)
 
         self._add_serial_device(devices)
         self._add_console_device(devices)
-        self._add_input_device(devices)
-        self._add_graphics_device(devices)
-        self._add_video_device(devices)
+        if not headless:
+            self._add_input_device(devices, bus=input_bus or 'usb')
+            self._add_graphics_device(devices)
+            self._add_video_device(devices,
+                                   model=video_model or DEFAULT_VIDEO_MODEL)
         cloud_init_iso = LIBVIRT_CONFPATH + "/" + name + "/cloud_init.iso"
-        self._add_cdrom_device(devices, cloud_init_iso)
+        self._add_cdrom_device(devices, cloud_init_iso, bus=cdrom_bus)
         if is_bare_metal:
             self._add_rng_device(devices)
         #self._add_seclabel(domain)
@@ -767,18 +2597,134 @@ class Libvirt_vm_xml(object):
         imagelabel = ET.SubElement(seclabel, "imagelabel")
         imagelabel.text = "unconfined_u:object_r:svirt_image_t:s0:c805,c993"
 
+    @staticmethod
+    def _is_ignored(parent, child):
+        return (child.tag in DOMAIN_XML_IGNORED_TAGS or
+                child.tag in DOMAIN_XML_IGNORED_CHILDREN.get(parent.tag, ()))
+
+    @staticmethod
+    def _canonical_node(element):
+        """
+        Returns the attributes and text of ``element`` with the memory
+        size normalised to KiB and volatile attributes removed.
+        """
+        attrs = dict(element.attrib)
+        for attr in DOMAIN_XML_IGNORED_ATTRS.get(element.tag, ()):
+            attrs.pop(attr, None)
+        text = (element.text or '').strip()
+        if element.tag == 'memory' and text:
+            unit = MEMORY_UNITS_KIB.get(element.get('unit', 'KiB'), 1)
+            text = str(int(text) * unit)
+        return attrs, text
+
+    @staticmethod
+    def _canonical_lines(element, path, lines):
+        path = '{0}/{1}'.format(path, element.tag)
+        attrs, text = Libvirt_vm_xml._canonical_node(element)
+        line = path
+        if attrs:
+            line += '[{0}]'.format(' '.join(
+                '{0}={1}'.format(k, v) for k, v in sorted(attrs.items())))
+        if text:
+            line += ' = {0}'.format(text)
+        lines.append(line)
+        for child in element:
+            if not Libvirt_vm_xml._is_ignored(element, child):
+                Libvirt_vm_xml._canonical_lines(child, path, lines)
+        return lines
+
+    @staticmethod
+    def canonicalise(xml):
+        """
+        Returns domain ``xml`` as a list of lines, one per element, each
+        holding the element path, its sorted attributes and its text.
+        """
+        return Libvirt_vm_xml._canonical_lines(ET.fromstring(xml), '', [])
+
+    @staticmethod
+    def diff_domain_xml(old_xml, new_xml):
+        """
+        Returns the unified diff of the canonical forms of two domain XMLs
+        generated by this class, an empty list if they are identical.
+        """
+        return list(difflib.unified_diff(Libvirt_vm_xml.canonicalise(old_xml),
+                                         Libvirt_vm_xml.canonicalise(new_xml),
+                                         'defined', 'generated', n=0,
+                                         lineterm=''))[2:]
+
+    @staticmethod
+    def _missing_nodes(wanted, actual, path):
+        path = '{0}/{1}'.format(path, wanted.tag)
+        wanted_attrs, wanted_text = Libvirt_vm_xml._canonical_node(wanted)
+        actual_attrs, actual_text = Libvirt_vm_xml._canonical_node(actual)
+        missing = []
+        for key, value in sorted(wanted_attrs.items()):
+            if actual_attrs.get(key) != value:
+                missing.append('{0}[{1}]: "{2}" != "{3}"'.format(
+                    path, key, value, actual_attrs.get(key)))
+        if wanted_text != actual_text:
+            missing.append('{0}: "{1}" != "{2}"'.format(path, wanted_text,
+                                                       actual_text))
+        unmatched = list(actual)
+        for child in wanted:
+            if Libvirt_vm_xml._is_ignored(wanted, child):
+                continue
+            candidates = [c for c in unmatched if c.tag == child.tag]
+            match = None
+            for candidate in candidates:
+                if not Libvirt_vm_xml._missing_nodes(child, candidate, path):
+                    match = candidate
+                    break
+            if match is not None:
+                unmatched.remove(match)
+            elif len(candidates) == 1:
+                missing.extend(Libvirt_vm_xml._missing_nodes(
+                    child, candidates[0], path))
+                unmatched.remove(candidates[0])
+            else:
+                missing.append('{0}/{1}: missing'.format(path, child.tag))
+        return missing
+
+    @staticmethod
+    def missing_domain_xml(wanted_xml, actual_xml):
+        """
+        Returns descriptions of the parts of ``wanted_xml`` which are not
+        present in ``actual_xml``, as returned by libvirt with the defaults
+        it fills in. An empty list means that libvirt holds ``wanted_xml``.
+        """
+        return Libvirt_vm_xml._missing_nodes(ET.fromstring(wanted_xml),
+                                             ET.fromstring(actual_xml), '')
+
+    @timed('build_xml')
     def build_machine_xml(self):
         try:
-            conf = Libvirt_conf(self.name)
+            conf = self._conf
+            if conf is None:
+                conf = Libvirt_conf(self.name)
             vm_data = conf.get_vm_data()
             adaptor_data = conf.get_adaptor_data()
             num_cpus = vm_data["cpu"]
             cpuset = vm_data.get("cpuset", None)
             cpunodebind = vm_data.get("cpunodebind", None)
+            iothreads = vm_data.get("iothreads", None)
+            disk_io = vm_data.get("disk_io", None)
+            disk_discard = vm_data.get("disk_discard", None)
+            net_queues = vm_data.get("net_queues", None)
+            net_vhost = vm_data.get("net_vhost", False) in (True, 'true')
+            hugepages = vm_data.get("hugepages", None)
+            memory_locked = vm_data.get("memory_locked", False) in (True,
+                                                                    'true')
+            nosharepages = vm_data.get("nosharepages", False) in (True,
+                                                                  'true')
+            machine_type = vm_data.get("machine_type", None)
+            headless = vm_data.get("headless", False) in (True, 'true')
+            video_model = vm_data.get("video_model", None)
+            input_bus = vm_data.get("input_bus", None)
             ram_size = vm_data["ram"]
             image = vm_data["image"]
             nics = vm_data["interfaces"]
             block_devices = [d[0] for d in adaptor_data.get('disk_mounts', [])]
+            storage_pool = Libvirt_storage_volume.get_pool_name(adaptor_data)
         except (KeyError, LitpLibvirtException) as ex:
             raise LitpLibvirtException('Problem reading config '
                                        'for Domain "{0}: '
@@ -786,5 +2732,17 @@ class Libvirt_vm_xml(object):
                                                     str(ex)))
         domain = self._define_domain(self.name, ram_size, num_cpus,
                                      image, nics, block_devices,
-                                     cpuset=cpuset, cpunodebind=cpunodebind)
+                                     cpuset=cpuset, cpunodebind=cpunodebind,
+                                     iothreads=iothreads, disk_io=disk_io,
+                                     disk_discard=disk_discard,
+                                     net_queues=net_queues,
+                                     net_vhost=net_vhost,
+                                     hugepages=hugepages,
+                                     memory_locked=memory_locked,
+                                     nosharepages=nosharepages,
+                                     machine_type=machine_type,
+                                     headless=headless,
+                                     video_model=video_model,
+                                     input_bus=input_bus,
+                                     storage_pool=storage_pool)
         return ET.tostring(domain, encoding='utf-8')
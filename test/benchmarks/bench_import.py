@@ -0,0 +1,62 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+"""
+Measures how long a fresh interpreter takes to import the adaptor, which is
+paid on every service action, and which heavy modules the import pulls in.
+
+    python test/benchmarks/bench_import.py [runs]
+"""
+
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ('lxml.etree', 'yaml', 'xml.etree.ElementTree', 'urllib2',
+                 'logging.config', 'uuid', 'difflib')
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import litpmnlibvirt.litp_libvirt_adaptor
+elapsed = time.time() - start
+print('%%f %%s' %% (elapsed, ','.join(m for m in %r if m in sys.modules)))
+""" % (HEAVY_MODULES,)
+
+
+def measure(runs):
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, os.pardir, 'src')
+    env = dict(os.environ)
+    env['TESTING_FLAG'] = '1'
+    env['PYTHONPATH'] = os.pathsep.join(
+        [src_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    timings = []
+    loaded = ''
+    for _ in range(runs):
+        out = subprocess.Popen([sys.executable, '-c', IMPORT_SCRIPT],
+                               stdout=subprocess.PIPE,
+                               env=env).communicate()[0]
+        elapsed, _, loaded = out.strip().partition(' ')
+        timings.append(float(elapsed) * 1000)
+    timings.sort()
+    return timings, loaded
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    timings, loaded = measure(runs)
+    print('adaptor import over %d runs: min %.1fms median %.1fms '
+          'max %.1fms' % (runs, timings[0], timings[len(timings) // 2],
+                          timings[-1]))
+    print('heavy modules loaded at import: %s' % (loaded or 'none'))
+
+
+if __name__ == '__main__':
+    main()
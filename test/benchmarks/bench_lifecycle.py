@@ -0,0 +1,130 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+"""
+Runs the adaptor lifecycle against the in-memory hypervisor of
+test_litpmnlibvirt/fake_libvirt.py and reports, per action, the wall time,
+the libvirt calls and the read/write syscalls (from /proc/self/io) per
+instance:
+
+    python test/benchmarks/bench_lifecycle.py [--instances 1,10,50,200]
+        [--latency SECONDS] [--image-size BYTES]
+
+``--latency`` adds a delay to every libvirt call, to approximate the RPC
+round trip to libvirtd.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+sys.path[:0] = [os.path.join(TEST_DIR, os.pardir, 'src'), TEST_DIR]
+os.environ['TESTING_FLAG'] = '1'
+
+from litpmnlibvirt.litp_libvirt_adaptor import LitpLibVirtAdaptor
+from test_litpmnlibvirt.fake_libvirt import FakeHost
+
+LIBVIRT_METHODS = ('listAllDomains', 'lookupByName', 'defineXML',
+                   'getCapabilities', 'info', 'isActive', 'XMLDesc',
+                   'create', 'shutdown', 'destroy', 'undefine')
+
+
+def _syscalls():
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(': ') for line in io_file)
+        return int(counters['syscr']) + int(counters['syscw'])
+    except (IOError, KeyError, ValueError):
+        return 0
+
+
+def _change_config(host, name):
+    host.write_config(name, ram='512M')
+    return LitpLibVirtAdaptor(name, base_os='6').start()
+
+
+ACTIONS = (
+    ('start', lambda host, name: LitpLibVirtAdaptor(
+        name, base_os='6').start()),
+    ('status', lambda host, name: LitpLibVirtAdaptor(
+        name, base_os='6').status()),
+    ('stop', lambda host, name: LitpLibVirtAdaptor(
+        name, base_os='6').stop()),
+    ('restart-defined', lambda host, name: LitpLibVirtAdaptor(
+        name, base_os='6').start()),
+    ('config-change', _change_config),
+    ('force-stop-undefine', lambda host, name: LitpLibVirtAdaptor(
+        name, base_os='6').force_stop_undefine()),
+)
+
+
+def run(instances, latency, image_size):
+    """
+    Returns (action, wall seconds, libvirt calls, syscalls, failures) for
+    each action run over ``instances`` instances.
+    """
+    root = tempfile.mkdtemp(prefix='bench_lifecycle')
+    latencies = dict((method, latency) for method in LIBVIRT_METHODS)
+    results = []
+    stdout = sys.stdout
+    try:
+        with FakeHost(root, image_size=image_size,
+                      latencies=latencies) as host:
+            names = ['vm{0}'.format(i) for i in range(instances)]
+            for name in names:
+                host.add_instance(name)
+            for action, func in ACTIONS:
+                calls = host.conn.total_calls()
+                syscalls = _syscalls()
+                failures = 0
+                sys.stdout = open(os.devnull, 'w')
+                start = time.time()
+                for name in names:
+                    if func(host, name) not in (0, None):
+                        failures += 1
+                elapsed = time.time() - start
+                sys.stdout.close()
+                sys.stdout = stdout
+                results.append((action, elapsed,
+                                host.conn.total_calls() - calls,
+                                _syscalls() - syscalls, failures))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(root)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--instances', default='1,10,50,200',
+                        help='comma separated instance counts')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every libvirt call')
+    parser.add_argument('--image-size', type=int, default=1024 * 1024,
+                        help='size of the base image in bytes')
+    args = parser.parse_args()
+    print('%-6s %-20s %10s %12s %10s %10s %4s' % (
+        'vms', 'action', 'total ms', 'ms/vm', 'calls/vm', 'sysc/vm',
+        'fail'))
+    for count in [int(c) for c in args.instances.split(',')]:
+        for action, elapsed, calls, syscalls, failures in run(
+                count, args.latency, args.image_size):
+            print('%-6d %-20s %10.1f %12.2f %10.1f %10.1f %4d' % (
+                count, action, elapsed * 1000, elapsed * 1000 / count,
+                float(calls) / count, float(syscalls) / count, failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,425 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+"""
+In-memory stand-in for a libvirt connection, so that adaptor actions can be
+run end to end without a hypervisor:
+
+    with FakeHost(tmp_dir) as host:
+        host.add_instance('vm1')
+        LitpLibVirtAdaptor('vm1', base_os='6').start()
+        host.conn.calls['create']
+
+Domains keep their definition and state across calls, as do the volumes of
+storage pools. Every call is counted in ``FakeConnection.calls`` and can be
+slowed down with ``latencies``.
+"""
+
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+
+import mock
+from libvirt import (VIR_CONNECT_LIST_DOMAINS_ACTIVE,
+                     VIR_CONNECT_LIST_DOMAINS_INACTIVE, VIR_DOMAIN_RUNNING,
+                     VIR_DOMAIN_SHUTDOWN, VIR_DOMAIN_SHUTOFF, libvirtError)
+
+from litpmnlibvirt import litp_libvirt_utils
+from litpmnlibvirt.litp_libvirt_connector import get_handle, register_driver
+from litpmnlibvirt.litp_libvirt_utils import (Libvirt_capabilities,
+                                              Libvirt_host_facts,
+                                              Libvirt_image_registry,
+                                              Libvirt_trash)
+
+FAKE_URI = 'fake:///'
+
+CAPABILITIES = """<capabilities>
+  <host>
+    <topology>
+      <cells num="2">
+        <cell id="0"><cpus num="2"><cpu id="0"/><cpu id="1"/></cpus></cell>
+        <cell id="1"><cpus num="2"><cpu id="2"/><cpu id="3"/></cpus></cell>
+      </cells>
+    </topology>
+  </host>
+  <guest>
+    <arch name="x86_64">
+      <machine canonical="pc-i440fx-rhel7.6.0">pc</machine>
+      <machine>pc-i440fx-rhel7.6.0</machine>
+      <machine>rhel6.6.0</machine>
+    </arch>
+  </guest>
+</capabilities>
+"""
+
+HOST_FACTS = {'is_bare_metal': True, 'cpu_model': 'Fake CPU',
+              'kvm_available': True}
+
+
+class FakeDomain(object):
+    """
+    Domain of a FakeConnection. An ACPI shutdown completes after the
+    connection's ``shutdown_delay`` seconds, or never if it is None.
+    """
+
+    def __init__(self, conn, xml):
+        self._conn = conn
+        self._name = ET.fromstring(xml).findtext('name')
+        self.xml = xml
+        self.state = VIR_DOMAIN_SHUTOFF
+        self.persistent = True
+        self._shutoff_at = None
+
+    def _call(self, method):
+        self._conn.record(method)
+
+    def _refresh(self):
+        if (self.state == VIR_DOMAIN_SHUTDOWN and
+                self._shutoff_at is not None and
+                time.time() >= self._shutoff_at):
+            self._power_off()
+
+    def _power_off(self):
+        self.state = VIR_DOMAIN_SHUTOFF
+        self._shutoff_at = None
+        if not self.persistent:
+            self._conn.domains.pop(self._name, None)
+
+    def is_active(self):
+        self._refresh()
+        return self.state != VIR_DOMAIN_SHUTOFF
+
+    def name(self):
+        # Answered by the client library, not an RPC
+        return self._name
+
+    def info(self):
+        self._call('info')
+        self._refresh()
+        return [self.state, 1048576, 1048576, 1, 0]
+
+    def isActive(self):
+        self._call('isActive')
+        return int(self.is_active())
+
+    def XMLDesc(self, flags=0):
+        # pylint: disable=W0613
+        self._call('XMLDesc')
+        return self.xml
+
+    def create(self):
+        self._call('create')
+        if self.is_active():
+            raise libvirtError('Requested operation is not valid: domain '
+                               'is already running')
+        self.state = VIR_DOMAIN_RUNNING
+
+    def shutdown(self):
+        self._call('shutdown')
+        if not self.is_active():
+            raise libvirtError('Requested operation is not valid: domain '
+                               'is not running')
+        delay = self._conn.shutdown_delay
+        if delay is not None:
+            self.state = VIR_DOMAIN_SHUTDOWN
+            self._shutoff_at = time.time() + delay
+            self._refresh()
+
+    def destroy(self):
+        self._call('destroy')
+        if not self.is_active():
+            raise libvirtError('Requested operation is not valid: domain '
+                               'is not running')
+        self._power_off()
+
+    def undefine(self):
+        self._call('undefine')
+        if self.is_active():
+            self.persistent = False
+        else:
+            self._conn.domains.pop(self._name, None)
+
+
+class FakeStorageVolume(object):
+    """
+    Volume of a FakeStoragePool, ``backing`` is the path of the volume it
+    is a snapshot of.
+    """
+
+    def __init__(self, pool, name, capacity, backing=None):
+        self._pool = pool
+        self._name = name
+        self.capacity = capacity
+        self.backing = backing
+
+    def _call(self, method):
+        self._pool._conn.record(method)
+
+    def name(self):
+        return self._name
+
+    def path(self):
+        return os.path.join(self._pool.path, self._name)
+
+    def XMLDesc(self, flags=0):
+        # pylint: disable=W0613
+        self._call('vol.XMLDesc')
+        return ('<volume><name>{0}</name><capacity unit="bytes">{1}'
+                '</capacity></volume>'.format(self._name, self.capacity))
+
+    def storagePoolLookupByVolume(self):
+        self._call('vol.storagePoolLookupByVolume')
+        return self._pool
+
+    def delete(self, flags=0):
+        # pylint: disable=W0613
+        self._call('vol.delete')
+        del self._pool.volumes[self._name]
+
+
+class FakeStoragePool(object):
+    """
+    Storage pool of a FakeConnection, its volumes are kept in memory.
+    """
+
+    def __init__(self, conn, name, pool_type, path):
+        self._conn = conn
+        self._name = name
+        self.pool_type = pool_type
+        self.path = path
+        self.volumes = {}
+
+    def _call(self, method):
+        self._conn.record(method)
+
+    def name(self):
+        return self._name
+
+    def isActive(self):
+        self._call('pool.isActive')
+        return 1
+
+    def XMLDesc(self, flags=0):
+        # pylint: disable=W0613
+        self._call('pool.XMLDesc')
+        return '<pool type="{0}"><name>{1}</name></pool>'.format(
+            self.pool_type, self._name)
+
+    def add_volume(self, name, capacity, backing=None):
+        volume = FakeStorageVolume(self, name, capacity, backing)
+        self.volumes[name] = volume
+        return volume
+
+    def storageVolLookupByName(self, name):
+        self._call('pool.storageVolLookupByName')
+        if name not in self.volumes:
+            raise libvirtError("Storage volume not found: no storage vol "
+                               "with matching name '{0}'".format(name))
+        return self.volumes[name]
+
+    def _create(self, xml):
+        volume = ET.fromstring(xml)
+        name = volume.findtext('name')
+        if name in self.volumes:
+            raise libvirtError("storage volume '{0}' exists "
+                               "already".format(name))
+        return name, int(volume.findtext('capacity')), volume.findtext(
+            'backingStore/path')
+
+    def createXML(self, xml, flags=0):
+        # pylint: disable=W0613
+        self._call('pool.createXML')
+        return self.add_volume(*self._create(xml))
+
+    def createXMLFrom(self, xml, clonevol, flags=0):
+        # pylint: disable=W0613
+        self._call('pool.createXMLFrom')
+        name, capacity, _ = self._create(xml)
+        return self.add_volume(name, capacity)
+
+
+class FakeConnection(object):
+    """
+    Hypervisor connection keeping its domains in memory.
+
+    ``latencies`` -- seconds each call of a method, e.g. "create", takes
+    ``shutdown_delay`` -- seconds a domain takes to power off after an ACPI
+                          shutdown, None if the guest ignores it
+    """
+
+    def __init__(self, latencies=None, shutdown_delay=0):
+        self.latencies = latencies or {}
+        self.shutdown_delay = shutdown_delay
+        self.domains = {}
+        self.pools = {}
+        self.calls = {}
+
+    def record(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        latency = self.latencies.get(method)
+        if latency:
+            time.sleep(latency)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def listAllDomains(self, flags=0):
+        self.record('listAllDomains')
+        wanted = flags & (VIR_CONNECT_LIST_DOMAINS_ACTIVE |
+                          VIR_CONNECT_LIST_DOMAINS_INACTIVE)
+        result = []
+        for name in sorted(self.domains):
+            dom = self.domains[name]
+            flag = (VIR_CONNECT_LIST_DOMAINS_ACTIVE if dom.is_active()
+                    else VIR_CONNECT_LIST_DOMAINS_INACTIVE)
+            # A domain may have been removed by an expired shutdown
+            if name in self.domains and (not wanted or flag & wanted):
+                result.append(dom)
+        return result
+
+    def lookupByName(self, name):
+        self.record('lookupByName')
+        if name not in self.domains:
+            raise libvirtError("Domain not found: no domain with matching "
+                               "name '{0}'".format(name))
+        return self.domains[name]
+
+    def defineXML(self, xml):
+        self.record('defineXML')
+        dom = FakeDomain(self, xml)
+        existing = self.domains.get(dom._name)
+        if existing is not None:
+            existing.xml = xml
+            existing.persistent = True
+            return existing
+        self.domains[dom._name] = dom
+        return dom
+
+    def storagePoolLookupByName(self, name):
+        self.record('storagePoolLookupByName')
+        if name not in self.pools:
+            raise libvirtError("Storage pool not found: no storage pool "
+                               "with matching name '{0}'".format(name))
+        return self.pools[name]
+
+    def storageVolLookupByPath(self, path):
+        self.record('storageVolLookupByPath')
+        for pool in self.pools.values():
+            for volume in pool.volumes.values():
+                if volume.path() == path:
+                    return volume
+        raise libvirtError("Storage volume not found: no storage vol with "
+                           "matching path '{0}'".format(path))
+
+    def getCapabilities(self):
+        self.record('getCapabilities')
+        return CAPABILITIES
+
+    def close(self):
+        self.record('close')
+        return 0
+
+
+class FakeHost(object):
+    """
+    Points the adaptor at a FakeConnection and at instance and image
+    directories below ``root`` for the duration of the ``with`` block.
+    """
+    IMAGE_NAME = 'fake-image.qcow2'
+
+    def __init__(self, root, image_size=1024, **conn_kwargs):
+        self.root = root
+        self.conf_path = os.path.join(root, 'instances')
+        self.image_path = os.path.join(root, 'images')
+        self.image_size = image_size
+        self.conn = FakeConnection(**conn_kwargs)
+        self._patches = []
+
+    def __enter__(self):
+        for path in (self.conf_path, self.image_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        with open(os.path.join(self.image_path, self.IMAGE_NAME), 'w') as f:
+            f.write('\0' * self.image_size)
+        register_driver('fake', lambda uri: self.conn)
+        get_handle.clear()
+        self._patches = [
+            mock.patch.dict(os.environ, {'LITP_LIBVIRT_URI': FAKE_URI}),
+            mock.patch.object(litp_libvirt_utils, 'LIBVIRT_CONFPATH',
+                              self.conf_path),
+            mock.patch.object(litp_libvirt_utils, 'LIBVIRT_BASE_IMGPATH',
+                              self.image_path),
+            mock.patch.object(Libvirt_host_facts, '_cached',
+                              Libvirt_host_facts(HOST_FACTS)),
+            mock.patch.object(Libvirt_capabilities, '_root', None),
+            # Empty the trash in process, rather than in a forked reaper
+            mock.patch.object(Libvirt_trash, 'reap_in_background',
+                              staticmethod(Libvirt_trash.reap)),
+            mock.patch.object(Libvirt_image_registry,
+                              'refresh_in_background',
+                              Libvirt_image_registry.refresh.im_func)]
+        if not self._find_executable(litp_libvirt_utils.GENISOIMAGE_PATH):
+            # The ISO is not needed by the fake domains
+            self._patches.append(mock.patch.object(
+                litp_libvirt_utils, 'GENISOIMAGE_PATH', 'true'))
+        for patch in self._patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *args):
+        for patch in reversed(self._patches):
+            patch.stop()
+        get_handle.clear()
+        return False
+
+    @staticmethod
+    def _find_executable(name):
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if os.access(os.path.join(path, name), os.X_OK):
+                return True
+        return False
+
+    def add_pool(self, name, pool_type='dir', path=None):
+        """
+        Adds a storage pool, a pool at ``image_path`` holds the base image.
+        """
+        pool = FakeStoragePool(self.conn, name, pool_type,
+                               path or os.path.join(self.root, name))
+        if pool.path == self.image_path:
+            pool.add_volume(self.IMAGE_NAME, self.image_size)
+        self.conn.pools[name] = pool
+        return pool
+
+    def add_instance(self, name, ram='256M', cpu='1', adaptor_data=None):
+        """
+        Writes the config.json and cloud-init files of a new instance.
+        """
+        instance_dir = os.path.join(self.conf_path, name)
+        if not os.path.isdir(instance_dir):
+            os.makedirs(instance_dir)
+        self.write_config(name, ram=ram, cpu=cpu, adaptor_data=adaptor_data)
+        with open(os.path.join(instance_dir, 'user-data'), 'w') as f:
+            f.write('#cloud-config\nruncmd: []\n')
+        with open(os.path.join(instance_dir, 'meta-data'), 'w') as f:
+            f.write('instance-id: {0}\n'.format(name))
+        with open(os.path.join(instance_dir, 'network-config'), 'w') as f:
+            f.write('version: 1\nconfig: []\n')
+
+    def write_config(self, name, ram='256M', cpu='1', adaptor_data=None):
+        config = {'vm_data': {'image': self.IMAGE_NAME,
+                              'ram': ram,
+                              'cpu': cpu,
+                              'interfaces': {'eth0': {'host_device': 'br0',
+                                                      'mac_address':
+                                                      '52:54:00:00:00:01'}}},
+                  'adaptor_data': adaptor_data or {'disk_mounts': []}}
+        with open(os.path.join(self.conf_path, name, 'config.json'),
+                  'w') as f:
+            json.dump(config, f)
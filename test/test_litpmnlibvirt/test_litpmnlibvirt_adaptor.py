@@ -21,10 +21,15 @@ from litpmnlibvirt.litp_libvirt_adaptor import (LitpLibVirtAdaptor,
                                                 INTERNAL_STATUS_FAIL)
 
 from litpmnlibvirt.litp_libvirt_utils import LitpLibvirtException
+from litpmnlibvirt.litp_libvirt_platform import Platform
 
 import unittest
 import mock
-from libvirt import libvirtError
+from libvirt import (libvirtError, VIR_DOMAIN_CRASHED, VIR_DOMAIN_NOSTATE,
+                     VIR_DOMAIN_PAUSED, VIR_DOMAIN_PMSUSPENDED,
+                     VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTDOWN,
+                     VIR_DOMAIN_SHUTOFF)
+from urllib2 import URLError
 
 ADAPTOR_MODULE = 'litpmnlibvirt.litp_libvirt_adaptor'
 ADAPTOR_CLASS = ADAPTOR_MODULE + '.LitpLibVirtAdaptor'
@@ -36,6 +41,7 @@ CONFIG = {"vm_data": {"image": "path/image_name",
                                "eth1": {'host_device': 'br1'}}},
           "adaptor_data": {}
           }
+BASE_IMAGE = {'size': 1024, 'mtime': 1400000000.0, 'inode': 1}
 
 
 class TestLitpLibVirtAdaptor(unittest.TestCase):
@@ -48,6 +54,16 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
     def test_init_sets_instance_name(self, _stderr, _exit):
         self.assertEquals("unittest", self.adaptor.instance_name)
 
+    @mock.patch(ADAPTOR_MODULE + ".Platform.get")
+    def test_platform_detected_on_first_use(self, platform_get):
+        platform_get.return_value = Platform('6', 'sysv')
+        adaptor = LitpLibVirtAdaptor("unittest")
+        self.assertEqual(0, platform_get.call_count)
+        self.assertFalse(adaptor.platform.uses_systemd)
+        self.assertEqual('6', adaptor.base_os)
+        self.assertTrue(self.adaptor.platform.uses_systemd)
+        self.assertEqual(1, platform_get.call_count)
+
     @mock.patch("sys.exit")
     @mock.patch("sys.stderr")
     def test_main_exits_on_bad_cmd(self, _stderr, _exit):
@@ -88,6 +104,53 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _main()
         _exit.assert_called_once_with(0)
 
+    @mock.patch(ADAPTOR_MODULE + ".ActionTimer")
+    @mock.patch(ADAPTOR_CLASS + ".can_read_conf")
+    @mock.patch("sys.exit")
+    @mock.patch(ADAPTOR_CLASS + ".stop")
+    def test_main_records_action_timing(self, stop, _exit, can_read_conf,
+                                        timer):
+        sys.argv = ['main', 'vm-name', 'STOP']
+        can_read_conf.return_value = True
+        stop.return_value = 1
+        _main()
+        timer.assert_called_once_with('vm-name', 'stop')
+        self.assertEqual(1, timer.return_value.result)
+        _exit.assert_called_once_with(1)
+
+    @mock.patch(ADAPTOR_MODULE + ".metrics")
+    @mock.patch(ADAPTOR_MODULE + ".ActionTimer")
+    @mock.patch(ADAPTOR_CLASS + ".can_read_conf")
+    @mock.patch("sys.exit")
+    @mock.patch(ADAPTOR_CLASS + ".stop")
+    def test_main_records_metrics_of_failed_action(self, stop, _exit,
+                                                   can_read_conf, timer,
+                                                   _metrics):
+        sys.argv = ['main', 'vm-name', 'stop']
+        can_read_conf.return_value = True
+        stop.side_effect = ValueError()
+        timer.return_value.result = 'ValueError'
+        timer.return_value.duration = 2.0
+        self.assertRaises(ValueError, _main)
+        _metrics.record_action.assert_called_once_with('vm-name', 'stop',
+                                                       'ValueError', 2.0)
+        _metrics.flush.assert_called_once_with()
+        self.assertEqual(0, _exit.call_count)
+
+    @mock.patch(ADAPTOR_MODULE + ".metrics")
+    @mock.patch(ADAPTOR_CLASS + ".can_read_conf")
+    @mock.patch("sys.exit")
+    @mock.patch(ADAPTOR_CLASS + ".status")
+    def test_main_does_not_count_status(self, status, _exit, can_read_conf,
+                                        _metrics):
+        sys.argv = ['main', 'vm-name', 'status']
+        can_read_conf.return_value = True
+        status.return_value = 0
+        _main()
+        self.assertEqual(0, _metrics.record_action.call_count)
+        self.assertEqual(0, _metrics.flush.call_count)
+        _exit.assert_called_once_with(0)
+
     @mock.patch(ADAPTOR_CLASS)
     @mock.patch(ADAPTOR_MODULE + ".log")
     @mock.patch("sys.exit")
@@ -229,7 +292,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         with mock.patch(ADAPTOR_MODULE + '.log') as log_patch:
             status = self.adaptor._internal_status()
         self.assertEqual(log_patch.call_args_list, [
-            mock.call('Checking Domain "unittest" status from URL: "http://10.10.10.1:12987"', level='DEBUG'),
+            mock.call('Checking Domain "{0}" status from URL: "{1}"', 'unittest', 'http://10.10.10.1:12987', level='DEBUG'),
             mock.call('Domain "unittest" internal status check OK'),
             ])
 
@@ -241,6 +304,25 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         self.assertEquals(status, INTERNAL_STATUS_NOK)
 
 
+    @mock.patch(ADAPTOR_MODULE + '.metrics')
+    @mock.patch(ADAPTOR_MODULE + '.urlopen')
+    def test_internal_status_records_metrics(self, urlopen, _metrics):
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {
+            'internal_status_check': {
+                'active': 'on',
+                'ip_address': '10.10.10.1',
+                },
+            }
+        urlopen.side_effect = URLError('refused')
+        self.assertEquals(INTERNAL_STATUS_FAIL,
+                          self.adaptor._internal_status())
+        self.assertEqual('litp_libvirt_internal_status_check_seconds',
+                         _metrics.observe.call_args[0][0])
+        _metrics.inc.assert_called_once_with(
+            'litp_libvirt_internal_status_checks_total',
+            {'instance': 'unittest', 'result': 'fail'})
+
     @mock.patch("sys.stdout")
     @mock.patch(ADAPTOR_CLASS + "._status")
     def test_status_calls_lsb_decorations_pos(self, _status, sysstdout):
@@ -300,6 +382,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _get_dom.return_value.destroy = destroy
         _is_def.return_value = True
         _is_run.return_value = True
+        _get_dom.return_value.info.return_value = [VIR_DOMAIN_RUNNING]
         _sysd_stop.return_value = False
         self.assertEquals(lv_succ, self.adaptor._force_stop())
         destroy.assert_called_once_with()
@@ -340,44 +423,82 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _log.assert_any_call('Domain "unittest" is not running - nothing to '
                 'destroy')
 
-    @mock.patch(SYSTEMD_CLASS + ".stop_service")
-    @mock.patch(ADAPTOR_MODULE + ".LITP_LIBVIRT_SUCCESS")
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._sleep")
     @mock.patch(ADAPTOR_CLASS + "._get_domain")
     @mock.patch(ADAPTOR_CLASS + "._is_running")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
-    def test_force_stop_retry_raises_exception_if_domain_not_running(self, _is_def,
-            _is_run, _get_dom, _log, lv_succ, _sysd_stop):
-        destroy = mock.Mock()
-        _get_dom.return_value.destroy = destroy
+    def test_force_stop_returns_once_domain_shut_off(self, _is_def, _is_run,
+            _get_dom, _sleep, _log):
         _is_def.return_value = True
-        _is_run.side_effect = [True, False, False, False, False]
-        _sysd_stop.return_value = 1
-        self.assertEquals(lv_succ, self.adaptor._force_stop())
-        _log.assert_any_call('Calling destroy on Domain "unittest"')
-        _log.assert_any_call('Retrying if domain unittest is not running.  Attempt 0 of 3.')
-        _log.assert_any_call('All retries attempts used, VM unittest is still down')
-        self.assertEquals(0, destroy.call_count)
-        _log.assert_any_call('Force Shutdown failed on "unittest" due to "instance is not running"')
+        _is_run.return_value = True
+        _get_dom.return_value.info.side_effect = [[VIR_DOMAIN_SHUTDOWN],
+                                                  [VIR_DOMAIN_SHUTOFF]]
+        self.assertEquals(0, self.adaptor._force_stop())
+        _sleep.assert_called_once_with(0.2)
+        self.assertEquals(0, _get_dom.return_value.destroy.call_count)
+        _log.assert_any_call('Domain "unittest" is shut off - nothing to '
+                             'destroy')
 
-    @mock.patch(SYSTEMD_CLASS + ".stop_service")
-    @mock.patch(ADAPTOR_MODULE + ".LITP_LIBVIRT_SUCCESS")
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._sleep")
     @mock.patch(ADAPTOR_CLASS + "._get_domain")
     @mock.patch(ADAPTOR_CLASS + "._is_running")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     def test_force_stop_after_domain_back_running(self, _is_def,
-            _is_run, _get_dom, _log, lv_succ, _sysd_stop):
-        destroy = mock.Mock()
-        _get_dom.return_value.destroy = destroy
+            _is_run, _get_dom, _sleep, _log):
         _is_def.return_value = True
-        _is_run.side_effect = [True, False, False, True, True]
-        _sysd_stop.return_value = 1
-        self.assertEquals(lv_succ, self.adaptor._force_stop())
-        _log.assert_any_call('Calling destroy on Domain "unittest"')
-        _log.assert_any_call('Retrying if domain unittest is not running.  Attempt 0 of 3.')
-        _log.assert_any_call('Retrying if domain unittest is not running.  Attempt 1 of 3.')
-        self.assertEquals(1, destroy.call_count)
+        _is_run.return_value = True
+        _get_dom.return_value.info.side_effect = [[VIR_DOMAIN_NOSTATE],
+                                                  [VIR_DOMAIN_NOSTATE],
+                                                  [VIR_DOMAIN_RUNNING]]
+        self.assertEquals(0, self.adaptor._force_stop())
+        self.assertEquals(2, _sleep.call_count)
+        _get_dom.return_value.destroy.assert_called_once_with()
+        _log.assert_any_call('Domain "unittest" is in state 0, waiting for it '
+                             'to settle')
+
+    @mock.patch(ADAPTOR_MODULE + ".time")
+    @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._sleep")
+    @mock.patch(ADAPTOR_CLASS + "._get_domain")
+    @mock.patch(ADAPTOR_CLASS + "._is_running")
+    @mock.patch(ADAPTOR_CLASS + "._is_defined")
+    def test_force_stop_destroys_domain_not_settled(self, _is_def,
+            _is_run, _get_dom, _sleep, _log, _time):
+        _is_def.return_value = True
+        _is_run.return_value = True
+        _time.time.side_effect = [100, 101, 106]
+        _get_dom.return_value.info.return_value = [VIR_DOMAIN_SHUTDOWN]
+        self.adaptor.conf.conf = {'adaptor_data': {'force-stop-wait': 5}}
+        self.assertEquals(0, self.adaptor._force_stop())
+        _sleep.assert_called_once_with(0.2)
+        _get_dom.return_value.destroy.assert_called_once_with()
+        _log.assert_any_call('Domain "unittest" did not settle in time, '
+                             'state is 4')
+
+    @mock.patch(ADAPTOR_CLASS + "._sleep")
+    @mock.patch(ADAPTOR_CLASS + "._get_domain")
+    @mock.patch(ADAPTOR_CLASS + "._is_running")
+    @mock.patch(ADAPTOR_CLASS + "._is_defined")
+    def test_force_stop_destroys_stable_states_at_once(self, _is_def,
+            _is_run, _get_dom, _sleep):
+        _is_def.return_value = True
+        _is_run.return_value = True
+        for state in (VIR_DOMAIN_PAUSED, VIR_DOMAIN_CRASHED,
+                      VIR_DOMAIN_PMSUSPENDED):
+            _get_dom.return_value.info.return_value = [state]
+            self.assertEquals(0, self.adaptor._force_stop())
+        self.assertEquals(0, _sleep.call_count)
+        self.assertEquals(3, _get_dom.return_value.destroy.call_count)
+
+    def test_get_force_stop_wait(self):
+        self.adaptor.conf.conf = {'adaptor_data': {'force-stop-wait': '10'}}
+        self.assertEquals(10.0, self.adaptor._get_force_stop_wait())
+        self.adaptor.conf.conf = {'adaptor_data': {}}
+        self.assertEquals(5, self.adaptor._get_force_stop_wait())
+        self.adaptor.conf.conf = {}
+        self.assertEquals(5, self.adaptor._get_force_stop_wait())
 
     @mock.patch(SYSTEMD_CLASS + ".stop_service")
     @mock.patch(ADAPTOR_MODULE + ".log")
@@ -391,6 +512,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _sysd_stop.return_value = False
 
         domain = mock.Mock()
+        domain.info.return_value = [VIR_DOMAIN_RUNNING]
         _get_dom.return_value = domain
 
         def raise_exception():
@@ -420,11 +542,16 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         LVcloudinit.get_disk_mounts.return_value=[]
         LVxml.return_value.build_machine_xml.return_value = xml
         self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
         self.adaptor._define()
 
         c_args, c_kwargs = LVxml.call_args
         self.assertEqual(c_args, ("unittest",))
+        self.assertTrue(c_kwargs['conf'] is self.adaptor.conf)
         conn.defineXML.assert_called_once_with(xml)
+        self.adaptor.conf.save_domain_xml.assert_called_once_with(xml)
+        self.adaptor.conf.save_defined_base_image.assert_called_once_with(
+            _get_img.return_value)
         _log.assert_any_call('Defining Domain "unittest"')
         _log.assert_any_call('Adding XML definition for Domain "unittest"')
 
@@ -439,6 +566,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         c_init_instance = mock.Mock()
         LVcloudinit.return_value = c_init_instance
         self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
         self.adaptor._define()
 
         c_args, c_kwargs = LVcloudinit.call_args
@@ -459,6 +587,8 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         img_inst = mock.Mock()
         LVimg.return_value = img_inst
         self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
+        self.adaptor.conf.restore_last_undefined_vm.return_value = False
         self.adaptor._define()
 
         LVimg.assert_called_once_with("unittest", "unittest.qcow2")
@@ -466,6 +596,24 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _log.assert_any_call('Copying base image "unittest.qcow2" to instance directory '
                 'for Domain "unittest"')
 
+    @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_cloud_init")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_xml")
+    @mock.patch(ADAPTOR_MODULE + ".get_handle")
+    @mock.patch(ADAPTOR_CLASS + "._get_image_name")
+    def test_define_restores_image(self, _get_img, connector, LVxml, LVimg,
+            LVcloudinit, _log):
+        _get_img.return_value = "unittest.qcow2"
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
+        self.adaptor.conf.restore_last_undefined_vm.return_value = True
+        self.adaptor._define()
+
+        self.assertEqual(0, LVimg.return_value.copy_image.call_count)
+        connector.return_value.defineXML.assert_called_once_with(
+            LVxml.return_value.build_machine_xml.return_value)
+
     @mock.patch(ADAPTOR_MODULE + ".LITP_LIBVIRT_SUCCESS")
     @mock.patch(ADAPTOR_MODULE + ".log")
     @mock.patch(ADAPTOR_CLASS + "._is_running")
@@ -664,6 +812,24 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
                 ' - calling force-stop')
         dom.shutdown.assert_called_once_with()
 
+    @mock.patch(ADAPTOR_MODULE + ".metrics")
+    @mock.patch(ADAPTOR_MODULE + ".log", mock.Mock())
+    @mock.patch(ADAPTOR_CLASS + "._force_stop")
+    @mock.patch(ADAPTOR_CLASS + ".wait_for_shutdown")
+    @mock.patch(ADAPTOR_CLASS + "._get_domain", mock.Mock())
+    @mock.patch(ADAPTOR_CLASS + "._is_running")
+    def test_stop_counts_force_stop_fallback(self, _is_run, _wait,
+                                             _force_stop, _metrics):
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
+        _is_run.return_value = True
+        _wait.return_value = False
+        _force_stop.return_value = 0
+        self.adaptor._stop(stop_timeout=1)
+        _metrics.inc.assert_called_once_with(
+            'litp_libvirt_force_stop_fallbacks_total',
+            {'instance': 'unittest'})
+
     @mock.patch("litpmnlibvirt.litp_libvirt_adaptor.Timeout.__enter__")
     @mock.patch(ADAPTOR_CLASS + "._sleep")
     @mock.patch(ADAPTOR_CLASS + "._shutdown_domain")
@@ -718,6 +884,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _get_domain.return_value.shutdown.assert_called_once_with()
 
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._check_hugepages", mock.Mock(return_value=[]))
     @mock.patch(ADAPTOR_CLASS + "._check_disk_images")
     def test_check_startup_requirements_logs_error(self, chk_dsk, _log):
         error = mock.Mock()
@@ -726,6 +893,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _log.assert_any_call(error, level="ERROR", echo=True)
 
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._check_hugepages", mock.Mock(return_value=[]))
     @mock.patch(ADAPTOR_CLASS + "._check_disk_images")
     def test_check_startup_requirements_does_not_log_if_clean(self, chk_dsk,
             _log):
@@ -733,6 +901,57 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         self.assertTrue(self.adaptor.check_startup_requirements())
         self.assertEquals(0, _log.call_count)
 
+    @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._check_hugepages")
+    @mock.patch(ADAPTOR_CLASS + "._check_disk_images")
+    def test_check_startup_requirements_logs_hugepages_error(self, chk_dsk,
+            chk_pages, _log):
+        chk_dsk.return_value = []
+        chk_pages.return_value = ['not enough hugepages']
+        self.assertFalse(self.adaptor.check_startup_requirements())
+        _log.assert_any_call('not enough hugepages', level="ERROR", echo=True)
+
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_host_facts.get_free_hugepages")
+    @mock.patch(ADAPTOR_CLASS + "._is_running")
+    def test_check_hugepages(self, _is_run, free_pages):
+        _is_run.return_value = False
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_vm_data.return_value = {'ram': '4096M'}
+        self.assertEquals([], self.adaptor._check_hugepages())
+        self.assertEquals(0, free_pages.call_count)
+
+        self.adaptor.conf.get_vm_data.return_value = {'ram': '4096M',
+                                                      'hugepages': '2M'}
+        free_pages.return_value = 2048
+        self.assertEquals([], self.adaptor._check_hugepages())
+        free_pages.assert_called_once_with(2048)
+
+        free_pages.return_value = 2047
+        self.assertEquals(['Domain "unittest" requires 2048 hugepages of '
+                           '2048KiB, only 2047 are free'],
+                          self.adaptor._check_hugepages())
+
+        free_pages.return_value = None
+        self.assertEquals(['Hugepages of 2048KiB required by Domain '
+                           '"unittest" are not supported by the host'],
+                          self.adaptor._check_hugepages())
+
+        # The pages of a running domain are already allocated
+        _is_run.return_value = True
+        self.assertEquals([], self.adaptor._check_hugepages())
+
+    def test_check_hugepages_bad_config(self):
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_vm_data.return_value = {'ram': '4096M',
+                                                      'hugepages': '2X'}
+        self.assertEquals(['unittest: hugepages size 2X has incorrect format'],
+                          self.adaptor._check_hugepages())
+
+        self.adaptor.conf.get_vm_data.return_value = {'hugepages': '2M'}
+        self.assertEquals(['Hugepages for Domain "unittest" cannot be '
+                           'checked, "ram" is missing from vm_data'],
+                          self.adaptor._check_hugepages())
+
     @mock.patch(ADAPTOR_MODULE + ".log")
     def testcan_read_conf_pos(self, _log):
         self.adaptor.conf = mock.Mock()
@@ -766,11 +985,12 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         live_image.assert_called_once()
         self.assertEquals(0, base_image.call_count)
 
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_image_registry")
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     @mock.patch(ADAPTOR_CLASS + "._get_image_name")
     def test_check_disk_images_check_base_if_not_defined(self, _get_img,
-            _is_def, _img):
+            _is_def, _img, _registry):
         _is_def.return_value = False
         mach_image = mock.Mock()
         base_image = mock.Mock()
@@ -778,6 +998,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _img.return_value.base_image_exists = base_image
         mach_image.return_value = True
         base_image.return_value = True
+        _registry.return_value.verify.return_value = None
 
         self.assertEquals([], self.adaptor._check_disk_images())
         base_image.assert_called_once()
@@ -794,15 +1015,17 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         live_image.return_value = True
         self.assertEquals([], self.adaptor._check_disk_images())
 
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_image_registry")
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     @mock.patch(ADAPTOR_CLASS + "._get_image_name")
     def test_check_disk_images_return_empty_if_not_issue_undef(self,
-            _get_img, _is_def, _img):
+            _get_img, _is_def, _img, _registry):
         _is_def.return_value = False
         base_image = mock.Mock()
         _img.return_value.base_image_exists = base_image
         base_image.return_value = True
+        _registry.return_value.verify.return_value = None
         self.assertEquals([], self.adaptor._check_disk_images())
 
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
@@ -831,6 +1054,23 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         self.assertEquals(['Base image for Domain "unittest" does not '
             'exist'], self.adaptor._check_disk_images())
 
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_image_registry")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
+    @mock.patch(ADAPTOR_CLASS + "._is_defined")
+    @mock.patch(ADAPTOR_CLASS + "._get_image_name")
+    def test_check_disk_images_return_message_if_base_corrupt(self,
+            _get_img, _is_def, _img, _registry):
+        _get_img.return_value = "unittest.qcow2"
+        _is_def.return_value = False
+        _img.return_value.base_image_exists.return_value = True
+        _registry.return_value.verify.return_value = 'it is truncated'
+
+        self.assertEquals(['Base image "unittest.qcow2" for Domain "unittest" '
+            'cannot be used, it is truncated'],
+            self.adaptor._check_disk_images())
+        _registry.return_value.verify.assert_called_once_with(
+            "unittest.qcow2")
+
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_cloud_init")
     def test_check_config_changed_no_conf_live(self, LVcloudinit, _is_def):
@@ -869,6 +1109,115 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         LVvmimage.return_value.delete_live_image = mock.Mock()
         self.assertEquals(True, self.adaptor._check_config_changed())
 
+    @mock.patch(ADAPTOR_CLASS + "._is_definition_unchanged")
+    @mock.patch(ADAPTOR_CLASS + "._stop")
+    @mock.patch(ADAPTOR_CLASS + "._undefine")
+    def test_check_config_changed_skips_unchanged_definition(
+        self, undefine, stop, unchanged):
+        unchanged.return_value = True
+        self.adaptor.conf.conf_live_exists = mock.Mock(return_value=True)
+        self.adaptor.conf.conf_same = mock.Mock(return_value=False)
+        self.adaptor.conf.cleanup_instance_dir = mock.Mock()
+        self.assertEquals(True, self.adaptor._check_config_changed())
+        self.assertEquals(0, stop.call_count)
+        self.assertEquals(0, undefine.call_count)
+        self.assertEquals(0, self.adaptor.conf.cleanup_instance_dir.call_count)
+
+    @mock.patch(ADAPTOR_CLASS + "._get_domain")
+    @mock.patch(ADAPTOR_CLASS + "._is_defined")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_xml")
+    def test_is_definition_unchanged(self, LVxml, _is_def, _get_dom):
+        _is_def.return_value = True
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.conf_file = 'config.json'
+        self.adaptor.conf.get_changed_config_files.return_value = [
+            'config.json']
+        self.adaptor.conf.get_domain_xml.return_value = '<domain/>'
+        self.adaptor.conf.get_base_image_identity.return_value = BASE_IMAGE
+        self.adaptor.conf.get_defined_base_image.return_value = BASE_IMAGE
+        self.adaptor.conf.get_live_conf.return_value = {
+            'adaptor_data': {'disk_mounts': [['/dev/vdb', '/mnt/data']]}}
+        self.adaptor.conf.get_adaptor_data.return_value = {
+            'disk_mounts': [['/dev/vdb', '/mnt/data']]}
+        LVxml.return_value.build_machine_xml.return_value = '<domain/>'
+        LVxml.diff_domain_xml.return_value = []
+        LVxml.missing_domain_xml.return_value = []
+        _get_dom.return_value.XMLDesc.return_value = '<domain id="1"/>'
+        self.assertTrue(self.adaptor._is_definition_unchanged())
+        LVxml.diff_domain_xml.assert_called_once_with('<domain/>',
+                                                      '<domain/>')
+        LVxml.missing_domain_xml.assert_called_once_with('<domain/>',
+                                                         '<domain id="1"/>')
+
+        LVxml.missing_domain_xml.return_value = ['/domain/name: missing']
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+
+    @mock.patch(ADAPTOR_CLASS + "._is_defined", mock.Mock(return_value=True))
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_xml")
+    def test_is_definition_unchanged_disk_mounts_changed(self, LVxml):
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.conf_file = 'config.json'
+        self.adaptor.conf.get_changed_config_files.return_value = [
+            'config.json']
+        self.adaptor.conf.get_domain_xml.return_value = '<domain/>'
+        self.adaptor.conf.get_base_image_identity.return_value = BASE_IMAGE
+        self.adaptor.conf.get_defined_base_image.return_value = BASE_IMAGE
+        self.adaptor.conf.get_live_conf.return_value = {
+            'adaptor_data': {'disk_mounts': [['/dev/vdb', '/mnt/data']]}}
+        self.adaptor.conf.get_adaptor_data.return_value = {
+            'disk_mounts': [['/dev/vdb', '/mnt/other']]}
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+        self.assertEqual(0, LVxml.return_value.build_machine_xml.call_count)
+
+        self.adaptor.conf.get_live_conf.side_effect = LitpLibvirtException()
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+
+    @mock.patch(ADAPTOR_CLASS + "._is_defined", mock.Mock(return_value=True))
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_xml")
+    def test_is_definition_unchanged_base_image_replaced(self, LVxml):
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.conf_file = 'config.json'
+        self.adaptor.conf.get_changed_config_files.return_value = [
+            'config.json']
+        self.adaptor.conf.get_domain_xml.return_value = '<domain/>'
+        self.adaptor.conf.get_vm_data.return_value = {'image': 'img.qcow2'}
+        self.adaptor.conf.get_base_image_identity.return_value = dict(
+            BASE_IMAGE, inode=2)
+        self.adaptor.conf.get_defined_base_image.return_value = BASE_IMAGE
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+        self.adaptor.conf.get_base_image_identity.assert_called_once_with(
+            'img.qcow2')
+        self.assertEqual(0, LVxml.return_value.build_machine_xml.call_count)
+
+        # Domains defined before the base image was recorded
+        self.adaptor.conf.get_defined_base_image.return_value = None
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_xml")
+    def test_is_definition_unchanged_needs_redefinition(self, LVxml):
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.conf_file = 'config.json'
+        self.adaptor.conf.get_changed_config_files.return_value = [
+            'config.json', 'user-data']
+        self.adaptor.conf.get_domain_xml.return_value = '<domain/>'
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+
+        self.adaptor.conf.get_changed_config_files.return_value = [
+            'config.json']
+        self.adaptor.conf.get_domain_xml.return_value = None
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+
+        self.adaptor._is_defined = mock.Mock(return_value=True)
+        self.adaptor.conf.get_domain_xml.return_value = '<domain/>'
+        self.adaptor.conf.get_base_image_identity.return_value = BASE_IMAGE
+        self.adaptor.conf.get_defined_base_image.return_value = BASE_IMAGE
+        self.adaptor.conf.get_live_conf.return_value = {'adaptor_data': {}}
+        self.adaptor.conf.get_adaptor_data.return_value = {}
+        LVxml.diff_domain_xml.return_value = ['-/domain/name = a',
+                                              '+/domain/name = b']
+        self.assertFalse(self.adaptor._is_definition_unchanged())
+        self.assertEqual(0, LVxml.missing_domain_xml.call_count)
+
     @mock.patch(ADAPTOR_CLASS + "._undefine")
     @mock.patch(ADAPTOR_CLASS + "._stop")
     def test_check_config_changed_cleanup_instance_dir_raise_error(
@@ -959,7 +1308,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         self.adaptor.conf = mock.Mock()
         self.adaptor.conf.move_files_to_last_undefined_vm_dir = mock.Mock()
         self.adaptor.conf.cleanup_instance_dir = mock.Mock()
-        self.adaptor.stop_undefine(stop_timeout=7)
+        self.assertEqual(lv_succ, self.adaptor.stop_undefine(stop_timeout=7))
         self.adaptor.conf.move_files_to_last_undefined_vm_dir.assert_called_once_with()
         self.adaptor.conf.cleanup_instance_dir.assert_called_once_with()
         _undefine.assert_called_once_with()
@@ -24,7 +24,8 @@ from litpmnlibvirt.litp_libvirt_utils import LitpLibvirtException
 
 import unittest
 import mock
-from libvirt import libvirtError
+from libvirt import (libvirtError, VIR_DOMAIN_NOSTATE, VIR_DOMAIN_RUNNING,
+                     VIR_DOMAIN_SHUTDOWN, VIR_DOMAIN_SHUTOFF)
 
 ADAPTOR_MODULE = 'litpmnlibvirt.litp_libvirt_adaptor'
 ADAPTOR_CLASS = ADAPTOR_MODULE + '.LitpLibVirtAdaptor'
@@ -223,7 +224,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         with mock.patch(ADAPTOR_MODULE + '.log') as log_patch:
             status = self.adaptor._internal_status()
         self.assertEqual(log_patch.call_args_list, [
-            mock.call('Checking Domain "unittest" status from URL: "http://10.10.10.1:12987"', level='DEBUG'),
+            mock.call('Checking Domain "{0}" status from URL: "{1}"', 'unittest', 'http://10.10.10.1:12987', level='DEBUG'),
             mock.call('Domain "unittest" internal status check OK'),
             ])
 
@@ -293,6 +294,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _get_dom.return_value.destroy = destroy
         _is_def.return_value = True
         _is_run.return_value = True
+        _get_dom.return_value.info.return_value = [VIR_DOMAIN_RUNNING]
         self.assertEquals(lv_succ, self.adaptor._force_stop())
         destroy.assert_called_once_with()
         _log.assert_any_call('Attempting to destroy Service "unittest"')
@@ -330,40 +332,67 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _log.assert_any_call('Domain "unittest" is not running - nothing to '
                 'destroy')
 
-    @mock.patch(ADAPTOR_MODULE + ".LITP_LIBVIRT_SUCCESS")
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._sleep")
     @mock.patch(ADAPTOR_CLASS + "._get_domain")
     @mock.patch(ADAPTOR_CLASS + "._is_running")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
-    def test_force_stop_retry_raises_exception_if_domain_not_running(self, _is_def,
-            _is_run, _get_dom, _log, lv_succ):
-        destroy = mock.Mock()
-        _get_dom.return_value.destroy = destroy
+    def test_force_stop_returns_once_domain_shut_off(self, _is_def, _is_run,
+            _get_dom, _sleep, _log):
         _is_def.return_value = True
-        _is_run.side_effect = [True, False, False, False, False]
-        self.assertEquals(lv_succ, self.adaptor._force_stop())
-        _log.assert_any_call('Calling destroy on Domain "unittest"')
-        _log.assert_any_call('Retrying if domain unittest is not running.  Attempt 0 of 3.')
-        _log.assert_any_call('All retries attempts used, VM unittest is still down')
-        self.assertEquals(0, destroy.call_count)
-        _log.assert_any_call('Force Shutdown failed on "unittest" due to "instance is not running"')
+        _is_run.return_value = True
+        _get_dom.return_value.info.side_effect = [[VIR_DOMAIN_SHUTDOWN],
+                                                  [VIR_DOMAIN_SHUTOFF]]
+        self.assertEquals(0, self.adaptor._force_stop())
+        _sleep.assert_called_once_with(0.2)
+        self.assertEquals(0, _get_dom.return_value.destroy.call_count)
+        _log.assert_any_call('Domain "unittest" is shut off - nothing to '
+                             'destroy')
 
-    @mock.patch(ADAPTOR_MODULE + ".LITP_LIBVIRT_SUCCESS")
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._sleep")
     @mock.patch(ADAPTOR_CLASS + "._get_domain")
     @mock.patch(ADAPTOR_CLASS + "._is_running")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     def test_force_stop_after_domain_back_running(self, _is_def,
-            _is_run, _get_dom, _log, lv_succ):
-        destroy = mock.Mock()
-        _get_dom.return_value.destroy = destroy
+            _is_run, _get_dom, _sleep, _log):
         _is_def.return_value = True
-        _is_run.side_effect = [True, False, False, True, True]
-        self.assertEquals(lv_succ, self.adaptor._force_stop())
-        _log.assert_any_call('Calling destroy on Domain "unittest"')
-        _log.assert_any_call('Retrying if domain unittest is not running.  Attempt 0 of 3.')
-        _log.assert_any_call('Retrying if domain unittest is not running.  Attempt 1 of 3.')
-        self.assertEquals(1, destroy.call_count)
+        _is_run.return_value = True
+        _get_dom.return_value.info.side_effect = [[VIR_DOMAIN_NOSTATE],
+                                                  [VIR_DOMAIN_NOSTATE],
+                                                  [VIR_DOMAIN_RUNNING]]
+        self.assertEquals(0, self.adaptor._force_stop())
+        self.assertEquals(2, _sleep.call_count)
+        _get_dom.return_value.destroy.assert_called_once_with()
+        _log.assert_any_call('Domain "unittest" is in state 0, waiting for it '
+                             'to settle')
+
+    @mock.patch(ADAPTOR_MODULE + ".time")
+    @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._sleep")
+    @mock.patch(ADAPTOR_CLASS + "._get_domain")
+    @mock.patch(ADAPTOR_CLASS + "._is_running")
+    @mock.patch(ADAPTOR_CLASS + "._is_defined")
+    def test_force_stop_destroys_domain_not_settled(self, _is_def,
+            _is_run, _get_dom, _sleep, _log, _time):
+        _is_def.return_value = True
+        _is_run.return_value = True
+        _time.time.side_effect = [100, 101, 106]
+        _get_dom.return_value.info.return_value = [VIR_DOMAIN_SHUTDOWN]
+        self.adaptor.conf.conf = {'adaptor_data': {'force-stop-wait': 5}}
+        self.assertEquals(0, self.adaptor._force_stop())
+        _sleep.assert_called_once_with(0.2)
+        _get_dom.return_value.destroy.assert_called_once_with()
+        _log.assert_any_call('Domain "unittest" did not settle in time, '
+                             'state is 4')
+
+    def test_get_force_stop_wait(self):
+        self.adaptor.conf.conf = {'adaptor_data': {'force-stop-wait': '10'}}
+        self.assertEquals(10.0, self.adaptor._get_force_stop_wait())
+        self.adaptor.conf.conf = {'adaptor_data': {}}
+        self.assertEquals(5, self.adaptor._get_force_stop_wait())
+        self.adaptor.conf.conf = {}
+        self.assertEquals(5, self.adaptor._get_force_stop_wait())
 
     @mock.patch(ADAPTOR_MODULE + ".log")
     @mock.patch(ADAPTOR_CLASS + "._get_domain")
@@ -374,6 +403,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _is_run.return_value = True
 
         domain = mock.Mock()
+        domain.info.return_value = [VIR_DOMAIN_RUNNING]
         _get_dom.return_value = domain
 
         def raise_exception():
@@ -403,10 +433,12 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         LVcloudinit.get_disk_mounts.return_value=[]
         LVxml.return_value.build_machine_xml.return_value = xml
         self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
         self.adaptor._define()
 
         c_args, c_kwargs = LVxml.call_args
         self.assertEqual(c_args, ("unittest",))
+        self.assertTrue(c_kwargs['conf'] is self.adaptor.conf)
         conn.defineXML.assert_called_once_with(xml)
         _log.assert_any_call('Defining Domain "unittest"')
         _log.assert_any_call('Adding XML definition for Domain "unittest"')
@@ -422,6 +454,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         c_init_instance = mock.Mock()
         LVcloudinit.return_value = c_init_instance
         self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
         self.adaptor._define()
 
         c_args, c_kwargs = LVcloudinit.call_args
@@ -442,6 +475,8 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         img_inst = mock.Mock()
         LVimg.return_value = img_inst
         self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
+        self.adaptor.conf.restore_last_undefined_vm.return_value = False
         self.adaptor._define()
 
         LVimg.assert_called_once_with("unittest", "unittest.qcow2")
@@ -449,6 +484,24 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _log.assert_any_call('Copying base image "unittest.qcow2" to instance directory '
                 'for Domain "unittest"')
 
+    @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_cloud_init")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_xml")
+    @mock.patch(ADAPTOR_MODULE + ".get_handle")
+    @mock.patch(ADAPTOR_CLASS + "._get_image_name")
+    def test_define_restores_image(self, _get_img, connector, LVxml, LVimg,
+            LVcloudinit, _log):
+        _get_img.return_value = "unittest.qcow2"
+        self.adaptor.conf = mock.Mock()
+        self.adaptor.conf.get_adaptor_data.return_value = {}
+        self.adaptor.conf.restore_last_undefined_vm.return_value = True
+        self.adaptor._define()
+
+        self.assertEqual(0, LVimg.return_value.copy_image.call_count)
+        connector.return_value.defineXML.assert_called_once_with(
+            LVxml.return_value.build_machine_xml.return_value)
+
     @mock.patch(ADAPTOR_MODULE + ".LITP_LIBVIRT_SUCCESS")
     @mock.patch(ADAPTOR_MODULE + ".log")
     @mock.patch(ADAPTOR_CLASS + "._is_running")
@@ -701,6 +754,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _get_domain.return_value.shutdown.assert_called_once_with()
 
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._check_hugepages", mock.Mock(return_value=[]))
     @mock.patch(ADAPTOR_CLASS + "._check_disk_images")
     def test_check_startup_requirements_logs_error(self, chk_dsk, _log):
         error = mock.Mock()
@@ -709,6 +763,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _log.assert_any_call(error, level="ERROR", echo=True)
 
     @mock.patch(ADAPTOR_MODULE + ".log")
+    @mock.patch(ADAPTOR_CLASS + "._check_hugepages", mock.Mock(return_value=[]))
     @mock.patch(ADAPTOR_CLASS + "._check_disk_images")
     def test_check_startup_requirements_does_not_log_if_clean(self, chk_dsk,
             _log):
@@ -749,11 +804,12 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         live_image.assert_called_once()
         self.assertEquals(0, base_image.call_count)
 
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_image_registry")
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     @mock.patch(ADAPTOR_CLASS + "._get_image_name")
     def test_check_disk_images_check_base_if_not_defined(self, _get_img,
-            _is_def, _img):
+            _is_def, _img, _registry):
         _is_def.return_value = False
         mach_image = mock.Mock()
         base_image = mock.Mock()
@@ -761,6 +817,7 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         _img.return_value.base_image_exists = base_image
         mach_image.return_value = True
         base_image.return_value = True
+        _registry.return_value.verify.return_value = None
 
         self.assertEquals([], self.adaptor._check_disk_images())
         base_image.assert_called_once()
@@ -777,15 +834,17 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         live_image.return_value = True
         self.assertEquals([], self.adaptor._check_disk_images())
 
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_image_registry")
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     @mock.patch(ADAPTOR_CLASS + "._get_image_name")
     def test_check_disk_images_return_empty_if_not_issue_undef(self,
-            _get_img, _is_def, _img):
+            _get_img, _is_def, _img, _registry):
         _is_def.return_value = False
         base_image = mock.Mock()
         _img.return_value.base_image_exists = base_image
         base_image.return_value = True
+        _registry.return_value.verify.return_value = None
         self.assertEquals([], self.adaptor._check_disk_images())
 
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
@@ -814,6 +873,23 @@ class TestLitpLibVirtAdaptor(unittest.TestCase):
         self.assertEquals(['Base image for Domain "unittest" does not '
             'exist'], self.adaptor._check_disk_images())
 
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_image_registry")
+    @mock.patch(ADAPTOR_MODULE + ".Libvirt_vm_image")
+    @mock.patch(ADAPTOR_CLASS + "._is_defined")
+    @mock.patch(ADAPTOR_CLASS + "._get_image_name")
+    def test_check_disk_images_return_message_if_base_corrupt(self,
+            _get_img, _is_def, _img, _registry):
+        _get_img.return_value = "unittest.qcow2"
+        _is_def.return_value = False
+        _img.return_value.base_image_exists.return_value = True
+        _registry.return_value.verify.return_value = 'it is truncated'
+
+        self.assertEquals(['Base image "unittest.qcow2" for Domain "unittest" '
+            'cannot be used, it is truncated'],
+            self.adaptor._check_disk_images())
+        _registry.return_value.verify.assert_called_once_with(
+            "unittest.qcow2")
+
     @mock.patch(ADAPTOR_CLASS + "._is_defined")
     @mock.patch(ADAPTOR_MODULE + ".Libvirt_cloud_init")
     def test_check_config_changed_no_conf_live(self, LVcloudinit, _is_def):
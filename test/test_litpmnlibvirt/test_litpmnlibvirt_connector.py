@@ -8,7 +8,10 @@
 # program(s) have been supplied.
 ##############################################################################
 
-from litpmnlibvirt.litp_libvirt_connector import get_handle
+from litpmnlibvirt.litp_libvirt_connector import (get_handle, register_driver,
+                                                  _drivers, _tracer,
+                                                  get_tracer, LibvirtTracer,
+                                                  TracingProxy)
 from litpmnlibvirt.litp_libvirt_connector import URI as libvirt_connector_URI
 
 import unittest
@@ -50,3 +53,89 @@ class TestLitpLibVirtConnector(unittest.TestCase):
         self.assertFalse(conn1 is conn2)
         lvpatch.assert_any_call("foo")
         lvpatch.assert_any_call("bar")
+
+    @mock.patch("libvirt.open")
+    def test_connector_opens_registered_driver(self, lvpatch):
+        opener = mock.Mock()
+        with mock.patch.dict(_drivers):
+            register_driver("fake", opener)
+            conn = get_handle("fake:///")
+            self.assertTrue(conn is opener.return_value)
+            self.assertTrue(conn is get_handle("fake:///"))
+            get_handle("qemu:///system")
+        opener.assert_called_once_with("fake:///")
+        lvpatch.assert_called_once_with("qemu:///system")
+
+    @mock.patch("libvirt.open")
+    def test_connector_default_URI_from_environment(self, lvpatch):
+        with mock.patch.dict("os.environ", {"LITP_LIBVIRT_URI": "test:///"}):
+            get_handle()
+        lvpatch.assert_called_once_with("test:///")
+
+
+class TestLibvirtTracer(unittest.TestCase):
+    def setUp(self):
+        get_handle.clear()
+        del _tracer[:]
+
+    def tearDown(self):
+        get_handle.clear()
+        del _tracer[:]
+
+    def test_tracing_disabled_by_default(self):
+        with mock.patch.dict("os.environ", {}, clear=True):
+            self.assertEqual(None, get_tracer())
+
+    @mock.patch("libvirt.open")
+    def test_get_handle_traces_when_enabled(self, lvpatch):
+        with mock.patch.dict("os.environ", {"LITP_LIBVIRT_TRACE": "1"}):
+            conn = get_handle("foo")
+            tracer = get_tracer()
+        self.assertTrue(isinstance(conn, TracingProxy))
+        lvpatch.return_value.getCapabilities.return_value = '<caps/>'
+        self.assertEqual('<caps/>', conn.getCapabilities())
+        self.assertEqual(1, tracer.count('getCapabilities'))
+
+    def test_proxy_wraps_returned_domains(self):
+        tracer = LibvirtTracer()
+        conn = mock.Mock()
+        dom = mock.Mock()
+        dom.info.return_value = [1, 0, 0, 1, 0]
+        conn.listAllDomains.return_value = [dom]
+        conn.lookupByName.return_value = dom
+        proxy = TracingProxy(conn, tracer)
+
+        self.assertEqual(1, proxy.listAllDomains(0)[0].info()[0])
+        proxy.lookupByName('vm1').info()
+        self.assertEqual(['listAllDomains', 'dom.info', 'lookupByName',
+                          'dom.info'], [c[0] for c in tracer.calls])
+        self.assertTrue(tracer.calls[0][2].startswith(
+            'test_litpmnlibvirt_connector.py:test_proxy_wraps_returned_'
+            'domains:'))
+
+    def test_proxy_records_failed_calls(self):
+        tracer = LibvirtTracer()
+        conn = mock.Mock()
+        conn.lookupByName.side_effect = ValueError
+        self.assertRaises(ValueError, TracingProxy(conn, tracer).lookupByName,
+                          'vm1')
+        self.assertEqual(1, tracer.count('lookupByName'))
+
+    @mock.patch("litpmnlibvirt.litp_libvirt_connector.time")
+    def test_summary(self, _time):
+        _time.time.side_effect = [10.0, 10.5, 11.0, 11.25, 12.0, 12.25]
+        tracer = LibvirtTracer()
+        proxy = TracingProxy(mock.Mock(), tracer)
+        for _ in range(2):
+            proxy.listAllDomains(0)
+        proxy.getCapabilities()
+        summary = tracer.summary()
+        self.assertEqual(3, summary['calls'])
+        self.assertEqual(1000.0, summary['ms'])
+        self.assertEqual({'listAllDomains': {'calls': 2, 'ms': 750.0},
+                          'getCapabilities': {'calls': 1, 'ms': 250.0}},
+                         summary['methods'])
+        self.assertEqual([2, 1], sorted(summary['callers'].values(),
+                                        reverse=True))
+        tracer.reset()
+        self.assertEqual(0, tracer.summary()['calls'])
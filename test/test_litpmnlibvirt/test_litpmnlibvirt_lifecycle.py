@@ -0,0 +1,192 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+os.environ["TESTING_FLAG"] = "1"
+from libvirt import VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTOFF
+
+from litpmnlibvirt import litp_libvirt_connector
+from litpmnlibvirt.litp_libvirt_adaptor import LitpLibVirtAdaptor
+from litpmnlibvirt.litp_libvirt_connector import get_handle, get_tracer
+from litpmnlibvirt.litp_libvirt_timing import ActionTimer
+from test_litpmnlibvirt.fake_libvirt import FakeHost
+
+
+class TestLitpLibvirtLifecycle(unittest.TestCase):
+    """
+    Runs adaptor actions end to end against the in-memory hypervisor.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.host = FakeHost(self.root).__enter__()
+        self.host.add_instance('vm1')
+        self.stdout = mock.patch.object(sys, 'stdout')
+        self.stdout.start()
+
+    def tearDown(self):
+        self.stdout.stop()
+        self.host.__exit__(None, None, None)
+        shutil.rmtree(self.root)
+
+    def _adaptor(self):
+        return LitpLibVirtAdaptor('vm1', base_os='6')
+
+    def test_start_defines_and_runs_domain(self):
+        self.assertEqual(0, self._adaptor().start())
+        dom = self.host.conn.domains['vm1']
+        self.assertEqual(VIR_DOMAIN_RUNNING, dom.state)
+        self.assertTrue('<name>vm1</name>' in dom.xml)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.host.conf_path, 'vm1', FakeHost.IMAGE_NAME)))
+        self.assertEqual(0, self._adaptor().status())
+
+        calls = dict(self.host.conn.calls)
+        self.assertEqual(0, self._adaptor().start())
+        self.assertEqual(calls['create'], self.host.conn.calls['create'])
+
+    def test_stop_and_start_again(self):
+        self._adaptor().start()
+        self.assertEqual(0, self._adaptor().stop())
+        self.assertEqual(VIR_DOMAIN_SHUTOFF,
+                         self.host.conn.domains['vm1'].state)
+        self.assertEqual(1, self._adaptor().status())
+        self.assertEqual(0, self._adaptor().start())
+        self.assertEqual(1, self.host.conn.calls['defineXML'])
+
+    def test_config_change_redefines_domain(self):
+        self._adaptor().start()
+        self.host.write_config('vm1', ram='512M')
+        self.assertEqual(0, self._adaptor().start())
+        self.assertEqual(2, self.host.conn.calls['defineXML'])
+        self.assertTrue('>512<' in self.host.conn.domains['vm1'].xml)
+
+    def test_config_change_of_replaced_base_image_redefines_domain(self):
+        self._adaptor().start()
+        self.host.write_config('vm1', adaptor_data={'disk_mounts': [],
+                                                    'start-timeout': 60})
+        self.assertEqual(0, self._adaptor().start())
+        self.assertEqual(1, self.host.conn.calls['defineXML'])
+
+        base_image = os.path.join(self.host.image_path, FakeHost.IMAGE_NAME)
+        with open(base_image + '.new', 'w') as f:
+            f.write('new base image')
+        os.rename(base_image + '.new', base_image)
+        self.host.write_config('vm1', adaptor_data={'disk_mounts': [],
+                                                    'start-timeout': 90})
+        self.assertEqual(0, self._adaptor().start())
+        self.assertEqual(2, self.host.conn.calls['defineXML'])
+        with open(os.path.join(self.host.conf_path, 'vm1',
+                               FakeHost.IMAGE_NAME)) as f:
+            self.assertEqual('new base image', f.read())
+
+    def test_force_stop_undefine_removes_domain(self):
+        self._adaptor().start()
+        self.assertEqual(0, self._adaptor().force_stop_undefine())
+        self.assertFalse('vm1' in self.host.conn.domains)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.host.conf_path, 'vm1', FakeHost.IMAGE_NAME)))
+
+    def test_redeploy_restores_image_of_same_config(self):
+        self._adaptor().start()
+        image_file = os.path.join(self.host.conf_path, 'vm1',
+                                  FakeHost.IMAGE_NAME)
+        with open(image_file, 'a') as f:
+            f.write('guest data')
+        self._adaptor().force_stop_undefine()
+        self.assertEqual(0, self._adaptor().start())
+        with open(image_file) as f:
+            self.assertTrue(f.read().endswith('guest data'))
+
+        # A different config starts from the base image
+        self._adaptor().force_stop_undefine()
+        self.host.write_config('vm1', ram='512M')
+        self.assertEqual(0, self._adaptor().start())
+        self.assertEqual(self.host.image_size, os.path.getsize(image_file))
+
+    def test_storage_pool_volumes(self):
+        self.host.add_pool('images', path=self.host.image_path)
+        pool = self.host.add_pool('vms')
+        self.host.write_config('vm1', adaptor_data={'disk_mounts': [],
+                                                    'storage-pool': 'vms'})
+        self.assertEqual(0, self._adaptor().start())
+        volume = pool.volumes['vm1-' + FakeHost.IMAGE_NAME]
+        self.assertEqual(self.host.image_size, volume.capacity)
+        self.assertEqual(1, self.host.conn.calls['pool.createXMLFrom'])
+        xml = self.host.conn.domains['vm1'].xml
+        self.assertTrue('<source pool="vms" volume="vm1-{0}" />'.format(
+            FakeHost.IMAGE_NAME) in xml)
+        self.assertTrue('type="qcow2"' in xml)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.host.conf_path, 'vm1', FakeHost.IMAGE_NAME)))
+        self.assertEqual(0, self._adaptor().status())
+
+        self.assertEqual(0, self._adaptor().force_stop_undefine())
+        self.assertEqual({}, pool.volumes)
+        # The config files are still backed up without the image
+        backup_dir = os.path.join(self.host.conf_path, 'vm1',
+                                  'last_undefined_vm')
+        self.assertEqual(['config.json.live', 'meta-data.live',
+                          'network-config.live', 'user-data.live'],
+                         sorted(fn.rsplit('-', 1)[0]
+                                for fn in os.listdir(backup_dir)
+                                if fn != 'index.json'))
+
+    def test_logical_pool_snapshots_base_volume(self):
+        pool = self.host.add_pool('vg', pool_type='logical')
+        base = pool.add_volume(FakeHost.IMAGE_NAME, 4096)
+        self.host.write_config('vm1', adaptor_data={'disk_mounts': [],
+                                                    'storage-pool': 'vg'})
+        self.assertEqual(0, self._adaptor().start())
+        volume = pool.volumes['vm1-' + FakeHost.IMAGE_NAME]
+        self.assertEqual(base.path(), volume.backing)
+        self.assertTrue('type="raw"' in self.host.conn.domains['vm1'].xml)
+
+        # A config change replaces the volume
+        self.host.write_config('vm1', ram='512M',
+                               adaptor_data={'disk_mounts': [],
+                                             'storage-pool': 'vg'})
+        self.assertEqual(0, self._adaptor().start())
+        self.assertEqual(2, self.host.conn.calls['pool.createXML'])
+        self.assertEqual(2, len(pool.volumes))
+
+    def test_missing_base_volume(self):
+        self.host.add_pool('vms')
+        self.host.write_config('vm1', adaptor_data={'disk_mounts': [],
+                                                    'storage-pool': 'vms'})
+        self.assertEqual(3, self._adaptor().start())
+        self.assertFalse('vm1' in self.host.conn.domains)
+
+    def test_libvirt_calls_per_action(self):
+        # Guards against RPC amplification, raise the limits only for
+        # calls that are needed
+        self._adaptor().start()
+        with mock.patch.dict(os.environ, {'LITP_LIBVIRT_TRACE': '1'}):
+            get_handle.clear()
+            try:
+                with ActionTimer('vm1', 'status'):
+                    self._adaptor().status()
+                tracer = get_tracer()
+                self.assertEqual(2, tracer.count('listAllDomains'))
+                self.assertEqual(4, tracer.count())
+                with ActionTimer('vm1', 'stop'):
+                    self._adaptor().stop()
+                self.assertEqual(1, tracer.count('dom.shutdown'))
+                self.assertEqual(6, tracer.count())
+            finally:
+                del litp_libvirt_connector._tracer[:]
+                get_handle.clear()
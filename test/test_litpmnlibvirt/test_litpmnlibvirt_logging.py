@@ -0,0 +1,169 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import logging
+import os
+import unittest
+from StringIO import StringIO
+
+import mock
+
+os.environ["TESTING_FLAG"] = "1"
+from litpmnlibvirt import litp_libvirt_logging
+from litpmnlibvirt.litp_libvirt_logging import (LazyMessage,
+                                                LitpQueueHandler,
+                                                configure_logging,
+                                                flush_logging,
+                                                get_handler_fds,
+                                                install_queue_handler,
+                                                reinit_logging_after_fork)
+
+
+class TestLazyMessage(unittest.TestCase):
+    def test_str(self):
+        self.assertEqual('vm1 took 1.50s',
+                         str(LazyMessage('{0} took {1:.2f}s', ('vm1', 1.5))))
+
+    def test_not_formatted_until_written(self):
+        arg = mock.MagicMock()
+        arg.__str__.return_value = 'x'
+        msg = LazyMessage('{0!s}', (arg,))
+        self.assertEqual(0, arg.__str__.call_count)
+        self.assertEqual('x', str(msg))
+
+
+class TestLitpQueueHandler(unittest.TestCase):
+    def setUp(self):
+        self.stream = StringIO()
+        self.target = logging.StreamHandler(self.stream)
+        self.target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.logger = logging.getLogger('litp_libvirt_test')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.logger.addHandler(self.target)
+
+    def tearDown(self):
+        for handler in self.logger.handlers[:]:
+            self.logger.removeHandler(handler)
+
+    @mock.patch('atexit.register')
+    def test_install_queue_handler(self, mock_register):
+        handler = install_queue_handler(self.logger)
+        self.assertEqual([handler], self.logger.handlers)
+        self.assertEqual([self.target], handler.handlers)
+        mock_register.assert_called_once_with(handler.flush)
+
+        self.logger.info(LazyMessage('{0} started', ('vm1',)))
+        self.logger.debug('polling')
+        handler.flush()
+        self.assertEqual('INFO vm1 started\nDEBUG polling\n',
+                         self.stream.getvalue())
+
+        # A new writer thread is started after a flush
+        self.logger.error('failed')
+        handler.flush()
+        self.assertTrue(self.stream.getvalue().endswith('ERROR failed\n'))
+
+    def test_install_queue_handler_without_handlers(self):
+        self.assertEqual(None,
+                         install_queue_handler(logging.getLogger('empty')))
+
+    def test_target_level(self):
+        self.target.setLevel(logging.INFO)
+        handler = LitpQueueHandler([self.target])
+        handler.handle(self.logger.makeRecord('test', logging.DEBUG, '', 0,
+                                              'hidden', (), None))
+        handler.handle(self.logger.makeRecord('test', logging.INFO, '', 0,
+                                              'shown', (), None))
+        handler.close()
+        self.assertEqual('INFO shown\n', self.stream.getvalue())
+
+    @mock.patch('os.getpid')
+    def test_restarts_writer_after_fork(self, mock_getpid):
+        handler = LitpQueueHandler([self.target])
+        mock_getpid.return_value = 100
+        handler.handle(self.logger.makeRecord('test', logging.INFO, '', 0,
+                                              'parent', (), None))
+        handler.flush()
+        parent_thread = handler._thread
+        mock_getpid.return_value = 101
+        handler.handle(self.logger.makeRecord('test', logging.INFO, '', 0,
+                                              'child', (), None))
+        self.assertFalse(parent_thread is handler._thread)
+        handler.flush()
+        self.assertEqual('INFO parent\nINFO child\n', self.stream.getvalue())
+
+
+    def test_after_fork(self):
+        handler = LitpQueueHandler([self.target])
+        handler.handle(self.logger.makeRecord('test', logging.INFO, '', 0,
+                                              'parent', (), None))
+        locks = (handler.lock, handler._lock, self.target.lock)
+        handler.after_fork()
+        self.assertEqual(None, handler._pid)
+        for old, new in zip(locks, (handler.lock, handler._lock,
+                                    self.target.lock)):
+            self.assertFalse(old is new)
+        handler.handle(self.logger.makeRecord('test', logging.INFO, '', 0,
+                                              'child', (), None))
+        handler.flush()
+        self.assertTrue(self.stream.getvalue().endswith('INFO child\n'))
+
+class TestConfigureLogging(unittest.TestCase):
+    def tearDown(self):
+        del litp_libvirt_logging._configured[:]
+
+    @mock.patch('logging.config.fileConfig')
+    def test_configure_logging_once(self, mock_file_config):
+        del litp_libvirt_logging._configured[:]
+        with mock.patch.dict(os.environ, {'TESTING_FLAG': ''}):
+            with mock.patch.object(litp_libvirt_logging,
+                                   'install_queue_handler') as mock_install:
+                configure_logging()
+                configure_logging()
+        mock_file_config.assert_called_once_with(
+            '/etc/litp_libvirt_logging.conf')
+        mock_install.assert_called_once_with(
+            logging.getLogger('litp_libvirt'))
+
+    @mock.patch('logging.config.fileConfig')
+    def test_no_configuration_in_unit_tests(self, mock_file_config):
+        del litp_libvirt_logging._configured[:]
+        configure_logging()
+        self.assertEqual(0, mock_file_config.call_count)
+
+    def test_get_handler_fds(self):
+        file_handler = mock.Mock(spec=['stream'])
+        file_handler.stream.fileno.return_value = 7
+        syslog_handler = mock.Mock(spec=['socket'])
+        syslog_handler.socket.fileno.return_value = 9
+        closed_handler = mock.Mock(spec=['stream'])
+        closed_handler.stream.fileno.side_effect = ValueError()
+        queue_handler = LitpQueueHandler([syslog_handler, closed_handler])
+        logger = logging.getLogger('litp_libvirt')
+        with mock.patch.object(logger, 'handlers',
+                               [file_handler, queue_handler]):
+            self.assertEqual([7, 9], get_handler_fds())
+
+    def test_reinit_logging_after_fork(self):
+        queue_handler = mock.Mock(spec=LitpQueueHandler)
+        handler = mock.Mock()
+        logger = logging.getLogger('litp_libvirt')
+        with mock.patch.object(logger, 'handlers', [queue_handler, handler]):
+            reinit_logging_after_fork()
+        queue_handler.after_fork.assert_called_once_with()
+        handler.createLock.assert_called_once_with()
+
+    def test_flush_logging(self):
+        handler = mock.Mock()
+        logger = logging.getLogger('litp_libvirt')
+        with mock.patch.object(logger, 'handlers', [handler]):
+            flush_logging()
+        handler.flush.assert_called_once_with()
@@ -0,0 +1,110 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+os.environ["TESTING_FLAG"] = "1"
+from litpmnlibvirt import litp_libvirt_metrics as metrics
+
+METRICS_MODULE = 'litpmnlibvirt.litp_libvirt_metrics'
+
+
+class TestLitpLibvirtMetrics(unittest.TestCase):
+    def setUp(self):
+        del metrics._pending[:]
+        self.tmp_dir = tempfile.mkdtemp()
+        self.textfile_dir = os.path.join(self.tmp_dir, 'textfile_collector')
+        os.mkdir(self.textfile_dir)
+        self.state_file = os.path.join(self.tmp_dir, 'metrics.json')
+        self.patches = [
+            mock.patch(METRICS_MODULE + '.METRICS_TEXTFILE_DIR',
+                       self.textfile_dir),
+            mock.patch(METRICS_MODULE + '.METRICS_STATE_FILE',
+                       self.state_file)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        del metrics._pending[:]
+        shutil.rmtree(self.tmp_dir)
+
+    def _textfile(self):
+        with open(os.path.join(self.textfile_dir, 'litp_libvirt.prom')) as f:
+            return f.read()
+
+    def test_flush_counters(self):
+        metrics.inc('litp_libvirt_force_stop_retries_total',
+                    {'instance': 'vm1'})
+        metrics.inc('litp_libvirt_force_stop_retries_total',
+                    {'instance': 'vm1'}, 2)
+        metrics.flush()
+        metrics.inc('litp_libvirt_force_stop_retries_total',
+                    {'instance': 'vm1'})
+        metrics.flush()
+        self.assertEqual(
+            '# HELP litp_libvirt_force_stop_retries_total Force-stops that '
+            'waited for the domain state to settle.\n'
+            '# TYPE litp_libvirt_force_stop_retries_total counter\n'
+            'litp_libvirt_force_stop_retries_total{instance="vm1"} 4\n',
+            self._textfile())
+        self.assertEqual([], metrics._pending)
+        self.assertEqual([], [f for f in os.listdir(self.textfile_dir)
+                              if f.startswith('.')])
+
+    def test_flush_histogram(self):
+        labels = {'instance': 'vm1', 'action': 'start'}
+        metrics.observe('litp_libvirt_action_duration_seconds', labels, 7)
+        metrics.observe('litp_libvirt_action_duration_seconds', labels, 700)
+        metrics.flush()
+        lines = self._textfile().splitlines()
+        self.assertTrue('litp_libvirt_action_duration_seconds_bucket'
+                        '{action="start",instance="vm1",le="5"} 0' in lines)
+        self.assertTrue('litp_libvirt_action_duration_seconds_bucket'
+                        '{action="start",instance="vm1",le="10"} 1' in lines)
+        self.assertTrue('litp_libvirt_action_duration_seconds_bucket'
+                        '{action="start",instance="vm1",le="+Inf"} 2' in lines)
+        self.assertTrue('litp_libvirt_action_duration_seconds_sum'
+                        '{action="start",instance="vm1"} 707' in lines)
+        self.assertTrue('litp_libvirt_action_duration_seconds_count'
+                        '{action="start",instance="vm1"} 2' in lines)
+
+    def test_flush_without_textfile_dir(self):
+        shutil.rmtree(self.textfile_dir)
+        metrics.inc('litp_libvirt_config_changes_total',
+                    {'instance': 'vm1', 'redefined': 'true'})
+        metrics.flush()
+        self.assertFalse(os.path.exists(self.state_file))
+        self.assertEqual([], metrics._pending)
+
+    @mock.patch(METRICS_MODULE + '.log')
+    def test_flush_discards_corrupt_state(self, mock_log):
+        with open(self.state_file, 'w') as f:
+            f.write('{not json')
+        metrics.inc('litp_libvirt_internal_status_checks_total',
+                    {'instance': 'vm1', 'result': 'ok'})
+        metrics.flush()
+        with open(self.state_file) as f:
+            self.assertEqual(
+                {'litp_libvirt_internal_status_checks_total':
+                     {'instance="vm1",result="ok"': 1}},
+                json.load(f))
+        self.assertEqual('ERROR', mock_log.call_args[1]['level'])
+
+    def test_label_escaping(self):
+        self.assertEqual('instance="a\\"b\\\\c"',
+                         metrics._label_str({'instance': 'a"b\\c'}))
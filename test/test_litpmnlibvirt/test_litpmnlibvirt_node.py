@@ -0,0 +1,367 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import os
+import sys
+import unittest
+
+import mock
+from libvirt import VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTOFF, libvirtError
+
+os.environ["TESTING_FLAG"] = "1"
+from litpmnlibvirt.litp_libvirt_node import LitpLibvirtNode, _main
+from litpmnlibvirt.litp_libvirt_platform import Platform
+
+NODE_MODULE = 'litpmnlibvirt.litp_libvirt_node'
+NODE_CLASS = NODE_MODULE + '.LitpLibvirtNode'
+
+
+def make_domain(name, states):
+    dom = mock.Mock()
+    dom.name.return_value = name
+    dom.info.side_effect = [[state] for state in states]
+    return dom
+
+
+class TestLitpLibvirtNodeDrain(unittest.TestCase):
+    def setUp(self):
+        self.node = LitpLibvirtNode(platform=Platform('7', 'systemd'))
+        self.node._sleep = mock.Mock()
+        self.patches = [mock.patch(NODE_MODULE + '.log'),
+                        mock.patch(NODE_MODULE + '.echo_success'),
+                        mock.patch(NODE_MODULE + '.echo_failure'),
+                        mock.patch(NODE_MODULE + '.metrics'),
+                        mock.patch(NODE_MODULE + '.Libvirt_systemd')]
+        (self.log, self.echo_success, self.echo_failure, self.metrics,
+         self.systemd) = [patch.start() for patch in self.patches]
+        self.systemd.run_jobs.side_effect = \
+            lambda action, names: dict((name, 0) for name in names)
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    @mock.patch(NODE_CLASS + '._running_domains')
+    def test_drain_nothing_running(self, running):
+        running.return_value = []
+        self.assertEqual(0, self.node.drain())
+        self.assertEqual(0, self.systemd.run_jobs.call_count)
+
+    @mock.patch('time.time')
+    @mock.patch(NODE_CLASS + '._running_domains')
+    def test_drain_shuts_down_all_at_once(self, running, mock_time):
+        mock_time.return_value = 100
+        vm1 = make_domain('vm1', [VIR_DOMAIN_RUNNING, VIR_DOMAIN_SHUTOFF])
+        vm2 = make_domain('vm2', [VIR_DOMAIN_SHUTOFF])
+        running.return_value = [vm1, vm2]
+
+        self.assertEqual(0, self.node.drain(timeout=60))
+        vm1.shutdown.assert_called_once_with()
+        vm2.shutdown.assert_called_once_with()
+        self.assertEqual(0, vm1.destroy.call_count)
+        self.assertEqual(0, vm2.destroy.call_count)
+        self.node._sleep.assert_called_once_with(1)
+        self.systemd.run_jobs.assert_called_once_with('stop', ['vm1', 'vm2'])
+        self.assertEqual([mock.call('Service drain for "vm1"'),
+                          mock.call('Service drain for "vm2"')],
+                         self.echo_success.call_args_list)
+
+    @mock.patch('time.time')
+    @mock.patch(NODE_CLASS + '._running_domains')
+    def test_drain_destroys_stragglers_at_deadline(self, running, mock_time):
+        # deadline, then one check round per poll
+        mock_time.side_effect = [100, 100, 101, 131, 161]
+        vm1 = make_domain('vm1', [VIR_DOMAIN_SHUTOFF])
+        vm2 = make_domain('vm2', [VIR_DOMAIN_RUNNING] * 3)
+        vm2.destroy.side_effect = libvirtError('busy')
+        running.return_value = [vm1, vm2]
+
+        self.assertEqual(1, self.node.drain(timeout=60))
+        self.assertEqual(0, vm1.destroy.call_count)
+        vm2.destroy.assert_called_once_with()
+        # ACPI resent once after SECONDS_BEFORE_SHUTDOWN_RETRY
+        self.assertEqual(2, vm2.shutdown.call_count)
+        self.metrics.inc.assert_called_once_with(
+            'litp_libvirt_force_stop_fallbacks_total', {'instance': 'vm2'})
+        self.echo_success.assert_called_once_with('Service drain for "vm1"')
+        self.echo_failure.assert_called_once_with('Service drain for "vm2"')
+
+    @mock.patch(NODE_CLASS + '._wait_for_shutdown')
+    @mock.patch(NODE_CLASS + '._get_stop_timeout')
+    @mock.patch(NODE_CLASS + '._running_domains')
+    def test_drain_timeout_from_config(self, running, stop_timeout, wait):
+        running.return_value = [make_domain('vm1', []),
+                                make_domain('vm2', [])]
+        stop_timeout.side_effect = [0, 0, 120, 30]
+        wait.return_value = []
+        with mock.patch('time.time', mock.Mock(return_value=100)):
+            self.node.drain()
+            self.assertEqual(400, wait.call_args[0][1])
+            self.node.drain()
+            self.assertEqual(220, wait.call_args[0][1])
+
+    @mock.patch(NODE_CLASS + '._running_domains')
+    def test_drain_sysv(self, running):
+        self.node = LitpLibvirtNode(platform=Platform('6', 'sysv'))
+        running.return_value = [make_domain('vm1', [VIR_DOMAIN_SHUTOFF])]
+        self.assertEqual(0, self.node.drain(timeout=10))
+        self.assertEqual(0, self.systemd.run_jobs.call_count)
+
+    @mock.patch(NODE_MODULE + '.get_handle')
+    @mock.patch(NODE_MODULE + '.Libvirt_conf')
+    def test_running_domains_only_managed(self, conf, get_handle):
+        vm1 = make_domain('vm1', [])
+        other = make_domain('other', [])
+        get_handle.return_value.listAllDomains.return_value = [vm1, other]
+        conf.side_effect = lambda name: mock.Mock(
+            conf_live_exists=mock.Mock(return_value=name == 'vm1'))
+        self.assertEqual([vm1], self.node._running_domains())
+
+
+class FakeProcess(object):
+    def __init__(self, polls):
+        self.polls = list(polls)
+        self.killed = False
+
+    def poll(self):
+        return self.polls.pop(0)
+
+    def kill(self):
+        self.killed = True
+
+    def wait(self):
+        return -9
+
+
+class TestLitpLibvirtNodeStartAll(unittest.TestCase):
+    def setUp(self):
+        self.node = LitpLibvirtNode(platform=Platform('7', 'systemd'))
+        self.node._sleep = mock.Mock()
+        self.patches = [mock.patch(NODE_MODULE + '.log'),
+                        mock.patch(NODE_MODULE + '.echo_success'),
+                        mock.patch(NODE_MODULE + '.echo_failure'),
+                        mock.patch(NODE_CLASS + '._get_io_pressure'),
+                        mock.patch(NODE_CLASS + '._get_start_after'),
+                        mock.patch(NODE_CLASS + '._start_instance')]
+        (self.log, self.echo_success, self.echo_failure, self.pressure,
+         self.start_after, self.start_instance) = \
+            [patch.start() for patch in self.patches]
+        self.pressure.return_value = 0.0
+        self.deps = {}
+        self.start_after.side_effect = lambda name: self.deps.get(name, [])
+        self.procs = {}
+        self.started = []
+
+        def start_instance(name):
+            self.started.append(name)
+            return self.procs[name]
+        self.start_instance.side_effect = start_instance
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_concurrency_window(self):
+        self.procs = {'vm1': FakeProcess([None, 0]),
+                      'vm2': FakeProcess([None, None, 0]),
+                      'vm3': FakeProcess([0])}
+        self.assertEqual(0, self.node.start_all(['vm1', 'vm2', 'vm3'],
+                                                concurrency=2))
+        self.assertEqual(['vm1', 'vm2', 'vm3'], self.started)
+        # vm3 is only admitted once vm1 has finished
+        self.assertEqual(3, self.node._sleep.call_count)
+        self.assertEqual(3, self.echo_success.call_count)
+
+    def test_dependencies(self):
+        self.deps = {'vm1': ['db'], 'vm2': ['unmanaged']}
+        self.procs = {'db': FakeProcess([None, 0]),
+                      'vm1': FakeProcess([0]),
+                      'vm2': FakeProcess([0])}
+        self.assertEqual(0, self.node.start_all(['vm1', 'vm2', 'db'],
+                                                concurrency=3))
+        self.assertEqual(['vm2', 'db', 'vm1'], self.started)
+
+    def test_failed_dependency(self):
+        self.deps = {'vm1': ['db'], 'vm2': ['vm1']}
+        self.procs = {'db': FakeProcess([1])}
+        self.assertEqual(1, self.node.start_all(['db', 'vm1', 'vm2']))
+        self.assertEqual(['db'], self.started)
+        self.assertEqual([mock.call('Service start-all for "db"'),
+                          mock.call('Service start-all for "vm1"'),
+                          mock.call('Service start-all for "vm2"')],
+                         self.echo_failure.call_args_list)
+
+    def test_dependency_cycle(self):
+        self.deps = {'vm1': ['vm2'], 'vm2': ['vm1']}
+        self.procs = {'vm3': FakeProcess([0])}
+        self.assertEqual(1, self.node.start_all(['vm1', 'vm2', 'vm3']))
+        self.assertEqual(['vm3'], self.started)
+        self.echo_success.assert_called_once_with(
+            'Service start-all for "vm3"')
+
+    def test_io_pressure_holds_back_starts(self):
+        self.pressure.side_effect = [80.0, 80.0, 10.0]
+        self.procs = {'vm1': FakeProcess([None, None, None, 0]),
+                      'vm2': FakeProcess([0])}
+        self.assertEqual(0, self.node.start_all(['vm1', 'vm2'],
+                                                concurrency=2))
+        self.assertEqual(['vm1', 'vm2'], self.started)
+        self.assertEqual(3, self.pressure.call_count)
+
+    @mock.patch(NODE_CLASS + '._stop_instance')
+    @mock.patch('time.time')
+    def test_start_timeout(self, mock_time, stop_instance):
+        mock_time.side_effect = [0, 0, 0, 5, 5, 11, 11]
+        self.procs = {'vm1': FakeProcess([None, None, None]),
+                      'vm2': FakeProcess([None, 0])}
+        self.assertEqual(1, self.node.start_all(['vm1', 'vm2'],
+                                                start_timeout=10))
+        self.assertTrue(self.procs['vm1'].killed)
+        self.assertFalse(self.procs['vm2'].killed)
+        stop_instance.assert_called_once_with('vm1')
+        self.echo_failure.assert_called_once_with(
+            'Service start-all for "vm1"')
+        self.echo_success.assert_called_once_with(
+            'Service start-all for "vm2"')
+
+    @mock.patch(NODE_MODULE + '.get_handle')
+    @mock.patch(NODE_MODULE + '.Libvirt_systemd')
+    def test_stop_instance(self, systemd, get_handle):
+        self.node._stop_instance('vm1')
+        systemd.assert_called_once_with('vm1')
+        systemd.return_value.stop_service.assert_called_once_with(
+            verbose=False)
+        self.assertEqual(0, get_handle.call_count)
+
+        self.node = LitpLibvirtNode(platform=Platform('6', 'sysv'))
+        dom = get_handle.return_value.lookupByName.return_value
+        dom.isActive.return_value = True
+        self.node._stop_instance('vm1')
+        get_handle.return_value.lookupByName.assert_called_once_with('vm1')
+        dom.destroy.assert_called_once_with()
+
+        get_handle.return_value.lookupByName.side_effect = libvirtError(
+            'Domain not found')
+        self.node._stop_instance('vm1')
+        self.assertEqual(1, systemd.call_count)
+
+    @mock.patch('os.path.isfile')
+    @mock.patch('os.listdir')
+    def test_managed_instances(self, listdir, isfile):
+        listdir.return_value = ['vm2', 'vm1', 'images']
+        isfile.side_effect = lambda path: 'images' not in path
+        self.assertEqual(['vm1', 'vm2'], LitpLibvirtNode._managed_instances())
+        isfile.assert_any_call('/var/lib/libvirt/instances/vm1/config.json')
+
+    @mock.patch('__builtin__.open')
+    def test_get_io_pressure(self, mock_open):
+        self.patches[3].stop()
+        try:
+            mock_open.return_value.__enter__.return_value = iter([
+                'some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n',
+                'full avg10=2.00 avg60=1.00 avg300=0.00 total=10\n'])
+            self.assertEqual(12.5, LitpLibvirtNode._get_io_pressure())
+            mock_open.side_effect = IOError('No such file')
+            self.assertEqual(0.0, LitpLibvirtNode._get_io_pressure())
+        finally:
+            self.patches[3].start()
+
+    @mock.patch.dict(os.environ, {'PYTHONPATH': '/opt/lib'})
+    @mock.patch('subprocess.Popen')
+    def test_start_instance_command(self, popen):
+        self.patches[5].stop()
+        try:
+            self.node._start_instance('vm1')
+            self.assertEqual(['/bin/systemctl', 'start', 'vm1'],
+                             popen.call_args[0][0])
+            self.assertTrue(popen.call_args[1]['env']['PYTHONPATH'].endswith(
+                os.pathsep + '/opt/lib'))
+            self.node = LitpLibvirtNode(platform=Platform('6', 'sysv'))
+            self.node._start_instance('vm1')
+            self.assertEqual([sys.executable, '-m',
+                              'litpmnlibvirt.litp_libvirt_adaptor', 'vm1',
+                              'start'], popen.call_args[0][0])
+        finally:
+            self.patches[5].start()
+
+
+class TestLitpLibvirtNodePrewarm(unittest.TestCase):
+    def setUp(self):
+        self.node = LitpLibvirtNode(platform=Platform('7', 'systemd'))
+        self.patches = [mock.patch(NODE_MODULE + '.log'),
+                        mock.patch(NODE_MODULE + '.echo_success'),
+                        mock.patch(NODE_MODULE + '.echo_failure'),
+                        mock.patch(NODE_MODULE + '.Libvirt_image_registry'),
+                        mock.patch(NODE_MODULE + '.Libvirt_vm_image'),
+                        mock.patch(NODE_CLASS + '._get_image_name')]
+        (self.log, self.echo_success, self.echo_failure, self.registry,
+         self.vm_image, self.image_name) = [patch.start()
+                                            for patch in self.patches]
+        self.image_name.side_effect = lambda name: {
+            'vm1': 'a.qcow2', 'vm2': 'a.qcow2', 'vm3': 'b.qcow2',
+            'vm4': 'c.qcow2'}.get(name)
+        self.vm_image.side_effect = lambda name, image: mock.Mock(
+            live_image_exists=mock.Mock(return_value=name == 'vm4'))
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    @mock.patch(NODE_CLASS + '._managed_instances')
+    def test_prewarm_images_of_new_instances(self, managed):
+        managed.return_value = ['vm1', 'vm2', 'vm3', 'vm4', 'vm5']
+        self.registry.return_value.prewarm.return_value = ['b.qcow2']
+        self.assertEqual(1, self.node.prewarm())
+        self.registry.return_value.prewarm.assert_called_once_with(
+            ['a.qcow2', 'b.qcow2'])
+        self.echo_success.assert_called_once_with(
+            'Service prewarm for image "a.qcow2"')
+        self.echo_failure.assert_called_once_with(
+            'Service prewarm for image "b.qcow2"')
+
+    def test_prewarm_nothing_to_do(self):
+        self.assertEqual(0, self.node.prewarm(['vm4']))
+        self.assertEqual(0, self.registry.return_value.prewarm.call_count)
+
+
+class TestLitpLibvirtNodeMain(unittest.TestCase):
+    @mock.patch(NODE_MODULE + '.metrics', mock.Mock())
+    @mock.patch("sys.exit")
+    @mock.patch(NODE_CLASS + '.drain')
+    def test_main_drain(self, drain, _exit):
+        sys.argv = ['litp_libvirt_node', 'drain', '--timeout', '90']
+        drain.return_value = 0
+        _main()
+        drain.assert_called_once_with(timeout=90)
+        _exit.assert_called_once_with(0)
+
+    @mock.patch(NODE_MODULE + '.metrics', mock.Mock())
+    @mock.patch("sys.exit")
+    @mock.patch(NODE_CLASS + '.start_all')
+    def test_main_start_all(self, start_all, _exit):
+        sys.argv = ['litp_libvirt_node', 'start-all', 'vm2', 'vm1',
+                    '--concurrency', '3']
+        start_all.return_value = 1
+        _main()
+        start_all.assert_called_once_with(names=['vm2', 'vm1'],
+                                          concurrency=3,
+                                          max_io_pressure=40.0,
+                                          start_timeout=600)
+        _exit.assert_called_once_with(1)
+
+    @mock.patch(NODE_MODULE + '.metrics', mock.Mock())
+    @mock.patch("sys.exit")
+    @mock.patch(NODE_CLASS + '.prewarm')
+    def test_main_prewarm(self, prewarm, _exit):
+        sys.argv = ['litp_libvirt_node', 'prewarm']
+        prewarm.return_value = 0
+        _main()
+        prewarm.assert_called_once_with(names=None)
+        _exit.assert_called_once_with(0)
@@ -0,0 +1,75 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import os
+import unittest
+
+import mock
+
+os.environ["TESTING_FLAG"] = "1"
+from litpmnlibvirt.litp_libvirt_platform import Platform
+
+OS_RELEASE_RHEL7 = '''NAME="Red Hat Enterprise Linux Server"
+VERSION="7.9 (Maipo)"
+ID="rhel"
+VERSION_ID="7.9"
+'''
+REDHAT_RELEASE_RHEL6 = 'Red Hat Enterprise Linux Server release 6.10 ' \
+                       '(Santiago)\n'
+
+
+class TestPlatform(unittest.TestCase):
+    def setUp(self):
+        Platform._cached = None
+
+    def tearDown(self):
+        Platform._cached = None
+
+    def _detect(self, files, systemd_booted):
+        with mock.patch.object(Platform, '_read_file', files.get):
+            with mock.patch('os.path.isdir',
+                            mock.Mock(return_value=systemd_booted)):
+                return Platform.detect()
+
+    def test_detect_from_os_release(self):
+        platform = self._detect({'/etc/os-release': OS_RELEASE_RHEL7,
+                                 '/etc/redhat-release': 'ignored'}, True)
+        self.assertEqual('7', platform.os_major)
+        self.assertTrue(platform.uses_systemd)
+
+    def test_detect_from_redhat_release(self):
+        platform = self._detect(
+            {'/etc/redhat-release': REDHAT_RELEASE_RHEL6}, False)
+        self.assertEqual('6', platform.os_major)
+        self.assertFalse(platform.uses_systemd)
+
+    def test_detect_systemd_version_without_runtime_dir(self):
+        platform = self._detect({'/etc/os-release': OS_RELEASE_RHEL7}, False)
+        self.assertTrue(platform.uses_systemd)
+
+    def test_detect_unknown_release(self):
+        platform = self._detect({}, True)
+        self.assertEqual('7', platform.os_major)
+        self.assertTrue(platform.uses_systemd)
+        platform = self._detect({'/etc/os-release': 'ID=custom\n'}, False)
+        self.assertEqual('7', platform.os_major)
+        self.assertFalse(platform.uses_systemd)
+
+    def test_from_base_os(self):
+        self.assertFalse(Platform.from_base_os('6').uses_systemd)
+        self.assertTrue(Platform.from_base_os('7').uses_systemd)
+        self.assertTrue(Platform.from_base_os(8).uses_systemd)
+        self.assertEqual('8', Platform.from_base_os(8).os_major)
+
+    @mock.patch.object(Platform, 'detect')
+    def test_get_is_cached(self, mock_detect):
+        mock_detect.return_value = Platform('7', 'systemd')
+        self.assertTrue(Platform.get() is Platform.get())
+        self.assertEqual(1, mock_detect.call_count)
@@ -0,0 +1,113 @@
+##############################################################################
+# COPYRIGHT Ericsson AB 2014
+#
+# The copyright to the computer program(s) herein is the property of
+# Ericsson AB. The programs may be used and/or copied only with written
+# permission from Ericsson AB. or in accordance with the terms and
+# conditions stipulated in the agreement/contract under which the
+# program(s) have been supplied.
+##############################################################################
+
+import json
+import os
+import unittest
+
+import mock
+
+os.environ["TESTING_FLAG"] = "1"
+from litpmnlibvirt.litp_libvirt_timing import ActionTimer, Span, timed
+
+
+class TestActionTimer(unittest.TestCase):
+    def setUp(self):
+        os.environ.pop('LITP_LIBVIRT_TIMING_FILE', None)
+
+    def tearDown(self):
+        ActionTimer._current = None
+        os.environ.pop('LITP_LIBVIRT_TIMING_FILE', None)
+
+    @mock.patch('socket.gethostname', mock.Mock(return_value='node1'))
+    @mock.patch('litpmnlibvirt.litp_libvirt_timing.logger')
+    @mock.patch('time.time')
+    def test_nested_phases(self, mock_time, mock_logger):
+        mock_time.side_effect = [100.0, 100.5, 101.0, 101.5, 102.0, 102.5,
+                                 103.0, 103.0]
+
+        @timed('copy_image')
+        def copy_image():
+            return 'copied'
+
+        with ActionTimer('vm1', 'start') as timer:
+            with Span('define'):
+                self.assertEqual('copied', copy_image())
+            with Span('create'):
+                pass
+            timer.result = 0
+
+        self.assertEqual(None, ActionTimer.current())
+        record = json.loads(
+            mock_logger.info.call_args[0][0][len('Action timing: '):])
+        self.assertEqual({'host': 'node1',
+                          'instance': 'vm1',
+                          'action': 'start',
+                          'result': 0,
+                          'timestamp': 100.0,
+                          'ms': 3000.0,
+                          'phases': [
+                              {'phase': 'define', 'start_ms': 500.0,
+                               'ms': 1500.0},
+                              {'phase': 'define.copy_image',
+                               'start_ms': 1000.0, 'ms': 500.0},
+                              {'phase': 'create', 'start_ms': 2500.0,
+                               'ms': 500.0}]},
+                         record)
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_timing.logger')
+    def test_exception_result(self, mock_logger):
+        def fail():
+            with ActionTimer('vm1', 'stop'):
+                with Span('acpi_shutdown'):
+                    raise ValueError()
+        self.assertRaises(ValueError, fail)
+        record = json.loads(
+            mock_logger.info.call_args[0][0][len('Action timing: '):])
+        self.assertEqual('ValueError', record['result'])
+        self.assertEqual('acpi_shutdown', record['phases'][0]['phase'])
+        self.assertTrue(record['phases'][0]['ms'] is not None)
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_timing.logger')
+    def test_result_not_serializable(self, mock_logger):
+        with ActionTimer('vm1', 'stop') as timer:
+            timer.result = object
+        record = json.loads(
+            mock_logger.info.call_args[0][0][len('Action timing: '):])
+        self.assertEqual(str(object), record['result'])
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_timing.get_tracer')
+    @mock.patch('litpmnlibvirt.litp_libvirt_timing.logger')
+    def test_libvirt_calls_summary(self, mock_logger, mock_get_tracer):
+        tracer = mock_get_tracer.return_value
+        tracer.summary.return_value = {'calls': 3}
+        with ActionTimer('vm1', 'status'):
+            pass
+        tracer.reset.assert_called_once_with()
+        record = json.loads(
+            mock_logger.info.call_args[0][0][len('Action timing: '):])
+        self.assertEqual({'calls': 3}, record['libvirt'])
+
+    def test_span_without_action(self):
+        @timed('copy_image')
+        def copy_image():
+            return 'copied'
+        self.assertEqual('copied', copy_image())
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_timing.logger', mock.Mock())
+    @mock.patch('__builtin__.open')
+    def test_timing_file(self, mock_open):
+        os.environ['LITP_LIBVIRT_TIMING_FILE'] = '/var/log/litp/timing.json'
+        with ActionTimer('vm1', 'status') as timer:
+            timer.result = 1
+        mock_open.assert_called_once_with('/var/log/litp/timing.json', 'a')
+        written = mock_open.return_value.__enter__.return_value.write
+        self.assertEqual(1, json.loads(written.call_args[0][0])['result'])
+        self.assertTrue(written.call_args[0][0].endswith('\n'))
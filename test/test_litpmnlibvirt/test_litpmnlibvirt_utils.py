@@ -8,22 +8,53 @@
 # program(s) have been supplied.
 ##############################################################################
 
+import errno
+import fcntl
+import hashlib
+import json
+import logging
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from StringIO import StringIO
+from io import BytesIO
 
 import mock
 from mock import MagicMock
 
 os.environ["TESTING_FLAG"] = "1"
+from litpmnlibvirt.litp_libvirt_logging import LitpQueueHandler
 from litpmnlibvirt.litp_libvirt_utils import (Libvirt_vm_xml,
                                               Libvirt_vm_image,
                                               Libvirt_conf,
                                               Libvirt_cloud_init,
                                               LitpLibvirtException,
+                                              LitpLibvirtCmdTimeout,
+                                              exec_cmd,
+                                              LazyModule,
                                               log,
                                               load_file_containing_yaml,
-                                              Libvirt_capabilities)
+                                              Libvirt_capabilities,
+                                              Libvirt_host_facts,
+                                              Libvirt_systemd,
+                                              Libvirt_systemd_bus,
+                                              Libvirt_trash,
+                                              Libvirt_image_registry,
+                                              Libvirt_storage_volume,
+                                              Libvirt_backup_index,
+                                              _close_fds,
+                                              SYSTEMCTL_TIMEOUT,
+                                              SYSTEMD_JOB_POLL_INTERVAL,
+                                              SYSTEMD_JOB_TIMEOUT,
+                                              run_in_background)
+
+UTILS_MODULE = 'litpmnlibvirt.litp_libvirt_utils'
+TRASH_CLASS = UTILS_MODULE + '.Libvirt_trash'
 
 import xml.etree.ElementTree as ET
 
@@ -80,6 +111,22 @@ class TestLibvirtLogging(unittest.TestCase):
                                                       'INVALID message: '
                                                       'Message invalid')])
 
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.logger')
+    def test_log_lazy_args(self, mock_logger):
+        mock_logger.isEnabledFor.return_value = True
+        log('Domain "{0}" took {1}s', 'vm1', 3, level='DEBUG')
+        message = mock_logger.debug.call_args[0][0]
+        self.assertEqual('Domain "vm1" took 3s', str(message))
+        mock_logger.isEnabledFor.assert_called_once_with(logging.DEBUG)
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.logger')
+    def test_log_level_disabled(self, mock_logger):
+        mock_logger.isEnabledFor.return_value = False
+        arg = mock.MagicMock()
+        log('Polling {0!s}', arg, level='DEBUG')
+        self.assertEqual(0, mock_logger.debug.call_count)
+        self.assertEqual(0, arg.__str__.call_count)
+
     @mock.patch('sys.stdout')
     @mock.patch('litpmnlibvirt.litp_libvirt_utils.logger')
     def test_log_echos(self, mock_logger, stdout):
@@ -87,6 +134,54 @@ class TestLibvirtLogging(unittest.TestCase):
         stdout.write.assert_any_call('test with echo')
 
 
+class TestLazyModule(unittest.TestCase):
+    @mock.patch('__builtin__.__import__')
+    def test_not_imported_until_used(self, mock_import):
+        LazyModule('keyword')
+        self.assertEqual(0, mock_import.call_count)
+
+    def test_attribute_access(self):
+        keyword = LazyModule('keyword')
+        self.assertTrue(keyword.iskeyword('def'))
+        self.assertTrue(keyword._module is sys.modules['keyword'])
+
+    def test_patch_attribute(self):
+        keyword = LazyModule('keyword')
+        with mock.patch.object(keyword, 'iskeyword') as mock_iskeyword:
+            mock_iskeyword.return_value = False
+            self.assertFalse(keyword.iskeyword('def'))
+        self.assertTrue(keyword.iskeyword('def'))
+
+
+class TestExecCmd(unittest.TestCase):
+    def test_exec_cmd_argv(self):
+        self.assertEqual((0, 'a; b', ''), exec_cmd(['/bin/echo', 'a; b']))
+
+    def test_exec_cmd_shell_string(self):
+        self.assertEqual((3, 'out', 'err'),
+                         exec_cmd('echo out; echo err >&2; exit 3'))
+
+    def test_exec_cmd_missing_command(self):
+        self.assertEqual((127, ''),
+                         exec_cmd(['/nonexistent/virt-what'])[:2])
+
+    def test_exec_cmd_timeout_kills_process_group(self):
+        self.assertRaises(LitpLibvirtCmdTimeout, exec_cmd,
+                          '/bin/sleep 10 & /bin/sleep 10', timeout=0.2)
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.log')
+    def test_exec_cmd_stream(self, mock_log):
+        rc, out, _ = exec_cmd(['/usr/bin/printf', 'one\ntwo'], stream=True)
+        self.assertEqual((0, 'one\ntwo'), (rc, out))
+        self.assertEqual([mock.call('{0}: {1}', '/usr/bin/printf one\ntwo',
+                                    'one', level='DEBUG'),
+                          mock.call('{0}: {1}', '/usr/bin/printf one\ntwo',
+                                    'two', level='DEBUG')],
+                         mock_log.call_args_list[:2])
+        self.assertEqual('Command "{0}" returned {1} in {2:.3f}s',
+                         mock_log.call_args[0][0])
+
+
 class TestLibvirtConf(unittest.TestCase):
     def setUp(self):
         name = "vm"
@@ -107,6 +202,37 @@ class TestLibvirtConf(unittest.TestCase):
             self.conf.read_conf_data()
             self.assertEqual(self.conf.conf, {"key": "value"})
 
+    def test_read_conf_data_shared_until_changed(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, 'vm'))
+            conf_file = os.path.join(root, 'vm', 'config.json')
+            with open(conf_file, 'w') as f:
+                json.dump({'vm_data': {'ram': '256M'}}, f)
+            with mock.patch(UTILS_MODULE + '.LIBVIRT_CONFPATH', root):
+                conf1, conf2 = Libvirt_conf('vm'), Libvirt_conf('vm')
+            with mock.patch('json.load', side_effect=json.load) as load:
+                self.assertEqual('256M', conf1.get_vm_data()['ram'])
+                self.assertTrue(conf1.get_vm_data() is conf2.get_vm_data())
+                self.assertEqual(1, load.call_count)
+
+                with open(conf_file, 'w') as f:
+                    json.dump({'vm_data': {'ram': '1024M'}}, f)
+                self.assertEqual('1024M', conf1.get_vm_data()['ram'])
+                self.assertEqual('1024M', conf2.get_vm_data()['ram'])
+                self.assertEqual(2, load.call_count)
+
+                # A config set on the object is not replaced
+                conf2.conf = {'vm_data': {'ram': '2G'}}
+                self.assertEqual('2G', conf2.get_vm_data()['ram'])
+
+                # Without a stat the file is read every time
+                with mock.patch('os.stat', side_effect=OSError):
+                    conf1.read_conf_data()
+                self.assertEqual(3, load.call_count)
+        finally:
+            shutil.rmtree(root)
+
     @mock.patch('litpmnlibvirt.litp_libvirt_utils.json')
     def test_get_live_conf(self, mock_json):
         def raise_ex(file_contents):
@@ -196,17 +322,97 @@ class TestLibvirtConf(unittest.TestCase):
             result = self.conf.conf_same()
             self.assertTrue(result)
 
+    def test_get_changed_config_files(self):
+        contents = {'/var/lib/libvirt/instances/vm/config.json': '{"a": 2}',
+                    '/var/lib/libvirt/instances/vm/config.json.live':
+                        '{"a": 1}'}
+
+        def fake_open(path, *args):
+            return BytesIO(contents.get(path, 'same'))
+
+        with mock.patch('__builtin__.open', fake_open, create=True):
+            self.assertEqual(['/var/lib/libvirt/instances/vm/config.json'],
+                             self.conf.get_changed_config_files())
+
+    def test_get_changed_config_files_unreadable(self):
+        with mock.patch('__builtin__.open', mock.Mock(side_effect=IOError),
+                        create=True):
+            self.assertEqual([i[0] for i in self.conf.config_files],
+                             self.conf.get_changed_config_files())
+
+    def test_get_domain_xml(self):
+        with mock.patch('__builtin__.open', mock.mock_open(read_data='<x/>'),
+                        create=True) as m:
+            self.assertEqual('<x/>', self.conf.get_domain_xml())
+        m.assert_called_once_with(
+            '/var/lib/libvirt/instances/vm/domain.xml.live', 'r')
+        with mock.patch('__builtin__.open', mock.Mock(side_effect=IOError),
+                        create=True):
+            self.assertEqual(None, self.conf.get_domain_xml())
+
+    def test_save_domain_xml(self):
+        with mock.patch('__builtin__.open', mock.mock_open(),
+                        create=True) as m:
+            self.conf.save_domain_xml('<x/>')
+        m.assert_called_once_with(
+            '/var/lib/libvirt/instances/vm/domain.xml.live', 'w')
+        m.return_value.write.assert_called_once_with('<x/>')
+
+    @mock.patch('os.stat')
+    def test_get_base_image_identity(self, _stat):
+        _stat.return_value = mock.Mock(st_size=1024, st_mtime=1400000000.5,
+                                       st_ino=7)
+        self.assertEqual({'size': 1024, 'mtime': 1400000000.5, 'inode': 7},
+                         self.conf.get_base_image_identity('img.qcow2'))
+        _stat.assert_called_once_with('/var/lib/libvirt/images/img.qcow2')
+        _stat.side_effect = OSError
+        self.assertEqual(None, self.conf.get_base_image_identity('img.qcow2'))
+
+    def test_defined_base_image(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.conf.instance_dir = tmpdir
+            self.assertEqual(None, self.conf.get_defined_base_image())
+            identity = {'size': 1024, 'mtime': 1400000000.5, 'inode': 7}
+            with mock.patch.object(self.conf, 'get_base_image_identity',
+                                   return_value=identity):
+                self.conf.save_defined_base_image('img.qcow2')
+            self.assertEqual(identity, self.conf.get_defined_base_image())
+        finally:
+            shutil.rmtree(tmpdir)
+
     @mock.patch('shutil.copy2')
     def test_conf_copy(self, _copy2):
         r = self.conf.conf_copy()
         self.assertTrue(r)
 
+    @mock.patch(TRASH_CLASS + '.reap_in_background')
+    @mock.patch(TRASH_CLASS + '.move')
+    @mock.patch('os.listdir')
+    def test_cleanup_instance_dir_moves_to_trash(self, mocklistdir,
+                                                 mockmove, mockreap):
+        mocklistdir.return_value = ['meta-data', 'user-data', 'config.json',
+                                    'network-config', 'cloud_init.iso',
+                                    'image.qcow2', 'last_undefined_vm']
+        self.conf.cleanup_instance_dir()
+        mockmove.assert_called_once_with(
+            ['/var/lib/libvirt/instances/vm/cloud_init.iso',
+             '/var/lib/libvirt/instances/vm/image.qcow2'], 'vm')
+        mockreap.assert_called_once_with()
+
+        mockmove.reset_mock()
+        mocklistdir.return_value = ['config.json']
+        self.conf.cleanup_instance_dir()
+        self.assertEqual(0, mockmove.call_count)
+
+    @mock.patch(TRASH_CLASS + '.reap_in_background')
+    @mock.patch(TRASH_CLASS + '.move', mock.Mock(side_effect=OSError))
     @mock.patch('os.listdir')
     @mock.patch('os.unlink')
     @mock.patch('shutil.rmtree')
     @mock.patch('os.path.isdir')
     def test_cleanup_instance_dir_success(self, mockisdir, mockrmtree,
-                                          mockunlink, mocklistdir):
+                                          mockunlink, mocklistdir, mockreap):
         mocklistdir.return_value = ['meta-data', 'user-data', 'config.json',
                                     'network-config', 'cloud_init.iso']
         mockisdir.return_value = False
@@ -219,7 +425,9 @@ class TestLibvirtConf(unittest.TestCase):
         self.conf.cleanup_instance_dir()
         mockrmtree.assert_has_calls(
                 [mock.call('/var/lib/libvirt/instances/vm/test-directory')])
+        self.assertEqual(0, mockreap.call_count)
 
+    @mock.patch(TRASH_CLASS + '.move', mock.Mock(side_effect=OSError))
     @mock.patch('os.listdir')
     @mock.patch('os.unlink')
     def test_cleanup_instance_dir_fail(self, mockunlink, mocklistdir):
@@ -229,6 +437,9 @@ class TestLibvirtConf(unittest.TestCase):
 
         self.assertRaises(OSError, self.conf.cleanup_instance_dir)
 
+    @mock.patch(UTILS_MODULE + '.Libvirt_backup_index')
+    @mock.patch(TRASH_CLASS + '.reap_in_background')
+    @mock.patch(TRASH_CLASS + '.move')
     @mock.patch('os.rename')
     @mock.patch('datetime.datetime')
     @mock.patch('os.path.isdir')
@@ -236,7 +447,8 @@ class TestLibvirtConf(unittest.TestCase):
     @mock.patch('shutil.rmtree')
     @mock.patch('os.path.exists')
     def test_move_files(self, mockexists, mockrmtree,
-                        mockmkdir, mockisdir, mockdatetime, mockrename):
+                        mockmkdir, mockisdir, mockdatetime, mockrename,
+                        mockmove, mockreap, mockindex):
         mockexists.return_value = True
         mockisdir.return_value = True
         strftime = mock.Mock()
@@ -247,6 +459,7 @@ class TestLibvirtConf(unittest.TestCase):
 
         self.conf.get_vm_data = mock.Mock()
         self.conf.get_vm_data.return_value = {'image': 'image.qcow2'}
+        self.conf.get_fingerprint = mock.Mock(return_value='f1')
         self.conf.move_files_to_last_undefined_vm_dir()
 
         self.assertEqual(mockrename.call_args_list, [
@@ -261,6 +474,15 @@ class TestLibvirtConf(unittest.TestCase):
             mock.call('/var/lib/libvirt/instances/vm/network-config.live',
                       '/var/lib/libvirt/instances/vm/last_undefined_vm/network-config.live-test'),
         ])
+        index = mockindex.return_value.load.return_value
+        index.add.assert_called_once_with('test', [
+            'image.qcow2-test', 'config.json.live-test',
+            'user-data.live-test', 'meta-data.live-test',
+            'network-config.live-test'], 'f1')
+        self.conf.get_fingerprint.assert_called_once_with(live=True)
+        index.save.assert_called_once_with()
+        self.assertEqual(0, mockmkdir.call_count)
+        self.assertEqual(0, mockrmtree.call_count)
 
     @mock.patch('litpmnlibvirt.litp_libvirt_utils.log')
     @mock.patch('os.rename')
@@ -284,6 +506,729 @@ class TestLibvirtConf(unittest.TestCase):
         self.assertEqual(mockrename.call_args_list, [])
 
 
+class TestLibvirtBackups(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.confpath = mock.patch(UTILS_MODULE + '.LIBVIRT_CONFPATH',
+                                   self.root)
+        self.confpath.start()
+        self.reap = mock.patch(TRASH_CLASS + '.reap_in_background')
+        self.reap.start()
+        self.adaptor_data = {}
+        self.generation = 0
+
+    def tearDown(self):
+        self.reap.stop()
+        self.confpath.stop()
+        shutil.rmtree(self.root)
+
+    def _conf(self, name='vm'):
+        conf = Libvirt_conf(name)
+        conf.conf = {'vm_data': {'image': 'image.qcow2'},
+                     'adaptor_data': self.adaptor_data}
+        return conf
+
+    def _undefine(self, name='vm', size=10, fingerprint=None):
+        instance_dir = os.path.join(self.root, name)
+        if not os.path.isdir(instance_dir):
+            os.mkdir(instance_dir)
+        for fn in ['image.qcow2', 'config.json.live', 'user-data.live',
+                   'meta-data.live', 'network-config.live']:
+            with open(os.path.join(instance_dir, fn), 'w') as f:
+                f.write('x' * (size if fn == 'image.qcow2' else 1))
+        self.generation += 1
+        with mock.patch('datetime.datetime') as mockdatetime:
+            mockdatetime.now.return_value.strftime.return_value = \
+                '201801010000{0:02d}'.format(self.generation)
+            with mock.patch.object(Libvirt_conf, 'get_fingerprint',
+                                   return_value=fingerprint):
+                self._conf(name).move_files_to_last_undefined_vm_dir()
+
+    def _generations(self, name='vm'):
+        index = Libvirt_backup_index(os.path.join(
+            self.root, name, 'last_undefined_vm')).load()
+        return [g['generation'] for g in index.generations]
+
+    def _trashed(self):
+        trash = os.path.join(self.root, '.trash')
+        if not os.path.isdir(trash):
+            return []
+        return sorted(fn for d in os.listdir(trash)
+                      for fn in os.listdir(os.path.join(trash, d)))
+
+    def test_keeps_one_generation_by_default(self):
+        self._undefine()
+        self._undefine()
+        self.assertEqual(['20180101000002'], self._generations())
+        self.assertEqual(['config.json.live-20180101000001',
+                          'image.qcow2-20180101000001',
+                          'meta-data.live-20180101000001',
+                          'network-config.live-20180101000001',
+                          'user-data.live-20180101000001'], self._trashed())
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.root, 'vm', 'last_undefined_vm',
+            'image.qcow2-20180101000002')))
+
+    def test_keeps_configured_generations(self):
+        self.adaptor_data['backup-generations'] = 2
+        for _ in range(3):
+            self._undefine()
+        self.assertEqual(['20180101000002', '20180101000003'],
+                         self._generations())
+        index = Libvirt_backup_index(os.path.join(
+            self.root, 'vm', 'last_undefined_vm')).load()
+        self.assertEqual(14, index.generations[0]['size'])
+        self.assertEqual(5, len(index.generations[0]['files']))
+
+    def test_evicts_by_instance_size(self):
+        self.adaptor_data.update({'backup-generations': 5,
+                                  'backup-max-size': '1K'})
+        self._undefine(size=600)
+        self._undefine(size=600)
+        self.assertEqual(['20180101000002'], self._generations())
+        # The newest generation is kept even if it is too large
+        self._undefine(size=2048)
+        self.assertEqual(['20180101000003'], self._generations())
+
+    def test_evicts_by_host_size(self):
+        self.adaptor_data.update({'backup-generations': 5,
+                                  'backup-host-max-size': 1000})
+        self._undefine('other', size=600)
+        self._undefine(size=100)
+        self._undefine(size=100)
+        self.assertEqual(['20180101000002', '20180101000003'],
+                         self._generations())
+        # The oldest generations of all instances are evicted first
+        self._undefine(size=300)
+        self.assertEqual(['20180101000002', '20180101000003',
+                          '20180101000004'], self._generations())
+        self.assertEqual([], self._generations('other'))
+        self.assertTrue('image.qcow2-20180101000001' in self._trashed())
+        # Only the generation just written is always kept
+        self._undefine('other', size=2000)
+        self.assertEqual([], self._generations())
+        self.assertEqual(['20180101000005'], self._generations('other'))
+
+    def test_evicts_when_filesystem_is_full(self):
+        self.adaptor_data.update({'backup-generations': 5,
+                                  'backup-min-free-percent': 10})
+        self._undefine()
+        with mock.patch('os.statvfs') as statvfs:
+            statvfs.return_value = mock.Mock(f_bavail=5, f_blocks=100,
+                                             f_frsize=4096)
+            self._undefine()
+        self.assertEqual(['20180101000002'], self._generations())
+
+        self._undefine('other')
+        with mock.patch('os.statvfs') as statvfs:
+            statvfs.return_value = mock.Mock(f_bavail=5, f_blocks=100,
+                                             f_frsize=4096)
+            self._undefine('other')
+        self.assertEqual([], self._generations())
+        self.assertEqual(['20180101000004'], self._generations('other'))
+
+    def test_no_free_space_eviction_by_default(self):
+        self.adaptor_data['backup-generations'] = 5
+        self._undefine('other')
+        with mock.patch('os.statvfs') as statvfs:
+            statvfs.return_value = mock.Mock(f_bavail=5, f_blocks=100,
+                                             f_frsize=4096)
+            self._undefine()
+            self._undefine()
+        self.assertFalse(statvfs.called)
+        self.assertEqual(['20180101000002', '20180101000003'],
+                         self._generations())
+        self.assertEqual(['20180101000001'], self._generations('other'))
+
+    @mock.patch(UTILS_MODULE + '.log')
+    def test_keeps_config_files_of_pool_backed_instance(self, mocklog):
+        self.adaptor_data['storage-pool'] = 'pool'
+        self._undefine(fingerprint='a')
+        self.assertEqual(['20180101000001'], self._generations())
+        index = Libvirt_backup_index(os.path.join(
+            self.root, 'vm', 'last_undefined_vm')).load()
+        self.assertEqual(['config.json.live-20180101000001',
+                          'user-data.live-20180101000001',
+                          'meta-data.live-20180101000001',
+                          'network-config.live-20180101000001'],
+                         index.generations[0]['files'])
+        self.assertEqual(None, index.generations[0]['fingerprint'])
+        mocklog.assert_any_call(
+            'The image of Domain "vm" is a volume of storage pool "pool" '
+            'and is not backed up, it cannot be rolled back')
+
+        conf = self._conf()
+        conf.get_fingerprint = mock.Mock(return_value='a')
+        os.remove(os.path.join(self.root, 'vm', 'image.qcow2'))
+        self.assertFalse(conf.restore_last_undefined_vm())
+
+    def test_scans_backups_without_index(self):
+        backup_dir = os.path.join(self.root, 'vm', 'last_undefined_vm')
+        os.makedirs(backup_dir)
+        for fn in ['image.qcow2-20170101000000',
+                   'config.json.live-20170101000000', 'unrelated']:
+            with open(os.path.join(backup_dir, fn), 'w') as f:
+                f.write('xx')
+        index = Libvirt_backup_index(backup_dir).load()
+        self.assertEqual([{'generation': '20170101000000', 'size': 4,
+                           'files': ['config.json.live-20170101000000',
+                                     'image.qcow2-20170101000000']}],
+                         [dict((k, g[k]) for k in ('generation', 'size',
+                                                   'files'))
+                          for g in index.generations])
+
+    def test_restore_matching_generation(self):
+        self.adaptor_data['backup-generations'] = 3
+        self._undefine(size=10, fingerprint='a')
+        self._undefine(size=20, fingerprint='b')
+        self._undefine(size=30, fingerprint='a')
+        conf = self._conf()
+        conf.get_fingerprint = mock.Mock(return_value='b')
+        self.assertTrue(conf.restore_last_undefined_vm())
+
+        image_file = os.path.join(self.root, 'vm', 'image.qcow2')
+        self.assertEqual(20, os.path.getsize(image_file))
+        self.assertEqual(['20180101000001', '20180101000003'],
+                         self._generations())
+        self.assertEqual(['config.json.live-20180101000002',
+                          'meta-data.live-20180101000002',
+                          'network-config.live-20180101000002',
+                          'user-data.live-20180101000002'], self._trashed())
+
+        # An image already in place is never overwritten
+        conf.get_fingerprint.return_value = 'a'
+        self.assertFalse(conf.restore_last_undefined_vm())
+        os.remove(image_file)
+        self.assertTrue(conf.restore_last_undefined_vm())
+        self.assertEqual(30, os.path.getsize(image_file))
+
+    def test_restore_without_matching_generation(self):
+        self._undefine(fingerprint='a')
+        self._undefine()
+        conf = self._conf()
+        conf.get_fingerprint = mock.Mock(return_value='a')
+        self.assertFalse(conf.restore_last_undefined_vm())
+        conf.get_fingerprint.return_value = None
+        self.assertFalse(conf.restore_last_undefined_vm())
+        self.assertEqual(['20180101000002'], self._generations())
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'vm',
+                                                     'image.qcow2')))
+
+    def test_fingerprint(self):
+        image_dir = os.path.join(self.root, 'images')
+        os.mkdir(image_dir)
+        os.mkdir(os.path.join(self.root, 'vm'))
+        conf = Libvirt_conf('vm')
+        with mock.patch(UTILS_MODULE + '.LIBVIRT_BASE_IMGPATH', image_dir):
+            self.assertEqual(None, conf.get_fingerprint())
+            with open(os.path.join(image_dir, 'image.qcow2'), 'w') as f:
+                f.write('base')
+            config = json.dumps({'vm_data': {'image': 'image.qcow2'}})
+            for conf_file, _ in conf.config_files:
+                with open(conf_file, 'w') as f:
+                    f.write(config if conf_file == conf.conf_file else 'x')
+            fingerprint = conf.get_fingerprint()
+            self.assertNotEqual(None, fingerprint)
+            self.assertEqual(None, conf.get_fingerprint(live=True))
+            conf.conf_copy()
+            self.assertEqual(fingerprint, conf.get_fingerprint(live=True))
+
+            with open(conf.config_files[1][0], 'w') as f:
+                f.write('y')
+            self.assertNotEqual(fingerprint, conf.get_fingerprint())
+            with open(os.path.join(image_dir, 'image.qcow2'), 'w') as f:
+                f.write('new base')
+            self.assertNotEqual(fingerprint, conf.get_fingerprint(live=True))
+
+    def test_backup_policy(self):
+        self.adaptor_data.update({'backup-generations': '3',
+                                  'backup-max-size': '2G',
+                                  'backup-host-max-size': 'lots'})
+        self.assertEqual((3, 2 * 1024 ** 3, None, None),
+                         self._conf().get_backup_policy())
+        self.adaptor_data.update({'backup-generations': 0,
+                                  'backup-host-max-size': 4096,
+                                  'backup-min-free-percent': '15'})
+        self.assertEqual((1, 2 * 1024 ** 3, 4096, 15),
+                         self._conf().get_backup_policy())
+        self.adaptor_data['backup-min-free-percent'] = 150
+        self.assertEqual(None, self._conf().get_backup_policy()[3])
+
+
+class BlockingFileHandler(logging.FileHandler):
+    """
+    Holds its lock in the parent process until ``unblock`` is set.
+    """
+
+    def __init__(self, path):
+        logging.FileHandler.__init__(self, path)
+        self.pid = os.getpid()
+        self.writing = threading.Event()
+        self.unblock = threading.Event()
+
+    def emit(self, record):
+        if os.getpid() == self.pid:
+            self.writing.set()
+            self.unblock.wait(10)
+        logging.FileHandler.emit(self, record)
+
+
+class TestLibvirtTrash(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.confpath = mock.patch(UTILS_MODULE + '.LIBVIRT_CONFPATH',
+                                   self.root)
+        self.confpath.start()
+
+    def tearDown(self):
+        self.confpath.stop()
+        shutil.rmtree(self.root)
+
+    def test_move_and_reap(self):
+        image = os.path.join(self.root, 'image.qcow2')
+        backup = os.path.join(self.root, 'last_undefined_vm')
+        open(image, 'w').close()
+        os.mkdir(backup)
+        open(os.path.join(backup, 'old.qcow2'), 'w').close()
+
+        target = Libvirt_trash.move([image, backup], 'vm')
+        self.assertEqual(os.path.join(self.root, '.trash'),
+                         os.path.dirname(target))
+        self.assertEqual(['image.qcow2', 'last_undefined_vm'],
+                         sorted(os.listdir(target)))
+        self.assertFalse(os.path.exists(image))
+        self.assertTrue(os.path.isdir(Libvirt_trash.move([], 'vm')))
+
+        Libvirt_trash.reap()
+        self.assertEqual(['.lock'],
+                         os.listdir(os.path.join(self.root, '.trash')))
+
+    def test_reap_skipped_while_locked(self):
+        Libvirt_trash.move([], 'vm')
+        with open(os.path.join(self.root, '.trash', '.lock'), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            Libvirt_trash.reap()
+        self.assertEqual(2, len(os.listdir(
+            os.path.join(self.root, '.trash'))))
+
+    def test_reap_without_trash(self):
+        Libvirt_trash.reap()
+        self.assertFalse(os.path.exists(os.path.join(self.root, '.trash')))
+
+    @mock.patch(UTILS_MODULE + '.log')
+    @mock.patch('os.waitpid')
+    @mock.patch('os.fork')
+    def test_reap_in_background(self, mockfork, mockwaitpid, mocklog):
+        mockfork.return_value = 123
+        Libvirt_trash.reap_in_background()
+        mockwaitpid.assert_called_once_with(123, 0)
+
+        mockfork.side_effect = OSError('Resource temporarily unavailable')
+        Libvirt_trash.reap_in_background()
+        mocklog.assert_called_once_with('Unable to start trash reaper: '
+                                        'Resource temporarily unavailable')
+
+    @mock.patch(UTILS_MODULE + '.reinit_logging_after_fork')
+    @mock.patch(UTILS_MODULE + '.flush_logging')
+    @mock.patch(UTILS_MODULE + '._close_fds', mock.Mock())
+    @mock.patch('os.nice', mock.Mock())
+    @mock.patch('os.dup2', mock.Mock())
+    @mock.patch('os.open', mock.Mock())
+    @mock.patch('os.setsid', mock.Mock())
+    @mock.patch('os._exit')
+    @mock.patch('os.fork')
+    def test_run_in_background_child(self, mockfork, mockexit,
+                                     mock_flush_logging, mock_reinit):
+        mockfork.return_value = 0
+        mockexit.side_effect = SystemExit
+        func = mock.Mock(side_effect=ValueError())
+        self.assertRaises(SystemExit, run_in_background, func, 'job')
+        func.assert_called_once_with()
+        mock_flush_logging.assert_called_once_with()
+        mock_reinit.assert_called_once_with()
+        mockexit.assert_called_once_with(0)
+
+    def test_run_in_background_while_record_is_written(self):
+        log_file = os.path.join(self.root, 'litp_libvirt.log')
+        target = BlockingFileHandler(log_file)
+        queue_handler = LitpQueueHandler([target])
+        logger = logging.getLogger('litp_libvirt')
+        with mock.patch.object(logger, 'handlers', [queue_handler]):
+            with mock.patch.object(logger, 'level', logging.DEBUG):
+                try:
+                    log('parent')
+                    self.assertTrue(target.writing.wait(5))
+
+                    def job():
+                        # The writer thread of the parent held the lock of
+                        # the file handler when the job was forked
+                        if target.lock.acquire(False):
+                            target.lock.release()
+                            log('child')
+                    run_in_background(job, 'job')
+                    deadline = time.time() + 3
+                    while time.time() < deadline:
+                        with open(log_file) as f:
+                            if 'child' in f.read():
+                                break
+                        time.sleep(0.05)
+                    with open(log_file) as f:
+                        self.assertTrue('child' in f.read())
+                finally:
+                    target.unblock.set()
+                    queue_handler.close()
+        with open(log_file) as f:
+            self.assertTrue('parent' in f.read())
+
+    @mock.patch('os.closerange')
+    def test_close_fds(self, mock_closerange):
+        _close_fds([8, 1, 5, 5])
+        self.assertEqual([mock.call(3, 5), mock.call(6, 8),
+                          mock.call(9, subprocess.MAXFD)],
+                         mock_closerange.call_args_list)
+
+
+class TestLibvirtImageRegistry(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.registry = Libvirt_image_registry(self.root)
+        self.image = os.path.join(self.root, 'image.qcow2')
+        self._write(self.image, 'image data')
+        self.md5 = hashlib.md5('image data').hexdigest()
+        self.background = mock.patch.object(Libvirt_image_registry,
+                                            'refresh_in_background')
+        self.refresh_in_background = self.background.start()
+
+    def tearDown(self):
+        self.background.stop()
+        shutil.rmtree(self.root)
+
+    @staticmethod
+    def _write(path, data):
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def test_hash_image_records_it(self):
+        record = self.registry.hash_image('image.qcow2')
+        self.assertEqual(self.md5, record['md5'])
+        self.assertEqual(10, record['size'])
+        self.assertEqual(record, self.registry.get_record('image.qcow2'))
+        self.assertEqual({'image.qcow2': record},
+                         Libvirt_image_registry(self.root).load())
+
+        # A changed image has to be hashed again
+        self._write(self.image, 'other image data')
+        self.assertEqual(None, self.registry.get_record('image.qcow2'))
+
+    @mock.patch(UTILS_MODULE + '.IMAGE_READ_BUFFER_SIZE', 3)
+    def test_hash_image_in_chunks(self):
+        self.assertEqual(self.md5,
+                         self.registry.hash_image('image.qcow2')['md5'])
+
+    @mock.patch(UTILS_MODULE + '.log')
+    def test_hash_image_changed_while_hashing(self, mocklog):
+        with mock.patch('os.stat') as mockstat:
+            mockstat.return_value = mock.Mock(st_size=5, st_mtime=1)
+            self.assertEqual(None, self.registry.hash_image('image.qcow2'))
+        mocklog.assert_called_once_with(
+            'Image "image.qcow2" changed while it was hashed')
+        self.assertEqual({}, self.registry.load())
+
+    def test_verify_without_checksum_file(self):
+        self.assertEqual(None, self.registry.verify('image.qcow2'))
+        self.refresh_in_background.assert_called_once_with()
+        self.assertEqual('it does not exist',
+                         self.registry.verify('missing.qcow2'))
+
+    def test_verify_against_checksum_file(self):
+        self._write(self.image + '.md5', self.md5 + '  image.qcow2\n')
+        self.assertEqual(None, self.registry.verify('image.qcow2'))
+        self.assertEqual(0, self.refresh_in_background.call_count)
+        self.assertEqual(self.md5,
+                         self.registry.get_record('image.qcow2')['md5'])
+
+        # A partially transferred image
+        self._write(self.image, 'image')
+        self.assertEqual('its md5 {0} does not match image.qcow2.md5'.format(
+            hashlib.md5('image').hexdigest()),
+            self.registry.verify('image.qcow2'))
+
+    def test_verify_uses_record(self):
+        self._write(self.image + '.md5', self.md5)
+        self.registry.hash_image('image.qcow2')
+        with mock.patch.object(self.registry, 'hash_image') as hash_image:
+            self.assertEqual(None, self.registry.verify('image.qcow2'))
+        self.assertEqual(0, hash_image.call_count)
+
+    def test_refresh_hashes_unrecorded_images(self):
+        self._write(os.path.join(self.root, 'other.qcow2'), 'other')
+        self._write(self.image + '.md5', self.md5)
+        self.registry.hash_image('image.qcow2')
+        with mock.patch.object(self.registry, 'hash_image') as hash_image:
+            self.registry.refresh()
+        hash_image.assert_called_once_with('other.qcow2')
+
+    def test_refresh_skipped_while_running(self):
+        with open(os.path.join(self.root, '.image_registry.json'
+                               '.refresh.lock'), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            with mock.patch.object(self.registry, 'hash_image') as hash_image:
+                self.registry.refresh()
+        self.assertEqual(0, hash_image.call_count)
+
+    @mock.patch(UTILS_MODULE + '.log', mock.Mock())
+    def test_prewarm(self):
+        self.registry.hash_image('image.qcow2')
+        self._write(os.path.join(self.root, 'new.qcow2'), 'new')
+        self.assertEqual(['missing.qcow2'], self.registry.prewarm(
+            ['image.qcow2', 'new.qcow2', 'missing.qcow2']))
+        self.assertEqual(['image.qcow2', 'new.qcow2'],
+                         sorted(self.registry.load()))
+
+    def test_load_ignores_bad_registry(self):
+        self._write(os.path.join(self.root, '.image_registry.json'), '[]')
+        self.assertEqual({}, self.registry.load())
+        self.assertEqual(None, self.registry.get_record('image.qcow2'))
+
+
+class TestLibvirtStorageVolume(unittest.TestCase):
+    def test_from_domain_xml(self):
+        xml = """<domain><devices>
+          <disk type="volume"><source pool="vms" volume="vm-a.qcow2"/></disk>
+          <disk type="volume"><source pool="vms" volume="shared"/></disk>
+          <disk type="file"><source file="/tmp/vm-b.qcow2"/></disk>
+          <disk type="block"><source dev="/dev/sdb"/></disk>
+        </devices></domain>"""
+        volumes = Libvirt_storage_volume.from_domain_xml('vm', xml)
+        self.assertEqual([('vms', 'a.qcow2', 'vm-a.qcow2')],
+                         [(v.pool_name, v.image_name, v.volume_name)
+                          for v in volumes])
+        self.assertEqual([], Libvirt_storage_volume.from_domain_xml('vm',
+                                                                    None))
+
+    @mock.patch(UTILS_MODULE + '.log')
+    def test_from_domain_xml_unreadable(self, mocklog):
+        self.assertEqual([], Libvirt_storage_volume.from_domain_xml(
+            'vm', '<domain>'))
+        self.assertEqual(1, mocklog.call_count)
+
+    def test_get_pool_name(self):
+        self.assertEqual(None, Libvirt_storage_volume.get_pool_name({}))
+        self.assertEqual('vms', Libvirt_storage_volume.get_pool_name(
+            {'storage-pool': 'vms'}))
+
+
+class FakeDBusError(Exception):
+    pass
+
+
+class TestLibvirtSystemd(unittest.TestCase):
+    def setUp(self):
+        self.systemd = Libvirt_systemd('vm')
+        self.bus = mock.Mock()
+        self.bus.error = FakeDBusError
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.echo_success')
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.exec_cmd')
+    @mock.patch.object(Libvirt_systemd_bus, 'get')
+    def test_stop_service_falls_back_to_systemctl(self, mock_get, mock_exec,
+                                                  mock_success):
+        mock_get.return_value = None
+        mock_exec.return_value = (0, '', '')
+        self.assertEqual(0, self.systemd.stop_service())
+        mock_exec.assert_called_once_with(['/bin/systemctl', 'stop', 'vm'],
+                                          timeout=SYSTEMD_JOB_TIMEOUT)
+        mock_success.assert_called_once_with('Service stop for "vm"')
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.echo_failure')
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.exec_cmd')
+    @mock.patch.object(Libvirt_systemd_bus, 'get')
+    def test_start_service_with_dbus(self, mock_get, mock_exec,
+                                     mock_failure):
+        mock_get.return_value = self.bus
+        self.bus.queue_job.return_value = '/org/freedesktop/systemd1/job/1'
+        self.bus.wait_for_jobs.return_value = {
+            '/org/freedesktop/systemd1/job/1': 'failed'}
+        self.assertEqual(1, self.systemd.start_service())
+        self.bus.queue_job.assert_called_once_with('StartUnit', 'vm.service')
+        self.bus.wait_for_jobs.assert_called_once_with(
+            ['/org/freedesktop/systemd1/job/1'], None)
+        mock_failure.assert_called_once_with('Service start for "vm"')
+        self.assertEqual(0, mock_exec.call_count)
+
+    @mock.patch.object(Libvirt_systemd_bus, 'get')
+    def test_run_jobs_queues_all_jobs_first(self, mock_get):
+        mock_get.return_value = self.bus
+        self.bus.queue_job.side_effect = lambda method, unit: unit
+        self.bus.wait_for_jobs.return_value = {'vm1.service': 'done',
+                                               'vm2.service': 'timeout'}
+        rcs = Libvirt_systemd.run_jobs('restart', ['vm1', 'vm2'], timeout=10)
+        self.assertEqual({'vm1': 0, 'vm2': 1}, rcs)
+        self.assertEqual([mock.call('RestartUnit', 'vm1.service'),
+                          mock.call('RestartUnit', 'vm2.service')],
+                         self.bus.queue_job.call_args_list)
+        self.assertEqual(1, self.bus.wait_for_jobs.call_count)
+        self.assertEqual(10, self.bus.wait_for_jobs.call_args[0][1])
+
+    @mock.patch.object(Libvirt_systemd_bus, 'get')
+    def test_run_jobs_missed_signal(self, mock_get):
+        mock_get.return_value = self.bus
+        self.bus.queue_job.side_effect = lambda method, unit: unit
+        self.bus.wait_for_jobs.return_value = {'vm1.service': 'missed',
+                                               'vm2.service': 'missed',
+                                               'vm3.service': 'missed'}
+        states = {'vm1.service': 'active', 'vm2.service': 'failed'}
+
+        def get_active_state(unit):
+            if unit not in states:
+                raise FakeDBusError('gone')
+            return states[unit]
+        self.bus.get_active_state.side_effect = get_active_state
+        self.assertEqual({'vm1': 0, 'vm2': 1, 'vm3': 1},
+                         Libvirt_systemd.run_jobs('start',
+                                                  ['vm1', 'vm2', 'vm3']))
+        self.assertEqual({'vm1': 1, 'vm2': 0, 'vm3': 1},
+                         Libvirt_systemd.run_jobs('stop',
+                                                  ['vm1', 'vm2', 'vm3']))
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.exec_cmd')
+    @mock.patch.object(Libvirt_systemd_bus, 'get')
+    def test_run_jobs_falls_back_on_dbus_error(self, mock_get, mock_exec):
+        mock_get.return_value = self.bus
+        mock_exec.return_value = (0, '', '')
+        self.bus.queue_job.side_effect = ['job1', FakeDBusError('gone')]
+        self.bus.wait_for_jobs.return_value = {'job1': 'done'}
+        self.assertEqual({'vm1': 0, 'vm2': 0},
+                         Libvirt_systemd.run_jobs('stop', ['vm1', 'vm2'],
+                                                  timeout=60))
+        mock_exec.assert_called_once_with(['/bin/systemctl', 'stop', 'vm2'],
+                                          timeout=60)
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.exec_cmd')
+    @mock.patch.object(Libvirt_systemd_bus, 'get')
+    def test_run_jobs_systemctl_timeout(self, mock_get, mock_exec):
+        mock_get.return_value = None
+        mock_exec.side_effect = [(0, '', ''), LitpLibvirtCmdTimeout('stuck')]
+        self.assertEqual({'vm1': 0, 'vm2': 1},
+                         Libvirt_systemd.run_jobs('start', ['vm1', 'vm2']))
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.exec_cmd')
+    @mock.patch.object(Libvirt_systemd_bus, 'get')
+    def test_is_service_inactive(self, mock_get, mock_exec):
+        mock_get.return_value = self.bus
+        self.bus.get_active_state.return_value = 'activating'
+        self.assertTrue(self.systemd.is_service_inactive())
+        self.bus.get_active_state.assert_called_once_with('vm.service')
+        self.bus.get_active_state.return_value = 'active'
+        self.assertFalse(self.systemd.is_service_inactive())
+        self.assertEqual(0, mock_exec.call_count)
+
+        mock_get.return_value = None
+        mock_exec.return_value = (3, 'unknown\n', '')
+        self.assertTrue(self.systemd.is_service_inactive())
+        mock_exec.assert_called_once_with(['/bin/systemctl', 'is-active',
+                                           'vm'], timeout=SYSTEMCTL_TIMEOUT)
+
+        mock_exec.side_effect = LitpLibvirtCmdTimeout('stuck')
+        self.assertFalse(self.systemd.is_service_inactive())
+
+    def test_unit_name(self):
+        self.assertEqual('vm.service', Libvirt_systemd._unit_name('vm'))
+        self.assertEqual('vm.service',
+                         Libvirt_systemd._unit_name('vm.service'))
+        self.assertEqual('vm.1.service', Libvirt_systemd._unit_name('vm.1'))
+
+
+class TestLibvirtSystemdBus(unittest.TestCase):
+    def setUp(self):
+        Libvirt_systemd_bus._instance = None
+        Libvirt_systemd_bus._unavailable = False
+
+    def tearDown(self):
+        Libvirt_systemd_bus._instance = None
+        Libvirt_systemd_bus._unavailable = False
+
+    @mock.patch.object(Libvirt_systemd_bus, '__init__')
+    def test_get_when_dbus_unavailable(self, mock_init):
+        mock_init.side_effect = ImportError('No module named dbus')
+        self.assertEqual(None, Libvirt_systemd_bus.get())
+        self.assertEqual(None, Libvirt_systemd_bus.get())
+        self.assertEqual(1, mock_init.call_count)
+
+    @mock.patch.object(Libvirt_systemd_bus, '__init__')
+    def test_get_is_shared(self, mock_init):
+        mock_init.return_value = None
+        bus = Libvirt_systemd_bus.get()
+        self.assertTrue(bus is Libvirt_systemd_bus.get())
+        self.assertEqual(1, mock_init.call_count)
+
+    def _bus(self, signals, jobs):
+        bus = object.__new__(Libvirt_systemd_bus)
+        bus._jobs = set(jobs)
+        bus._results = {}
+        bus._glib = mock.Mock()
+        bus._context = mock.Mock()
+        bus._context.pending.return_value = False
+        bus.error = FakeDBusError
+
+        def iteration(may_block):
+            signal = signals.pop(0)
+            if callable(signal):
+                signal()
+            else:
+                bus._job_removed(*signal)
+        bus._context.iteration.side_effect = iteration
+        return bus
+
+    def test_wait_for_jobs(self):
+        bus = self._bus([(1, '/job/1', 'vm1.service', 'done'),
+                         (3, '/job/3', 'other.service', 'done'),
+                         (2, '/job/2', 'vm2.service', 'failed')],
+                        ['/job/1', '/job/2'])
+        self.assertEqual({'/job/1': 'done', '/job/2': 'failed'},
+                         bus.wait_for_jobs(['/job/1', '/job/2']))
+        self.assertEqual(3, bus._context.iteration.call_count)
+        self.assertEqual(1, bus._glib.timeout_add.call_count)
+        self.assertEqual({}, bus._results)
+        self.assertEqual(set(), bus._jobs)
+
+    @mock.patch('time.time')
+    def test_wait_for_jobs_timeout(self, mock_time):
+        mock_time.side_effect = [100, 100, 106]
+        bus = self._bus([(1, '/job/1', 'vm1.service', 'done')],
+                        ['/job/1', '/job/2'])
+        self.assertEqual({'/job/1': 'done', '/job/2': 'timeout'},
+                         bus.wait_for_jobs(['/job/1', '/job/2'], timeout=5))
+        self.assertEqual(5000, bus._glib.timeout_add.call_args[0][0])
+
+        # A late signal of a job which timed out is not kept
+        bus._job_removed(2, '/job/2', 'vm2.service', 'done')
+        self.assertEqual({}, bus._results)
+
+    @mock.patch('time.time')
+    def test_wait_for_jobs_default_timeout(self, mock_time):
+        mock_time.side_effect = [100, 100, 100 + SYSTEMD_JOB_TIMEOUT]
+        bus = self._bus([lambda: None], ['/job/1'])
+        self.assertEqual({'/job/1': 'timeout'},
+                         bus.wait_for_jobs(['/job/1']))
+        self.assertEqual(SYSTEMD_JOB_POLL_INTERVAL * 1000,
+                         bus._glib.timeout_add.call_args[0][0])
+
+    def test_wait_for_jobs_missed_signal(self):
+        bus = self._bus([lambda: bus._glib.timeout_add.call_args[0][1]()],
+                        ['/job/1', '/job/2'])
+        bus._job_exists = mock.Mock(side_effect=lambda job: job == '/job/2')
+
+        def pending():
+            # The signal of /job/2 arrives while the jobs are polled
+            bus._job_removed(2, '/job/2', 'vm2.service', 'done')
+            return False
+        bus._context.pending.side_effect = pending
+        self.assertEqual({'/job/1': 'missed', '/job/2': 'done'},
+                         bus.wait_for_jobs(['/job/1', '/job/2']))
+        self.assertEqual(1, bus._context.iteration.call_count)
+
+
 class TestLibvirtCloudInit(unittest.TestCase):
     def setUp(self):
         self.name = "vm"
@@ -320,12 +1265,12 @@ class TestLibvirtCloudInit(unittest.TestCase):
         self.assertEqual("/".join(['/var/lib/libvirt/instances', cloud.name,
                                    'cloud_init.iso']),
                          cloud._iso)
-        expected = mock.call('genisoimage -output '
-                             '/var/lib/libvirt/instances/vm/cloud_init.iso'
-                             ' -volid cidata -joliet -rock'
-                             ' /var/lib/libvirt/instances/vm/user-data'
-                             ' /var/lib/libvirt/instances/vm/meta-data'
-                             ' ')
+        expected = mock.call(['genisoimage', '-output',
+                              '/var/lib/libvirt/instances/vm/cloud_init.iso',
+                              '-volid', 'cidata', '-joliet', '-rock',
+                              '/var/lib/libvirt/instances/vm/user-data',
+                              '/var/lib/libvirt/instances/vm/meta-data'],
+                             timeout=300, stream=True)
     
         mock_exec.assert_has_calls([expected])
         mock_exec.reset_mock()
@@ -439,6 +1384,53 @@ class TestLibvirtImage(unittest.TestCase):
                              self.img_name)
         )
 
+    @mock.patch('fcntl.ioctl')
+    def test_copy_image_clones(self, ioctl):
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, self.name))
+            with open(os.path.join(root, self.img_name), 'w') as f:
+                f.write('image data')
+            os.chmod(os.path.join(root, self.img_name), 0o640)
+            with mock.patch.multiple(UTILS_MODULE, LIBVIRT_CONFPATH=root,
+                                     LIBVIRT_BASE_IMGPATH=root):
+                self.img = Libvirt_vm_image(self.name, self.img_name)
+                with mock.patch('shutil.copy') as _copy:
+                    self.img.copy_image()
+                self.assertEqual(0, _copy.call_count)
+                self.assertEqual(1, ioctl.call_count)
+                self.assertEqual(0x40049409, ioctl.call_args[0][1])
+                live = self.img.get_live_img_path()
+                self.assertEqual(0o640, os.stat(live).st_mode & 0o777)
+        finally:
+            shutil.rmtree(root)
+
+    @mock.patch('fcntl.ioctl')
+    def test_copy_image_without_reflinks(self, ioctl):
+        ioctl.side_effect = IOError(errno.EOPNOTSUPP, 'Operation not '
+                                    'supported')
+        root = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(root, self.name))
+            with open(os.path.join(root, self.img_name), 'w') as f:
+                f.write('image data')
+            with mock.patch.multiple(UTILS_MODULE, LIBVIRT_CONFPATH=root,
+                                     LIBVIRT_BASE_IMGPATH=root):
+                self.img = Libvirt_vm_image(self.name, self.img_name)
+                with mock.patch.object(Libvirt_vm_image, '_no_reflink',
+                                       set()):
+                    self.img.copy_image()
+                    with open(self.img.get_live_img_path()) as f:
+                        self.assertEqual('image data', f.read())
+                    # The filesystems are not tried again
+                    os.remove(self.img.get_live_img_path())
+                    self.img.copy_image()
+                    self.assertEqual(1, ioctl.call_count)
+                    self.assertTrue(os.path.isfile(
+                        self.img.get_live_img_path()))
+        finally:
+            shutil.rmtree(root)
+
     @mock.patch("os.path.isfile")
     def test_base_img_exists(self, _isfile):
         self.assertEquals(_isfile.return_value, self.img.base_image_exists())
@@ -456,6 +1448,11 @@ class TestLibvirtVmXml(unittest.TestCase):
     def setUp(self):
         name = "vm_name"
         self.xml = Libvirt_vm_xml(name)
+        Libvirt_host_facts._cached = Libvirt_host_facts(
+                {'is_bare_metal': False})
+
+    def tearDown(self):
+        Libvirt_host_facts._cached = None
 
     def test_add_image_device(self):
         devices = ET.Element("devices")
@@ -470,6 +1467,29 @@ class TestLibvirtVmXml(unittest.TestCase):
                     '</disk></devices>')
         self.assertEquals(result, expected)
 
+    def test_add_image_device_tuning(self):
+        devices = ET.Element("devices")
+        self.xml._add_image_device(devices, "imagefile",
+                                   {'io': 'native', 'discard': 'unmap',
+                                    'iothread': '1'})
+        driver = devices.find('disk/driver')
+        self.assertEqual({'name': 'qemu', 'type': 'qcow2', 'cache': 'none',
+                          'io': 'native', 'discard': 'unmap',
+                          'iothread': '1'}, driver.attrib)
+
+    def test_add_disk_device_tuning(self):
+        devices = ET.Element("devices")
+        self.xml._add_disk_device(devices, "/dev/vg/lv",
+                                  {'io': 'native', 'discard': None})
+        result = ET.tostring(devices, encoding='utf-8')
+        expected = ('<devices><disk device="disk" type="block">'
+                    '<driver cache="none" io="native" name="qemu"'
+                    ' type="raw" />'
+                    '<source dev="/dev/vg/lv" />'
+                    '<target bus="virtio" dev="vda" />'
+                    '</disk></devices>')
+        self.assertEquals(result, expected)
+
     def test_add_usb_device(self):
         devices = ET.Element("devices")
         self.xml._add_usb_device(devices)
@@ -562,6 +1582,24 @@ class TestLibvirtVmXml(unittest.TestCase):
                     '</devices>')
         self.assertEquals(result, expected)
 
+    def test_add_net_interface_device_multiqueue(self):
+        devices = ET.Element("devices")
+        self.xml._add_net_interface_device(devices, "br1", None, queues=4,
+                                           vhost=True)
+        result = ET.tostring(devices, encoding='utf-8')
+        expected = ('<devices>'
+                    '<interface type="bridge">'
+                    '<source bridge="br1" />'
+                    '<model type="virtio" />'
+                    '<driver name="vhost" queues="4" />'
+                    '</interface>'
+                    '</devices>')
+        self.assertEquals(result, expected)
+
+        devices = ET.Element("devices")
+        self.xml._add_net_interface_device(devices, "br1", None, queues=1)
+        self.assertEqual(None, devices.find('interface/driver'))
+
     def test_add_net_interface_device_no_mac(self):
         devices = ET.Element("devices")
         device = "br1"
@@ -606,7 +1644,7 @@ class TestLibvirtVmXml(unittest.TestCase):
                     '</domain>')
         self.assertEquals(result, expected)
 
-    @mock.patch('litpmnlibvirt.litp_libvirt_utils.exec_cmd')
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.Libvirt_host_facts.get')
     @mock.patch(
             "litpmnlibvirt.litp_libvirt_utils.Libvirt_vm_xml._add_image_device")
     @mock.patch(
@@ -629,7 +1667,7 @@ class TestLibvirtVmXml(unittest.TestCase):
             "litpmnlibvirt.litp_libvirt_utils.Libvirt_vm_xml._add_cdrom_device")
     def test_define_domain(self, mock_cd, mock_net_if, mock_memb,
                            mock_vid, mock_gphics, mock_input, mock_cnsl,
-                           mock_serial, mock_usb, mock_disk, mock_exec):
+                           mock_serial, mock_usb, mock_disk, mock_facts):
         name = "machine_name"
         ram_size = "1024M"
         cpus = "2"
@@ -638,7 +1676,7 @@ class TestLibvirtVmXml(unittest.TestCase):
         nics = {}
         block_devices = []
         # test case for physical machine
-        mock_exec.side_effect = [['0', '', '']]
+        mock_facts.return_value = Libvirt_host_facts({'is_bare_metal': True})
         domain = self.xml._define_domain(name, ram_size, cpus, image, nics,
                                          block_devices)
         result = ET.tostring(domain, encoding='utf-8')
@@ -662,10 +1700,9 @@ class TestLibvirtVmXml(unittest.TestCase):
                     '</domain>')
 
         self.assertEquals(result, expected)
-        mock_exec.reset_mock()
 
         # test case for virtual machine
-        mock_exec.side_effect = [['0', 'vmware', '']]
+        mock_facts.return_value = Libvirt_host_facts({'is_bare_metal': False})
         domain = self.xml._define_domain(name, ram_size, cpus, image, nics,
                                          block_devices)
         result = ET.tostring(domain, encoding='utf-8')
@@ -705,8 +1742,10 @@ class TestLibvirtVmXml(unittest.TestCase):
             domain = self.xml._define_domain(name, ram_size, cpus, image, nics,
                                              block_devices)
             self.assertEqual(mock_net_if.call_args_list, [
-                mock.call(et_subtree_mock, "br0", None),
-                mock.call(et_subtree_mock, "br1", None)])
+                mock.call(et_subtree_mock, "br0", None, queues=None,
+                          vhost=False),
+                mock.call(et_subtree_mock, "br1", None, queues=None,
+                          vhost=False)])
 
         with mock.patch(
                 "litpmnlibvirt.litp_libvirt_utils.Libvirt_vm_xml._add_net_interface_device") \
@@ -723,10 +1762,163 @@ class TestLibvirtVmXml(unittest.TestCase):
             domain = self.xml._define_domain(name, ram_size, cpus, image, nics,
                                              block_devices)
             self.assertEqual(mock_net_if.call_args_list, [
-                mock.call(et_subtree_mock, "br0", '52:54:00:e2:8d:65'),
-                mock.call(et_subtree_mock, "br1", '52:54:00:c3:fa:14'),
-                mock.call(et_subtree_mock, "br2", '52:54:00:c3:fa:15'),
-                mock.call(et_subtree_mock, "br3", '52:54:00:c3:fa:16')])
+                mock.call(et_subtree_mock, "br0", '52:54:00:e2:8d:65',
+                          queues=None, vhost=False),
+                mock.call(et_subtree_mock, "br1", '52:54:00:c3:fa:14',
+                          queues=None, vhost=False),
+                mock.call(et_subtree_mock, "br2", '52:54:00:c3:fa:15',
+                          queues=None, vhost=False),
+                mock.call(et_subtree_mock, "br3", '52:54:00:c3:fa:16',
+                          queues=None, vhost=False)])
+
+    def test_define_domain_io_tuning(self):
+        domain = self.xml._define_domain("vm", "1024M", "4", "img",
+                                         {'eth0': {'host_device': 'br0'}},
+                                         ['/dev/vg/lv1', '/dev/vg/lv2'],
+                                         iothreads='2', disk_io='native',
+                                         disk_discard='unmap',
+                                         net_queues='auto', net_vhost=True)
+        self.assertEqual('2', domain.find('iothreads').text)
+        drivers = [d.find('driver') for d in domain.findall('devices/disk')
+                   if d.get('device') == 'disk']
+        self.assertEqual(['1', '2', '1'],
+                         [d.get('iothread') for d in drivers])
+        self.assertEqual(['native'] * 3, [d.get('io') for d in drivers])
+        self.assertEqual(['unmap'] * 3, [d.get('discard') for d in drivers])
+        net_driver = domain.find('devices/interface/driver')
+        self.assertEqual({'name': 'vhost', 'queues': '4'}, net_driver.attrib)
+
+        domain = self.xml._define_domain("vm", "1024M", "4", "img",
+                                         {'eth0': {'host_device': 'br0'}},
+                                         [], net_queues='8')
+        self.assertEqual({'queues': '4'},
+                         domain.find('devices/interface/driver').attrib)
+        self.assertEqual(None, domain.find('iothreads'))
+
+    def test_define_domain_raises_exception_on_bad_io_tuning(self):
+        for kwargs in ({'disk_io': 'fast'}, {'disk_discard': 'trim'},
+                       {'iothreads': '0'}, {'net_queues': 'many'}):
+            self.assertRaises(LitpLibvirtException, self.xml._define_domain,
+                              "name", "1024M", "2", "img", {}, [], **kwargs)
+
+    def test_define_domain_memory_units(self):
+        for ram_size, unit, value in (('4G', 'GiB', '4'),
+                                      ('1024M', 'MiB', '1024'),
+                                      ('65536K', 'KiB', '65536')):
+            domain = self.xml._define_domain("vm", ram_size, "2", "img", {},
+                                             [])
+            memory = domain.find('memory')
+            self.assertEqual(unit, memory.get('unit'))
+            self.assertEqual(value, memory.text)
+
+    def test_define_domain_memory_backing(self):
+        domain = self.xml._define_domain("vm", "4G", "2", "img", {}, [])
+        self.assertEqual(None, domain.find('memoryBacking'))
+
+        domain = self.xml._define_domain("vm", "4G", "2", "img", {}, [],
+                                         hugepages='1G', memory_locked=True,
+                                         nosharepages=True)
+        result = ET.tostring(domain.find('memoryBacking'), encoding='utf-8')
+        expected = ('<memoryBacking><hugepages>'
+                    '<page size="1" unit="GiB" />'
+                    '</hugepages><nosharepages /><locked /></memoryBacking>')
+        self.assertEqual(expected, result)
+
+        domain = self.xml._define_domain(
+            "vm", "4G", "2", "img", {}, [],
+            hugepages=[{'size': '1G', 'nodeset': '0'},
+                       {'size': '2M', 'nodeset': '1-3'}])
+        result = ET.tostring(domain.find('memoryBacking'), encoding='utf-8')
+        expected = ('<memoryBacking><hugepages>'
+                    '<page nodeset="0" size="1" unit="GiB" />'
+                    '<page nodeset="1-3" size="2" unit="MiB" />'
+                    '</hugepages></memoryBacking>')
+        self.assertEqual(expected, result)
+
+        for hugepages in ('2', '2MB', [{'nodeset': '0'}]):
+            self.assertRaises(LitpLibvirtException, self.xml._define_domain,
+                              "vm", "4G", "2", "img", {}, [],
+                              hugepages=hugepages)
+
+    def test_get_hugepages_requirement(self):
+        self.assertEqual(None, Libvirt_vm_xml.get_hugepages_requirement(
+            'vm', {'ram': '4G'}))
+        self.assertEqual((2048, 2048),
+                         Libvirt_vm_xml.get_hugepages_requirement(
+                             'vm', {'ram': '4G', 'hugepages': '2M'}))
+        self.assertEqual((1048576, 3),
+                         Libvirt_vm_xml.get_hugepages_requirement(
+                             'vm', {'ram': '2049M', 'hugepages': '1G'}))
+        self.assertEqual((2048, 512),
+                         Libvirt_vm_xml.get_hugepages_requirement(
+                             'vm', {'ram': '1024M',
+                                    'hugepages': [
+                                        {'size': '1G', 'nodeset': '1'},
+                                        {'size': '2M', 'nodeset': '0,2'}]}))
+        self.assertRaises(LitpLibvirtException,
+                          Libvirt_vm_xml.get_hugepages_requirement,
+                          'vm', {'ram': '1024M',
+                                 'hugepages': [{'size': '2M',
+                                                'nodeset': 'x'}]})
+
+    def _device_tags(self, domain):
+        return [(d.tag, d.get('type'), d.get('bus'), d.get('model'))
+                for d in domain.find('devices')
+                if d.tag in ('controller', 'input', 'graphics', 'video')]
+
+    def test_define_domain_headless(self):
+        domain = self.xml._define_domain("vm", "1024M", "2", "img", {}, [],
+                                         headless=True)
+        self.assertEqual([('controller', 'usb', None, 'none')],
+                         self._device_tags(domain))
+
+    def test_define_domain_virtio_devices(self):
+        domain = self.xml._define_domain("vm", "1024M", "2", "img", {}, [],
+                                         input_bus='virtio',
+                                         video_model='virtio')
+        self.assertEqual([('controller', 'usb', None, 'none'),
+                          ('input', 'tablet', 'virtio', None),
+                          ('input', 'mouse', 'ps2', None),
+                          ('graphics', 'vnc', None, None),
+                          ('video', None, None, None)],
+                         self._device_tags(domain))
+        self.assertEqual({'type': 'virtio', 'heads': '1'},
+                         domain.find('devices/video/model').attrib)
+        self.assertRaises(LitpLibvirtException, self.xml._define_domain,
+                          "vm", "1024M", "2", "img", {}, [], input_bus='ps2')
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.Libvirt_capabilities.'
+                'get_machine_type')
+    def test_define_domain_machine_type(self, m_get_machine_type):
+        domain = self.xml._define_domain("vm", "1024M", "2", "img", {}, [])
+        self.assertEqual('rhel6.6.0', domain.find('os/type').get('machine'))
+        self.assertEqual(0, m_get_machine_type.call_count)
+
+        m_get_machine_type.return_value = 'pc-q35-rhel7.6.0'
+        domain = self.xml._define_domain("vm", "1024M", "2", "img", {}, [],
+                                         machine_type='q35')
+        m_get_machine_type.assert_called_once_with('q35')
+        self.assertEqual('pc-q35-rhel7.6.0',
+                         domain.find('os/type').get('machine'))
+        cdrom = [d for d in domain.findall('devices/disk')
+                 if d.get('device') == 'cdrom'][0]
+        self.assertEqual({'dev': 'sda', 'bus': 'sata'},
+                         cdrom.find('target').attrib)
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.Libvirt_host_facts.get')
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.Libvirt_conf')
+    def test_build_machine_xml_with_conf_and_host_facts(self, mock_conf,
+                                                         mock_get_facts):
+        conf = mock.Mock()
+        conf.get_vm_data.return_value = {'cpu': '2', 'ram': '1024M',
+                                         'image': 'img', 'interfaces': {}}
+        conf.get_adaptor_data.return_value = {}
+        xml = Libvirt_vm_xml('vm', conf=conf, host_facts=Libvirt_host_facts(
+            {'is_bare_metal': True}))
+        domain = ET.fromstring(xml.build_machine_xml())
+        self.assertEqual('host-passthrough', domain.find('cpu').get('mode'))
+        self.assertEqual(0, mock_conf.call_count)
+        self.assertEqual(0, mock_get_facts.call_count)
 
     def test_define_domain_raises_exception_on_bad_mem(self):
         ram_size = "64k"
@@ -763,7 +1955,13 @@ class TestLibvirtVmXml(unittest.TestCase):
                 [mock.call('vm_name', '1024', '2', 'path/image_name',
                            {'eth1': {'host_device': 'br1'},
                             'eth0': {'host_device': 'br0'}}, [],
-                           cpuset=None, cpunodebind=None)])
+                           cpuset=None, cpunodebind=None, iothreads=None,
+                           disk_io=None, disk_discard=None, net_queues=None,
+                           net_vhost=False, hugepages=None,
+                           memory_locked=False, nosharepages=False,
+                           machine_type=None, headless=False,
+                           video_model=None, input_bus=None,
+                           storage_pool=None)])
 
     def test_find_free_device_name(self):
         root = ET.parse(StringIO("""<root><devices>
@@ -861,6 +2059,188 @@ class TestLibvirtVmXml(unittest.TestCase):
             self.assert_cpuset(expected)
 
 
+class TestLibvirtVmXmlDiff(unittest.TestCase):
+    GENERATED = ('<domain type="kvm"><name>vm</name>'
+                 '<memory unit="MiB">1024</memory>'
+                 '<vcpu placement="static">2</vcpu>'
+                 '<reboot>restart</reboot>'
+                 '<devices>'
+                 '<interface type="bridge"><source bridge="br0" />'
+                 '<model type="virtio" /></interface>'
+                 '<interface type="bridge"><source bridge="br1" />'
+                 '<model type="virtio" /></interface>'
+                 '<serial type="pty"><source path="/dev/pts/3" />'
+                 '<target port="0" /><alias name="serial0" /></serial>'
+                 '<graphics autoport="yes" port="5902" type="vnc" />'
+                 '</devices></domain>')
+
+    LIBVIRT = """<domain type='kvm'>
+  <name>vm</name>
+  <uuid>0ba9e2ff-6fb1-4b5e-9f39-1d7e1f8d2b4a</uuid>
+  <memory unit='KiB'>1048576</memory>
+  <vcpu placement='static'>2</vcpu>
+  <devices>
+    <interface type='bridge'>
+      <mac address='52:54:00:e2:8d:65'/>
+      <source bridge='br0'/>
+      <model type='virtio'/>
+    </interface>
+    <interface type='bridge'>
+      <mac address='52:54:00:c3:fa:14'/>
+      <source bridge='br1'/>
+      <model type='virtio'/>
+    </interface>
+    <serial type='pty'>
+      <target port='0'/>
+    </serial>
+    <graphics type='vnc' port='-1' autoport='yes'/>
+  </devices>
+</domain>"""
+
+    def test_canonicalise(self):
+        self.assertEqual([
+            '/domain[type=kvm]',
+            '/domain/name = vm',
+            '/domain/memory = 1048576',
+            '/domain/vcpu[placement=static] = 2',
+            '/domain/devices',
+            '/domain/devices/interface[type=bridge]',
+            '/domain/devices/interface/source[bridge=br0]',
+            '/domain/devices/interface/model[type=virtio]',
+            '/domain/devices/interface[type=bridge]',
+            '/domain/devices/interface/source[bridge=br1]',
+            '/domain/devices/interface/model[type=virtio]',
+            '/domain/devices/serial[type=pty]',
+            '/domain/devices/serial/target[port=0]',
+            '/domain/devices/graphics[autoport=yes type=vnc]'],
+            Libvirt_vm_xml.canonicalise(self.GENERATED))
+
+    def test_diff_domain_xml(self):
+        self.assertEqual([], Libvirt_vm_xml.diff_domain_xml(self.GENERATED,
+                                                            self.GENERATED))
+        changed = self.GENERATED.replace('br1', 'br2')
+        self.assertEqual(['@@ -10 +10 @@',
+                          '-/domain/devices/interface/source[bridge=br1]',
+                          '+/domain/devices/interface/source[bridge=br2]'],
+                         Libvirt_vm_xml.diff_domain_xml(self.GENERATED,
+                                                        changed))
+
+    def test_missing_domain_xml(self):
+        self.assertEqual([], Libvirt_vm_xml.missing_domain_xml(
+            self.GENERATED, self.LIBVIRT))
+
+        changed = self.GENERATED.replace('1024', '2048')
+        self.assertEqual(['/domain/memory: "2097152" != "1048576"'],
+                         Libvirt_vm_xml.missing_domain_xml(changed,
+                                                           self.LIBVIRT))
+
+        changed = self.GENERATED.replace('br1', 'br2')
+        self.assertEqual(['/domain/devices/interface/source[bridge]: '
+                          '"br2" != "br1"'],
+                         Libvirt_vm_xml.missing_domain_xml(changed,
+                                                           self.LIBVIRT))
+
+
+class TestLibvirtHostFacts(unittest.TestCase):
+    CPUINFO_PHYSICAL = ("processor\t: 0\n"
+                        "model name\t: Intel(R) Xeon(R) CPU E5-2680 v4\n"
+                        "flags\t\t: fpu vme de pse vmx\n\n"
+                        "processor\t: 1\n"
+                        "model name\t: Intel(R) Xeon(R) CPU E5-2680 v4\n"
+                        "flags\t\t: fpu vme de pse vmx\n")
+    CPUINFO_VIRTUAL = ("processor\t: 0\n"
+                       "model name\t: Intel Xeon Processor (Skylake)\n"
+                       "flags\t\t: fpu vme de pse hypervisor\n")
+
+    def setUp(self):
+        Libvirt_host_facts._cached = None
+
+    def tearDown(self):
+        Libvirt_host_facts._cached = None
+
+    def _files(self, files):
+        return mock.Mock(side_effect=lambda path: files.get(path))
+
+    @mock.patch('os.path.exists')
+    def test_detect_physical(self, _exists):
+        _exists.return_value = True
+        files = {'/proc/cpuinfo': self.CPUINFO_PHYSICAL,
+                 '/sys/class/dmi/id/product_name': 'ProLiant DL380 Gen9\n'}
+        with mock.patch.object(Libvirt_host_facts, '_read_file',
+                               self._files(files)):
+            facts = Libvirt_host_facts.detect()
+        self.assertEqual({'is_bare_metal': True,
+                          'cpu_model': 'Intel(R) Xeon(R) CPU E5-2680 v4',
+                          'kvm_available': True}, facts)
+        _exists.assert_called_once_with('/dev/kvm')
+
+    @mock.patch('os.path.exists', mock.Mock(return_value=False))
+    def test_detect_virtual_from_cpu_flags(self):
+        files = {'/proc/cpuinfo': self.CPUINFO_VIRTUAL}
+        with mock.patch.object(Libvirt_host_facts, '_read_file',
+                               self._files(files)):
+            facts = Libvirt_host_facts.detect()
+        self.assertFalse(facts['is_bare_metal'])
+        self.assertFalse(facts['kvm_available'])
+
+    @mock.patch('os.path.exists', mock.Mock(return_value=True))
+    def test_detect_virtual_from_dmi(self):
+        files = {'/proc/cpuinfo': self.CPUINFO_PHYSICAL,
+                 '/sys/class/dmi/id/product_name': 'VMware Virtual Platform'}
+        with mock.patch.object(Libvirt_host_facts, '_read_file',
+                               self._files(files)):
+            facts = Libvirt_host_facts.detect()
+        self.assertFalse(facts['is_bare_metal'])
+
+    @mock.patch('os.path.exists', mock.Mock(return_value=True))
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.exec_cmd')
+    def test_detect_falls_back_to_virt_what(self, mock_exec):
+        mock_exec.return_value = (0, 'vmware', '')
+        with mock.patch.object(Libvirt_host_facts, '_read_file',
+                               self._files({})):
+            facts = Libvirt_host_facts.detect()
+        self.assertFalse(facts['is_bare_metal'])
+        mock_exec.assert_called_once_with(['/usr/sbin/virt-what'],
+                                          timeout=30)
+
+    def test_get_free_hugepages(self):
+        files = {'/sys/kernel/mm/hugepages/hugepages-2048kB/free_hugepages':
+                     '512\n'}
+        with mock.patch.object(Libvirt_host_facts, '_read_file',
+                               self._files(files)):
+            self.assertEqual(512, Libvirt_host_facts.get_free_hugepages(2048))
+            self.assertEqual(None,
+                             Libvirt_host_facts.get_free_hugepages(1048576))
+
+    @mock.patch.object(Libvirt_host_facts, '_save_cache')
+    @mock.patch.object(Libvirt_host_facts, 'detect')
+    def test_get_uses_cache_for_same_boot(self, mock_detect, mock_save):
+        cache = '{"boot_id": "abc", "facts": {"is_bare_metal": true}}'
+        files = {'/proc/sys/kernel/random/boot_id': 'abc\n',
+                 '/var/run/litp_libvirt_host_facts.json': cache}
+        with mock.patch.object(Libvirt_host_facts, '_read_file',
+                               self._files(files)):
+            facts = Libvirt_host_facts.get()
+            self.assertTrue(facts is Libvirt_host_facts.get())
+        self.assertTrue(facts.is_bare_metal)
+        self.assertEqual(0, mock_detect.call_count)
+        self.assertEqual(0, mock_save.call_count)
+
+    @mock.patch.object(Libvirt_host_facts, '_save_cache')
+    @mock.patch.object(Libvirt_host_facts, 'detect')
+    def test_get_detects_on_new_boot(self, mock_detect, mock_save):
+        mock_detect.return_value = {'is_bare_metal': False}
+        cache = '{"boot_id": "old", "facts": {"is_bare_metal": true}}'
+        files = {'/proc/sys/kernel/random/boot_id': 'new\n',
+                 '/var/run/litp_libvirt_host_facts.json': cache}
+        with mock.patch.object(Libvirt_host_facts, '_read_file',
+                               self._files(files)):
+            facts = Libvirt_host_facts.get()
+        self.assertFalse(facts.is_bare_metal)
+        mock_detect.assert_called_once_with()
+        mock_save.assert_called_once_with('new', {'is_bare_metal': False})
+
+
 class TestLibvirt_capabilities(unittest.TestCase):
     # Taken from a Gen9/Gen10 rack
     CAPS_PHYSICAL = """
@@ -910,8 +2290,35 @@ class TestLibvirt_capabilities(unittest.TestCase):
 </capabilities>
         """
 
+    CAPS_MACHINES = """
+<capabilities>
+  <guest>
+    <os_type>hvm</os_type>
+    <arch name='i686'>
+      <machine canonical='pc-i440fx-rhel7.6.0' maxCpus='240'>pc</machine>
+    </arch>
+  </guest>
+  <guest>
+    <os_type>hvm</os_type>
+    <arch name='x86_64'>
+      <wordsize>64</wordsize>
+      <machine maxCpus='240'>pc-i440fx-rhel7.6.0</machine>
+      <machine canonical='pc-i440fx-rhel7.6.0' maxCpus='240'>pc</machine>
+      <machine maxCpus='240'>pc-i440fx-rhel7.0.0</machine>
+      <machine maxCpus='384'>pc-q35-rhel7.6.0</machine>
+      <machine canonical='pc-q35-rhel7.6.0' maxCpus='384'>q35</machine>
+      <machine maxCpus='240'>rhel6.6.0</machine>
+    </arch>
+  </guest>
+</capabilities>
+        """
+
     def setUp(self):
         self.caps = Libvirt_capabilities()
+        Libvirt_capabilities.clear()
+
+    def tearDown(self):
+        Libvirt_capabilities.clear()
 
     @mock.patch('litpmnlibvirt.litp_libvirt_utils.get_handle')
     def test_get_cpu_capabilities(self, p_get_handle):
@@ -929,7 +2336,27 @@ class TestLibvirt_capabilities(unittest.TestCase):
 
         m_conn.getCapabilities.return_value = \
             TestLibvirt_capabilities.CAPS_CLOUD
+        Libvirt_capabilities.clear()
         mappings = self.caps.get_cpu_capabilities()
         self.assertEqual(1, len(mappings))
         self.assertTrue('0' in mappings)
         self.assertEqual('0-1', mappings['0'])
+
+    @mock.patch('litpmnlibvirt.litp_libvirt_utils.get_handle')
+    def test_get_machine_type(self, p_get_handle):
+        m_conn = MagicMock(name='m_conn')
+        p_get_handle.return_value = m_conn
+        m_conn.getCapabilities.return_value = \
+            TestLibvirt_capabilities.CAPS_MACHINES
+
+        self.assertEqual('pc-q35-rhel7.6.0',
+                         self.caps.get_machine_type('q35'))
+        self.assertEqual('pc-i440fx-rhel7.6.0',
+                         self.caps.get_machine_type('pc'))
+        self.assertEqual('pc-i440fx-rhel7.0.0',
+                         self.caps.get_machine_type('pc-i440fx-rhel7.0.0'))
+        self.assertEqual('rhel6.6.0', self.caps.get_machine_type('rhel6.6.0'))
+        self.assertRaises(LitpLibvirtException, self.caps.get_machine_type,
+                          'virt')
+        # The capabilities are only fetched once per process
+        m_conn.getCapabilities.assert_called_once_with()